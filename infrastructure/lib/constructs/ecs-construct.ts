@@ -9,6 +9,7 @@ import * as path from 'path';
 export interface ECSProps {
     stockAnalyticsTable: string;
     portfolioTable: string;
+    analysisRunsTable: string;
     region: string;
 }
 
@@ -84,6 +85,7 @@ export class ECSConstruct extends Construct {
 
         stockAnalytics.addEnvironment('TABLE_NAME_STOCK_ANALYTICS', props.stockAnalyticsTable);
         stockAnalytics.addEnvironment('TABLE_NAME_PORTFOLIO', props.portfolioTable);
+        stockAnalytics.addEnvironment('TABLE_NAME_ANALYSIS_RUNS', props.analysisRunsTable);
         stockAnalytics.addEnvironment('REGION', props.region);
         stockAnalytics.addEnvironment('ROLE', 'STOCK_ANALYST');
 
@@ -119,6 +121,7 @@ export class ECSConstruct extends Construct {
 
         portfolioManager.addEnvironment('TABLE_NAME_STOCK_ANALYTICS', props.stockAnalyticsTable);
         portfolioManager.addEnvironment('TABLE_NAME_PORTFOLIO', props.portfolioTable);
+        portfolioManager.addEnvironment('TABLE_NAME_ANALYSIS_RUNS', props.analysisRunsTable);
         portfolioManager.addEnvironment('REGION', props.region);
         portfolioManager.addEnvironment('ROLE', 'PORTFOLIO_MANAGER');
 
@@ -50,14 +50,23 @@ export class InfrastructureStack extends cdk.Stack {
             billing: dynamodb.Billing.onDemand(),
             tableClass: TableClass.STANDARD,
             deletionProtection: true,
+            // Date partitioned access path, reads scale with one day of data instead of the full history
+            globalSecondaryIndexes: [{
+                indexName: 'date-index',
+                partitionKey: { name: sortKey, type: dynamodb.AttributeType.STRING},
+                sortKey: { name: partitionKey, type: dynamodb.AttributeType.STRING},
+            }],
         });
 
         const stockAnalyticsTable = createDynamoDBTable('StockAnalytics', 'stock', 'date');
         const portfolioTable = createDynamoDBTable('Portfolio', 'stock', 'date');
+        // Shard plans and completion markers of the analyst workers, kept out of the tables users read
+        const analysisRunsTable = createDynamoDBTable('AnalysisRuns', 'run', 'date');
 
         const ecsInfrastructure = new ECSConstruct(this, 'ECSInfrastructure', {
             stockAnalyticsTable: stockAnalyticsTable.tableName,
             portfolioTable: portfolioTable.tableName,
+            analysisRunsTable: analysisRunsTable.tableName,
             region: this.region,
         });
 
@@ -70,6 +79,8 @@ export class InfrastructureStack extends cdk.Stack {
         stockAnalyticsTable.grantFullAccess(ecsInfrastructure.taskDefinitionStockAnalyst.taskRole);
         portfolioTable.grantFullAccess(ecsInfrastructure.taskDefinitionPortfolioManager.taskRole);
         stockAnalyticsTable.grantFullAccess(ecsInfrastructure.taskDefinitionPortfolioManager.taskRole);
+        analysisRunsTable.grantFullAccess(ecsInfrastructure.taskDefinitionStockAnalyst.taskRole);
+        analysisRunsTable.grantReadData(ecsInfrastructure.taskDefinitionPortfolioManager.taskRole);
 
         // Bedrock Agent AWS Lambda
         const dockerfileDir = path.join(__dirname, '../../src/lambda/');
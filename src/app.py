@@ -1,3 +1,4 @@
+import argparse
 import warnings
 import os
 from aws_lambda_powertools import Logger
@@ -5,32 +6,70 @@ from helper.stock_analyst import StockAnalyst
 from helper.finance_api import FinanceService
 from helper.database import DatabaseService
 from helper.portfolio_manager import PortfolioManager
+from helper.batch_inference import create_batch_backend
+from helper.helper import MODEL_ID
+from helper.instrumentation import instrumentation
+from helper.response_cache import response_cache
+from helper.sharding import SqliteWorkQueue, SHARD_MODE
 
 # Suppress FutureWarnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 logger: Logger = Logger(service="app")
 
-stock_analyst: StockAnalyst = StockAnalyst()
-portfolio_manager: PortfolioManager = PortfolioManager()
+# Construction is cheap, each role loads only the data it needs in main
 finance_api: FinanceService = FinanceService()
 database: DatabaseService = DatabaseService()
 
 ROLE = os.getenv("ROLE", "PORTFOLIO_MANAGER")
+FORCE_RECOMPUTE = os.getenv("FORCE_RECOMPUTE", "false").lower() == "true"
+# 'online' ranks every industry with a synchronous model call, 'batch' submits all of them as batch inference jobs
+RANKING_MODE = os.getenv("RANKING_MODE", "online")
 
 
-def main() -> None:
+def main(force_recompute: bool = FORCE_RECOMPUTE, ranking_mode: str = RANKING_MODE,
+         shard_mode: str = SHARD_MODE) -> None:
     """
     Main function to execute stock analysis and portfolio management.
     """
 
-    if ROLE == 'STOCK_ANALYST':
-        stock_analyst.stock_analysis(finance_api, database)
-    elif ROLE == 'PORTFOLIO_MANAGER':
-        portfolio_manager.manage_portfolio(finance_api, database)
-    else:
-        raise ValueError(f'ROLE {ROLE} not found')
+    try:
+        with instrumentation.span(f'{ROLE.lower()}.run'):
+            if ROLE == 'STOCK_ANALYST':
+                # Ranking needs history, fundamentals and indicators of the whole universe
+                finance_api.load_market_data()
+                stock_analyst = StockAnalyst()
+                if shard_mode == 'queue':
+                    if ranking_mode == 'batch':
+                        raise ValueError('Batch ranking runs with static shards only')
+                    queue = SqliteWorkQueue(str(finance_api.today.strftime('%Y-%m-%d')))
+                    stock_analyst.stock_analysis_queue(finance_api, database, queue, force_recompute=force_recompute)
+                elif ranking_mode == 'batch':
+                    stock_analyst.stock_analysis_batch(finance_api, database, create_batch_backend(MODEL_ID),
+                                                       force_recompute=force_recompute)
+                else:
+                    stock_analyst.stock_analysis(finance_api, database, force_recompute=force_recompute)
+            elif ROLE == 'PORTFOLIO_MANAGER':
+                # The day's analyses carry their industry, no universe or market data is loaded
+                PortfolioManager().manage_portfolio(finance_api, database)
+            else:
+                raise ValueError(f'ROLE {ROLE} not found')
+    finally:
+        # The run ends with a profile of where time and calls went
+        if finance_api.market_cache:
+            instrumentation.count_all('market_cache', finance_api.market_cache.get_stats())
+        if response_cache:
+            instrumentation.count_all('response_cache', response_cache.get_stats())
+        instrumentation.flush(ROLE.lower())
 
 
 if __name__ == "__main__":
-    main()
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--force-recompute', action='store_true', default=FORCE_RECOMPUTE,
+                            help='Ignore the checkpoints of today\'s run and analyse all industries again')
+    arg_parser.add_argument('--ranking-mode', choices=['online', 'batch'], default=RANKING_MODE,
+                            help='Rank industries with synchronous model calls or as batch inference jobs')
+    arg_parser.add_argument('--shard-mode', choices=['static', 'queue'], default=SHARD_MODE,
+                            help='Analyse the shard of SHARD_INDEX/SHARD_COUNT or pull industries from a work queue')
+    args = arg_parser.parse_args()
+    main(force_recompute=args.force_recompute, ranking_mode=args.ranking_mode, shard_mode=args.shard_mode)
@@ -0,0 +1,99 @@
+"""
+Benchmark of the internet_search HTML-to-text extraction against the previous BeautifulSoup implementation.
+
+Usage:
+    python benchmark/extractor.py --corpus <directory with saved .html pages> [--repeat 3]
+    python benchmark/extractor.py --corpus <directory> --download <file with one URL per line>
+"""
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+import internet_search  # noqa: E402
+
+
+def legacy_extract(html):
+    """Extraction as done by get_page_content before the streaming extractor."""
+    soup = BeautifulSoup(html.decode('utf-8', errors='replace'), 'html.parser')
+
+    for script_or_style in soup(["script", "style"]):
+        script_or_style.decompose()
+
+    text = soup.get_text()
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    return ';'.join(chunk for chunk in chunks if chunk)
+
+
+def streaming_extract(html):
+    chunks = (html[start:start + internet_search.CHUNK_SIZE]
+              for start in range(0, min(len(html), internet_search.MAX_PAGE_BYTES), internet_search.CHUNK_SIZE))
+    return internet_search.extract_text(chunks)
+
+
+def download_corpus(corpus, urls_file):
+    os.makedirs(corpus, exist_ok=True)
+    with open(urls_file) as file:
+        urls = [line.strip() for line in file if line.strip()]
+
+    for url in urls:
+        try:
+            response = internet_search.session.get(url, timeout=internet_search.FETCH_TIMEOUT)
+            response.raise_for_status()
+        except Exception as e:
+            print(f'Skipping {url}: {e}')
+            continue
+        name = hashlib.sha1(url.encode()).hexdigest()[:16]
+        with open(os.path.join(corpus, f'{name}.html'), 'wb') as file:
+            file.write(response.content)
+
+
+def load_corpus(corpus):
+    pages = []
+    for name in sorted(os.listdir(corpus)):
+        if name.endswith(('.html', '.htm')):
+            with open(os.path.join(corpus, name), 'rb') as file:
+                pages.append(file.read())
+    return pages
+
+
+def run(name, extractor, pages, repeat):
+    output_size = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        output_size = sum(len(extractor(page)) for page in pages)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    input_size = sum(len(page) for page in pages)
+    print(f'{name:<12} {elapsed:8.3f}s  {len(pages) / elapsed:8.1f} pages/s  '
+          f'{input_size / elapsed / 1024 ** 2:8.2f} MB/s  {output_size:>10} output chars')
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--corpus', required=True, help='Directory with saved .html pages')
+    arg_parser.add_argument('--download', help='File with URLs to save into the corpus before benchmarking')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+
+    if args.download:
+        download_corpus(args.corpus, args.download)
+
+    pages = load_corpus(args.corpus)
+    if not pages:
+        raise SystemExit(f'No .html pages found in {args.corpus}')
+
+    parser = 'lxml' if internet_search.etree is not None else 'html.parser'
+    print(f'{len(pages)} pages, {sum(len(page) for page in pages) / 1024 ** 2:.2f} MB, streaming parser: {parser}')
+    run('legacy', legacy_extract, pages, args.repeat)
+    run('streaming', streaming_extract, pages, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,523 @@
+"""
+Local stand-ins for Yahoo Finance, Bedrock, DynamoDB and the internet search Lambda used by the offline pipeline
+benchmark. Every fake counts its calls in ``calls`` and can add latency, the Bedrock fakes can also throttle.
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+import pickle
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError, EventStreamError
+from pynamodb.exceptions import PutError
+
+from helper.database import DatabaseService, WriteResult, BATCH_SIZE, StockAnalysis, Portfolio, \
+    PORTFOLIO_VERSION_KEY, SHARD_MARKER_PREFIX, AnalysisRun
+from helper.batch_inference import read_batch_output, STATUS_COMPLETED
+from helper.fundamentals import FUNDAMENTAL_PARAMETERS
+from helper.instrumentation import instrumentation
+
+STOCKS_PER_INDUSTRY = 12
+SECTORS = 11
+HISTORY_BARS = 300
+RECOMMENDATIONS = ['strong_buy', 'buy', 'hold', 'underperform', 'sell']
+WORDS = ['revenue', 'guidance', 'quarter', 'margin', 'growth', 'analyst', 'upgrade', 'downgrade', 'demand',
+         'supply', 'chain', 'outlook', 'earnings', 'dividend', 'buyback', 'market', 'share', 'product', 'launch',
+         'regulator', 'lawsuit', 'merger', 'acquisition', 'customer', 'contract', 'forecast', 'inflation', 'rates']
+
+
+class CallCounter:
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counts[name] += value
+
+
+calls = CallCounter()
+
+
+def sleep(seconds):
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+# Yahoo Finance
+
+def synthetic_universe(size, stocks_per_industry=STOCKS_PER_INDUSTRY):
+    return [{'symbol': f'SYM{i:05d}', 'index': False, 'name': f'Synthetic Company {i}'} for i in range(size)], \
+        max(1, size // stocks_per_industry)
+
+
+def synthetic_fixture(index, industries, bars=HISTORY_BARS):
+    """Deterministic random walk history and info payload of the synthetic symbol ``index``."""
+    rng = np.random.default_rng(index)
+    dates = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=bars, tz='America/New_York')
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, bars)))
+    history = pd.DataFrame({
+        'Open': close * (1 + rng.normal(0, 0.005, bars)),
+        'High': close * 1.01,
+        'Low': close * 0.99,
+        'Close': close,
+        'Volume': rng.integers(10 ** 5, 10 ** 7, bars),
+        'Dividends': 0.0,
+        'Stock Splits': 0.0,
+    }, index=dates)
+
+    industry = index % industries
+    info = {parameter: float(rng.normal(10, 5)) for parameter in FUNDAMENTAL_PARAMETERS}
+    info.update({
+        'symbol': f'SYM{index:05d}',
+        'shortName': f'Synthetic Company {index}',
+        'longName': f'Synthetic Company {index} Inc.',
+        'industry': f'Industry {industry}',
+        'sector': f'Sector {industry % SECTORS}',
+        'currency': 'USD',
+        'exchange': 'NMS',
+        'recommendationKey': RECOMMENDATIONS[index % len(RECOMMENDATIONS)],
+        'previousClose': float(close[-2]),
+        'currentPrice': float(close[-1]),
+        'marketCap': float(rng.uniform(1e9, 1e12)),
+        'beta': float(rng.uniform(0.5, 2)),
+        'fiftyTwoWeekLow': float(close[-252:].min()),
+        'fiftyTwoWeekHigh': float(close[-252:].max()),
+        'targetMeanPrice': float(close[-1] * rng.uniform(0.8, 1.3)),
+        'longBusinessSummary': ' '.join(rng.choice(WORDS, 120)),
+        'companyOfficers': [{'name': 'Jane Doe', 'title': 'CEO'}],
+    })
+    return history, info
+
+
+class TickerFixtures:
+    """History and info payloads per symbol, synthetic or recorded from Yahoo Finance."""
+
+    def __init__(self, fixtures=None):
+        self.fixtures = fixtures or {}
+
+    @classmethod
+    def synthetic(cls, universe, industries):
+        return cls({symbol['symbol']: synthetic_fixture(index, industries)
+                    for index, symbol in enumerate(universe)})
+
+    @classmethod
+    def load(cls, directory):
+        fixtures = {}
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.pkl'):
+                with open(os.path.join(directory, name), 'rb') as file:
+                    fixture = pickle.load(file)
+                fixtures[fixture['symbol']] = fixture['history'], fixture['info']
+        return cls(fixtures)
+
+    @staticmethod
+    def record(symbols, directory, days=400):
+        """Download history and info of ``symbols`` with yfinance into replayable fixture files."""
+        import yfinance as yf
+
+        os.makedirs(directory, exist_ok=True)
+        for symbol in symbols:
+            ticker = yf.Ticker(symbol)
+            fixture = {'symbol': symbol, 'history': ticker.history(period=f'{days}d'), 'info': ticker.info}
+            with open(os.path.join(directory, f'{symbol}.pkl'), 'wb') as file:
+                pickle.dump(fixture, file)
+
+    def universe(self):
+        return [{'symbol': symbol, 'index': False, 'name': info.get('shortName', symbol)}
+                for symbol, (_, info) in self.fixtures.items()]
+
+
+class FakeTicker:
+    def __init__(self, symbol, fixtures, latency):
+        self.symbol = symbol
+        self.fixtures = fixtures
+        self.latency = latency
+
+    def history(self, start=None, end=None, period=None, **kwargs):
+        calls.add('yahoo.history')
+        sleep(self.latency)
+        history, _ = self.fixtures.fixtures.get(self.symbol, (pd.DataFrame(), {}))
+        if history.empty:
+            return history
+        tz = history.index.tz
+        if start:
+            history = history[history.index >= pd.Timestamp(start).tz_localize(tz)]
+        if end:
+            history = history[history.index < pd.Timestamp(end).tz_localize(tz)]
+        return history.copy()
+
+    @property
+    def info(self):
+        calls.add('yahoo.info')
+        sleep(self.latency)
+        if self.symbol not in self.fixtures.fixtures:
+            raise KeyError(f'No fixture for {self.symbol}')
+        return dict(self.fixtures.fixtures[self.symbol][1])
+
+    @property
+    def earnings_dates(self):
+        calls.add('yahoo.earnings_dates')
+        return None
+
+
+class FakeYFinance:
+    """Replaces the ``yf`` module of helper.finance_api, tickers are served from fixtures."""
+
+    def __init__(self, fixtures, latency=0.0):
+        self.fixtures = fixtures
+        self.latency = latency
+
+    def Ticker(self, symbol):
+        return FakeTicker(symbol, self.fixtures, self.latency)
+
+
+# Bedrock
+
+def parse_table(content):
+    """Rows of the first CSV table in a prompt whose header starts with ``symbol`` or ``stock``."""
+    lines = content.splitlines()
+    for start, line in enumerate(lines):
+        # The header follows the prompt text on its line, e.g. ``Stock data: symbol,name``
+        match = re.search(r'(?:^|\s)((?:symbol|stock),.*)$', line)
+        if match:
+            lines[start] = match.group(1)
+            break
+    else:
+        return []
+
+    rows = []
+    reader = csv.reader(lines[start:])
+    header = next(reader)
+    for values in reader:
+        if len(values) != len(header):
+            break
+        rows.append(dict(zip(header, values)))
+    return rows
+
+
+def fake_completion(request):
+    """Answer ranking and portfolio prompts with a deterministic JSON array after a short preamble."""
+    rows = parse_table(request['messages'][-1]['content'])
+    if rows and 'symbol' in rows[0]:
+        order = sorted(rows, key=lambda row: hashlib.md5(row['symbol'].encode()).hexdigest())
+        result = [{'symbol': row['symbol'], 'rank': rank,
+                   'explanation': f'{row.get("name", row["symbol"])} shows solid fundamentals and momentum.',
+                   'investment_decision': 'buy' if rank <= len(order) // 3 else 'hold'}
+                  for rank, row in enumerate(order, start=1)]
+    else:
+        result = [{'symbol': row['stock'], 'name': row.get('name', ''), 'number_of_shares_to_buy': 10}
+                  for row in rows[:20]]
+    return 'Here is the result:\n' + json.dumps(result, indent=1)
+
+
+def throttling_error(operation, stream=False):
+    # Error events of a stream use lower camel case codes
+    error_response = {'Error': {'Code': 'throttlingException' if stream else 'ThrottlingException',
+                                'Message': 'Rate exceeded'}}
+    return EventStreamError(error_response, operation) if stream else ClientError(error_response, operation)
+
+
+class FakeEventStream:
+    def __init__(self, events, first_latency, chunk_latency, error=None, error_after=0):
+        self.events = events
+        self.first_latency = first_latency
+        self.chunk_latency = chunk_latency
+        self.error = error
+        self.error_after = error_after
+        self.closed = False
+
+    def __iter__(self):
+        sleep(self.first_latency)
+        for position, event in enumerate(self.events):
+            if self.error and position == self.error_after:
+                raise self.error
+            if self.closed:
+                return
+            yield event
+            sleep(self.chunk_latency)
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBedrockRuntime:
+    """``bedrock-runtime`` client answering with ``fake_completion`` after a configurable latency."""
+
+    def __init__(self, latency=0.0, chunk_latency=0.0, throttle_rate=0.0, chunk_chars=80, seed=0):
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.throttle_rate = throttle_rate
+        self.chunk_chars = chunk_chars
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _throttled(self):
+        with self._lock:
+            return self.random.random() < self.throttle_rate
+
+    @staticmethod
+    def _usage(body, text):
+        return {'input_tokens': len(body) // 4, 'output_tokens': len(text) // 4}
+
+    def invoke_model(self, body, modelId):
+        calls.add('bedrock.invoke_model')
+        if self._throttled():
+            calls.add('bedrock.invoke_model.throttled')
+            raise throttling_error('InvokeModel')
+
+        text = fake_completion(json.loads(body))
+        sleep(self.latency)
+        response = {'content': [{'type': 'text', 'text': text}], 'usage': self._usage(body, text)}
+        return {'body': io.BytesIO(json.dumps(response).encode())}
+
+    def invoke_model_with_response_stream(self, body, modelId):
+        calls.add('bedrock.invoke_model_stream')
+        throttled = self._throttled()
+        if throttled:
+            calls.add('bedrock.invoke_model_stream.throttled')
+
+        text = fake_completion(json.loads(body))
+        usage = self._usage(body, text)
+        events = [{'type': 'message_start', 'message': {'usage': {'input_tokens': usage['input_tokens']}}}]
+        events += [{'type': 'content_block_delta', 'delta': {'type': 'text_delta', 'text': text[i:i + size]}}
+                   for size in [self.chunk_chars] for i in range(0, len(text), size)]
+        events += [{'type': 'message_delta', 'usage': {'output_tokens': usage['output_tokens']}},
+                   {'type': 'message_stop'}]
+        chunks = [{'chunk': {'bytes': json.dumps(event).encode()}} for event in events]
+        # Throttling arrives as an error event after the stream was opened, like the service does
+        error = throttling_error('InvokeModelWithResponseStream', True) if throttled else None
+        return {'body': FakeEventStream(chunks, self.latency, self.chunk_latency, error=error, error_after=1)}
+
+
+class FakeBatchBackend:
+    """
+    Batch backend answering every record with ``fake_completion``. Output lines are also appended to
+    ``replay_file`` in the Bedrock batch output format, so ``LocalReplayBackend`` can replay the run.
+    """
+
+    def __init__(self, replay_file=None, latency=0.0):
+        self.replay_file = replay_file
+        self.latency = latency
+        self.jobs = {}
+
+    def submit(self, input_path):
+        calls.add('bedrock.batch_job')
+        job_id = f'fake-{len(self.jobs):06d}'
+        with open(input_path, 'r') as file:
+            records = [json.loads(line) for line in file if line.strip()]
+        calls.add('bedrock.batch_records', len(records))
+        self.jobs[job_id] = [{**record, 'modelOutput': {'content': [
+            {'type': 'text', 'text': fake_completion(record['modelInput'])}]}} for record in records]
+        if self.replay_file:
+            with open(self.replay_file, 'a') as file:
+                file.writelines(json.dumps(line) + '\n' for line in self.jobs[job_id])
+        return job_id
+
+    def status(self, job_id):
+        sleep(self.latency)
+        return STATUS_COMPLETED
+
+    def results(self, job_id):
+        return read_batch_output(json.dumps(line) for line in self.jobs[job_id])
+
+
+class FakeAgentRuntime:
+    """
+    ``bedrock-agent-runtime`` client whose completion is the result of ``search`` for the input text.
+
+    Completions are streamed in small byte chunks which may split multibyte characters. Throttling is raised as
+    an error event of the stream, like the service does.
+    """
+
+    def __init__(self, search, latency=0.0, chunk_latency=0.0, throttle_rate=0.0, output_chars=1500,
+                 chunk_bytes=50, seed=0):
+        self.search = search
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.throttle_rate = throttle_rate
+        self.output_chars = output_chars
+        self.chunk_bytes = chunk_bytes
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def invoke_agent(self, agentId, agentAliasId, sessionId, inputText):
+        calls.add('bedrock.invoke_agent')
+        with self._lock:
+            throttled = self.random.random() < self.throttle_rate
+        if throttled:
+            calls.add('bedrock.invoke_agent.throttled')
+            return {'completion': FakeEventStream([], self.latency, 0, error=throttling_error('InvokeAgent', True))}
+
+        data = self.search(inputText)[:self.output_chars].encode()
+        chunks = [{'chunk': {'bytes': data[i:i + self.chunk_bytes]}} for i in range(0, len(data), self.chunk_bytes)]
+        return {'completion': FakeEventStream(chunks, self.latency, self.chunk_latency)}
+
+
+# Internet search
+
+def canned_html(url, query, paragraphs=30):
+    """Article page with boilerplate around paragraphs mentioning the query."""
+    rng = random.Random(url)
+    body = ''.join(f'<p>{query} {" ".join(rng.choice(WORDS) for _ in range(60))} – {query} €.</p>'
+                   for _ in range(paragraphs))
+    return (f'<html><head><title>{query}</title><script>var tracking = "{"x" * 2000}";</script>'
+            f'<style>.a{{color:red}}</style></head><body><nav>Home | Markets | News</nav>'
+            f'<article><h1>{query}</h1>{body}</article><footer>Copyright</footer></body></html>').encode()
+
+
+def canned_news(query):
+    calls.add('search.canned')
+    return f'{query}: ' + ' '.join(random.Random(query).choice(WORDS) for _ in range(300))
+
+
+class FakeInternetSearch:
+    """
+    Runs the real ``internet_search.handle_search`` with the Google search and ``get_page_content`` replaced by
+    canned HTML pages, optionally loaded from a corpus directory of saved pages.
+    """
+
+    def __init__(self, internet_search, pages_per_query=8, page_latency=0.0, corpus=None):
+        self.internet_search = internet_search
+        self.pages_per_query = pages_per_query
+        self.page_latency = page_latency
+        self.corpus = []
+        if corpus:
+            for name in sorted(os.listdir(corpus)):
+                if name.endswith(('.html', '.htm')):
+                    with open(os.path.join(corpus, name), 'rb') as file:
+                        self.corpus.append(file.read())
+
+        internet_search.search_google = self.search_google
+        internet_search.get_page_content = self.get_page_content
+
+    def search_google(self, query, num_results=10, sleep_interval=5):
+        calls.add('search.query')
+        slug = hashlib.md5(query.encode()).hexdigest()[:8]
+        return [f'https://news.example.com/{slug}/{i}?q={query}' for i in range(self.pages_per_query)]
+
+    def get_page_content(self, url, timeout=None, max_bytes=None):
+        max_bytes = max_bytes or self.internet_search.MAX_PAGE_BYTES
+        if self.corpus:
+            html = self.corpus[int(hashlib.md5(url.encode()).hexdigest(), 16) % len(self.corpus)]
+        else:
+            html = canned_html(url, url.split('?q=', 1)[-1])
+        html = html[:max_bytes]
+
+        calls.add('search.page')
+        calls.add('search.bytes', len(html))
+        sleep(self.page_latency)
+        chunk_size = self.internet_search.CHUNK_SIZE
+        return self.internet_search.extract_text(html[i:i + chunk_size] for i in range(0, len(html), chunk_size))
+
+    def __call__(self, query):
+        # The agent answers from the action group response body
+        result_json = self.internet_search.serialize_results(self.internet_search.handle_search({'inputText': query}))
+        return json.loads(result_json)['results']
+
+
+# DynamoDB
+
+class LocalDatabase(DatabaseService):
+    """
+    In-memory stand-in for the DynamoDB tables. Items are stored in their pynamodb JSON form and persisted to
+    ``path``, so a portfolio manager run in another process sees the analyst results.
+    """
+
+    def __init__(self, path=None, latency=0.0):
+        self.path = path
+        self.latency = latency
+        self.tables = {model.Meta.table_name: {} for model in (StockAnalysis, Portfolio, AnalysisRun)}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, 'r') as file:
+                self.tables.update({table: {tuple(json.loads(key)): item for key, item in items.items()}
+                                    for table, items in json.load(file).items()})
+
+    def persist(self):
+        if self.path:
+            with open(self.path, 'w') as file:
+                json.dump({table: {json.dumps(list(key)): item for key, item in items.items()}
+                           for table, items in self.tables.items()}, file)
+
+    @staticmethod
+    def _key(item):
+        row = json.loads(item.to_json())
+        return row, (row[item._hash_keyname], row[item._range_keyname])
+
+    def _store(self, item):
+        row, key = self._key(item)
+        with self._lock:
+            self.tables[item.Meta.table_name][key] = row
+
+    def batch_save(self, model_class, items):
+        result = WriteResult()
+        for start in range(0, len(items), BATCH_SIZE):
+            chunk = items[start:start + BATCH_SIZE]
+            with instrumentation.span('dynamodb.batch_write', table=model_class.Meta.table_name):
+                calls.add('dynamodb.batch_write')
+                sleep(self.latency)
+                for item in chunk:
+                    self._store(item)
+            result.written += len(chunk)
+        return result
+
+    def _save_item(self, item, condition=None):
+        calls.add('dynamodb.put_item')
+        sleep(self.latency)
+        row, key = self._key(item)
+        with self._lock:
+            # The only condition in use is that the item does not exist yet
+            if condition is not None and key in self.tables[item.Meta.table_name]:
+                raise PutError(cause=ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem'))
+            self.tables[item.Meta.table_name][key] = row
+
+    def _get_item(self, model_class, hash_key, range_key):
+        calls.add('dynamodb.get_item')
+        sleep(self.latency)
+        with self._lock:
+            row = self.tables[model_class.Meta.table_name].get((hash_key, range_key))
+        return dict(row) if row else None
+
+    def _query(self, table, date):
+        calls.add('dynamodb.query')
+        sleep(self.latency)
+        with self._lock:
+            return [dict(row) for (_, row_date), row in self.tables[table].items() if row_date == date]
+
+    def get_analyst_data_by_date(self, date):
+        with instrumentation.span('dynamodb.query', table=StockAnalysis.Meta.table_name):
+            return self._query(StockAnalysis.Meta.table_name, date)
+
+    def get_shard_markers(self, date):
+        return [row for row in self._query(AnalysisRun.Meta.table_name, date)
+                if row['run'].startswith(SHARD_MARKER_PREFIX)]
+
+    def get_previous_analysis(self, symbol, date):
+        calls.add('dynamodb.query')
+        sleep(self.latency)
+        with self._lock:
+            rows = [row for (stock, row_date), row in self.tables[StockAnalysis.Meta.table_name].items()
+                    if stock == symbol and row_date < date]
+        return dict(max(rows, key=lambda row: row['date'])) if rows else None
+
+    def get_latest_portfolio_date(self):
+        with self._lock:
+            dates = [date for stock, date in self.tables[Portfolio.Meta.table_name] if stock == PORTFOLIO_VERSION_KEY]
+        return max(dates, default=None)
+
+    def get_portfolio_data(self, date=None):
+        date = date or self.get_latest_portfolio_date()
+        if date is None:
+            return []
+        return [row for row in self._query(Portfolio.Meta.table_name, date) if row['stock'] != PORTFOLIO_VERSION_KEY]
@@ -0,0 +1,226 @@
+"""
+Offline end-to-end benchmark of app.main with local stand-ins for Yahoo Finance, Bedrock, DynamoDB and the internet
+search Lambda (see benchmark/fakes.py).
+
+Every role and universe size runs in its own process, so peak RSS is measured per run. The portfolio manager
+reads the analyses the stock analyst of the same size wrote to the local DynamoDB stand-in.
+
+In batch ranking mode the batch jobs are answered by a fake backend which records its output to
+``--batch-replay``. If that file already exists, the run replays it with the local batch backend instead, which
+tests the whole batch path offline.
+
+Latencies are realistic per call values multiplied by ``--time-scale``. The client side Bedrock rate limits are
+lifted by default, so throttling comes from the fakes (``--throttle-rate``) and not from the limiter.
+
+Usage (from the src directory):
+    python benchmark/pipeline.py [--symbols 100 1000 5000] [--roles STOCK_ANALYST PORTFOLIO_MANAGER]
+                                 [--time-scale 0.01] [--throttle-rate 0.02] [--fixtures <directory>]
+                                 [--html-corpus <directory> | --canned-news] [--output results.json]
+                                 [--ranking-mode batch [--batch-replay <file>] [--batch-min-records 10]]
+    python benchmark/pipeline.py --record-fixtures <directory> --record-symbols AAPL MSFT ...
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+ROLES = ['STOCK_ANALYST', 'PORTFOLIO_MANAGER']
+# Per call latencies in seconds before scaling
+LATENCIES = {
+    'yahoo': 0.4,
+    'model_first_token': 3.0,
+    'model_chunk': 0.02,
+    'agent_first_chunk': 12.0,
+    'agent_chunk': 0.01,
+    'page': 0.8,
+    'dynamodb': 0.03,
+}
+REPORTED_CALLS = ['yahoo.history', 'yahoo.info', 'bedrock.invoke_agent', 'bedrock.invoke_model_stream',
+                  'bedrock.invoke_model', 'throttled', 'search.page', 'search.bytes', 'dynamodb.batch_write',
+                  'dynamodb.query', 'bedrock.batch_job', 'bedrock.batch_records']
+
+
+def configure_environment(args, role, work_dir):
+    """Settings read by the app modules at import time, they have to be set before the first import."""
+    os.environ.update({
+        'ROLE': role,
+        'AWS_DEFAULT_REGION': os.getenv('AWS_DEFAULT_REGION', 'us-east-1'),
+        'MARKET_CACHE_DIR': os.path.join(work_dir, 'market_data'),
+        'CHECKPOINT_DIR': os.path.join(work_dir, 'checkpoints'),
+        'PROFILE_DIR': os.path.join(work_dir, 'profiles'),
+        'BATCH_WORK_DIR': os.path.join(work_dir, 'batch'),
+        'RESPONSE_CACHE_DIR': '',
+        'PERSISTENT_CACHE': 'none',
+        'LOG_LEVEL': args.log_level,
+        'POWERTOOLS_LOG_LEVEL': args.log_level,
+        'METRICS_NAMESPACE': 'StockAnalysisBenchmark',
+        'BEDROCK_RATE_INVOKE_MODEL': str(args.model_rate),
+        'BEDROCK_BURST_INVOKE_MODEL': str(max(1, int(args.model_rate))),
+        'BEDROCK_RATE_INVOKE_AGENT': str(args.agent_rate),
+        'BEDROCK_BURST_INVOKE_AGENT': str(max(1, int(args.agent_rate))),
+        'BEDROCK_RETRY_BASE_DELAY': str(2 * args.time_scale),
+        'BATCH_POLL_INTERVAL': '0',
+        'BATCH_MIN_RECORDS': str(args.batch_min_records),
+    })
+    if args.batch_replay and os.path.exists(args.batch_replay):
+        os.environ.update({'BATCH_BACKEND': 'local', 'BATCH_REPLAY_FILE': args.batch_replay})
+
+
+def run_role(args):
+    """Run one role in this process and write its measurements to ``<work dir>/result-<role>.json``."""
+    configure_environment(args, args.run, args.work_dir)
+
+    from benchmark import fakes
+    from helper import finance_api, helper
+    from helper.instrumentation import instrumentation
+    import internet_search
+
+    latency = {name: value * args.time_scale for name, value in LATENCIES.items()}
+    if args.fixtures:
+        fixtures = fakes.TickerFixtures.load(args.fixtures)
+        universe = fixtures.universe()[:args.size]
+    else:
+        universe, industries = fakes.synthetic_universe(args.size)
+        fixtures = fakes.TickerFixtures.synthetic(universe, industries)
+
+    finance_api.yf = fakes.FakeYFinance(fixtures, latency=latency['yahoo'])
+    finance_api.FinanceService._get_symbols = lambda self: universe
+    if args.canned_news:
+        search = fakes.canned_news
+    else:
+        search = fakes.FakeInternetSearch(internet_search, page_latency=latency['page'], corpus=args.html_corpus)
+    helper.clients['bedrock-runtime'] = fakes.FakeBedrockRuntime(
+        latency=latency['model_first_token'], chunk_latency=latency['model_chunk'], throttle_rate=args.throttle_rate)
+    helper.clients['bedrock-agent-runtime'] = fakes.FakeAgentRuntime(
+        search, latency=latency['agent_first_chunk'], chunk_latency=latency['agent_chunk'],
+        throttle_rate=args.throttle_rate)
+
+    start = time.perf_counter()
+    import app
+    startup = time.perf_counter() - start
+
+    app.database = fakes.LocalDatabase(os.path.join(args.work_dir, 'dynamodb.json'), latency=latency['dynamodb'])
+    if args.ranking_mode == 'batch' and os.getenv('BATCH_BACKEND') != 'local':
+        replay_file = args.batch_replay or os.path.join(args.work_dir, 'batch_replay.jsonl')
+        app.create_batch_backend = lambda model_id: fakes.FakeBatchBackend(replay_file,
+                                                                           latency=latency['model_first_token'])
+    start = time.perf_counter()
+    app.main(force_recompute=True, ranking_mode=args.ranking_mode)
+    run = time.perf_counter() - start
+    app.database.persist()
+
+    result = {
+        'role': args.run,
+        'symbols': len(universe),
+        # The portfolio manager loads no market data, its industries are not counted
+        'industries': len(app.finance_api._industries or {}),
+        'startup_seconds': round(startup, 3),
+        'run_seconds': round(run, 3),
+        # ru_maxrss is reported in KiB on Linux
+        'peak_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'calls': dict(fakes.calls.counts),
+        'stages': instrumentation.profile()['stages'],
+    }
+    with open(os.path.join(args.work_dir, f'result-{args.run}.json'), 'w') as file:
+        json.dump(result, file, indent=1)
+
+
+def child_arguments(args, role, size, work_dir):
+    arguments = [sys.executable, os.path.abspath(__file__), '--run', role, '--size', str(size),
+                 '--work-dir', work_dir, '--time-scale', str(args.time_scale),
+                 '--throttle-rate', str(args.throttle_rate), '--model-rate', str(args.model_rate),
+                 '--agent-rate', str(args.agent_rate), '--log-level', args.log_level,
+                 '--ranking-mode', args.ranking_mode, '--batch-min-records', str(args.batch_min_records)]
+    if args.fixtures:
+        arguments += ['--fixtures', args.fixtures]
+    if args.html_corpus:
+        arguments += ['--html-corpus', args.html_corpus]
+    if args.canned_news:
+        arguments += ['--canned-news']
+    if args.batch_replay:
+        arguments += ['--batch-replay', os.path.abspath(args.batch_replay)]
+    return arguments
+
+
+def print_results(results):
+    print(f'{"symbols":>8} {"role":<18} {"startup":>9} {"run":>9} {"rss MiB":>8}  calls')
+    for result in results:
+        calls = result['calls']
+        throttled = sum(value for name, value in calls.items() if name.endswith('.throttled'))
+        counts = ', '.join(f'{name}={throttled if name == "throttled" else calls.get(name, 0)}'
+                           for name in REPORTED_CALLS
+                           if (throttled if name == 'throttled' else calls.get(name, 0)))
+        print(f'{result["symbols"]:>8} {result["role"]:<18} {result["startup_seconds"]:>8.2f}s '
+              f'{result["run_seconds"]:>8.2f}s {result["peak_rss_mib"]:>8.1f}  {counts}')
+
+    print('\nSlowest stages (total seconds / count):')
+    for result in results:
+        stages = sorted(result['stages'].items(), key=lambda item: -item[1]['total'])[:6]
+        print(f'{result["symbols"]:>8} {result["role"]:<18} ' +
+              ', '.join(f'{name} {stage["total"]:.2f}/{stage["count"]}' for name, stage in stages))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--symbols', type=int, nargs='+', default=[100, 1000, 5000])
+    arg_parser.add_argument('--roles', nargs='+', choices=ROLES, default=ROLES)
+    arg_parser.add_argument('--time-scale', type=float, default=0.01,
+                            help='Factor applied to the realistic per call latencies')
+    arg_parser.add_argument('--throttle-rate', type=float, default=0.02,
+                            help='Probability that a Bedrock call is throttled')
+    arg_parser.add_argument('--model-rate', type=float, default=1000, help='Client side invoke_model rate limit')
+    arg_parser.add_argument('--agent-rate', type=float, default=1000, help='Client side invoke_agent rate limit')
+    arg_parser.add_argument('--fixtures', help='Directory of recorded ticker fixtures instead of synthetic ones')
+    arg_parser.add_argument('--html-corpus', help='Directory of saved .html pages served by the fake search')
+    arg_parser.add_argument('--canned-news', action='store_true',
+                            help='Answer agent calls with canned text instead of running the internet search')
+    arg_parser.add_argument('--ranking-mode', choices=['online', 'batch'], default='online')
+    arg_parser.add_argument('--batch-replay',
+                            help='Batch output to replay, recorded by the fake batch backend if it does not exist')
+    arg_parser.add_argument('--batch-min-records', type=int, default=10,
+                            help='Smaller ranking rounds are ranked synchronously, Bedrock requires far more')
+    arg_parser.add_argument('--output', help='Write all results as JSON to this file')
+    arg_parser.add_argument('--log-level', default='WARNING')
+    arg_parser.add_argument('--record-fixtures', help='Record ticker fixtures of --record-symbols into this directory')
+    arg_parser.add_argument('--record-symbols', nargs='+', default=[])
+    arg_parser.add_argument('--run', choices=ROLES, help=argparse.SUPPRESS)
+    arg_parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    arg_parser.add_argument('--work-dir', help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.run:
+        return run_role(args)
+
+    if args.record_fixtures:
+        from benchmark.fakes import TickerFixtures
+        return TickerFixtures.record(args.record_symbols, args.record_fixtures)
+
+    results = []
+    for size in args.symbols:
+        with tempfile.TemporaryDirectory(prefix=f'benchmark-{size}-') as work_dir:
+            for role in args.roles:
+                with open(os.path.join(work_dir, f'{role}.log'), 'w') as log:
+                    process = subprocess.run(child_arguments(args, role, size, work_dir), stdout=log,
+                                             stderr=subprocess.STDOUT)
+                if process.returncode != 0:
+                    with open(os.path.join(work_dir, f'{role}.log')) as log:
+                        print(f'{role} with {size} symbols failed:\n{log.read()[-3000:]}')
+                    continue
+                with open(os.path.join(work_dir, f'result-{role}.json')) as file:
+                    results.append(json.load(file))
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Benchmark of the technical indicator engine on synthetic random walk panels.
+
+Usage (from the src directory):
+    python benchmark/technical_indicators.py [--symbols 1000 5000] [--bars 365] [--new-bars 5]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from helper.technical_indicators import TechnicalIndicatorEngine  # noqa: E402
+
+
+def synthetic_panel(symbols, bars, seed=0):
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=bars)
+    columns = [f'SYM{i}' for i in range(symbols)]
+    closes = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, (bars, symbols)), axis=0))
+    volumes = rng.integers(10 ** 5, 10 ** 7, (bars, symbols)).astype('float64')
+    return pd.DataFrame(closes, index=index, columns=columns), pd.DataFrame(volumes, index=index, columns=columns)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--symbols', type=int, nargs='+', default=[1000, 5000])
+    arg_parser.add_argument('--bars', type=int, default=365)
+    arg_parser.add_argument('--new-bars', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    print(f'{"symbols":>8} {"compute":>10} {"update":>10} {"compute/1k":>12} {"update/1k":>12}')
+    for symbols in args.symbols:
+        closes, volumes = synthetic_panel(symbols, args.bars + args.new_bars)
+        history_closes, history_volumes = closes.iloc[:args.bars], volumes.iloc[:args.bars]
+
+        engine = TechnicalIndicatorEngine()
+        start = time.perf_counter()
+        engine.compute(history_closes, history_volumes)
+        compute = time.perf_counter() - start
+
+        start = time.perf_counter()
+        engine.update(closes, volumes)
+        update = time.perf_counter() - start
+
+        print(f'{symbols:>8} {compute:>9.3f}s {update:>9.3f}s '
+              f'{compute / symbols * 1000:>11.3f}s {update / symbols * 1000:>11.3f}s')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+
+import boto3
+from aws_lambda_powertools import Logger
+
+logger = Logger()
+
+# Backend used for batch ranking: 'bedrock' or 'local'
+BATCH_BACKEND = os.getenv("BATCH_BACKEND", "bedrock")
+BATCH_WORK_DIR = os.getenv("BATCH_WORK_DIR", ".cache/batch")
+BATCH_S3_BUCKET = os.getenv("BATCH_S3_BUCKET", "")
+BATCH_S3_PREFIX = os.getenv("BATCH_S3_PREFIX", "batch-inference")
+BATCH_ROLE_ARN = os.getenv("BATCH_ROLE_ARN", "")
+# JSONL file with canned {"recordId", "modelOutput"} lines for the local backend
+BATCH_REPLAY_FILE = os.getenv("BATCH_REPLAY_FILE", "")
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "60"))
+BATCH_TIMEOUT = float(os.getenv("BATCH_TIMEOUT", str(60 * 60 * 24)))
+# Bedrock rejects batch jobs with fewer records, smaller rounds are ranked with synchronous model calls
+BATCH_MIN_RECORDS = int(os.getenv("BATCH_MIN_RECORDS", "100"))
+
+STATUS_COMPLETED = 'Completed'
+FINAL_STATUSES = (STATUS_COMPLETED, 'PartiallyCompleted', 'Failed', 'Stopped', 'Expired')
+
+
+def write_batch_input(records, path):
+    """Write ``{record_id: model_input}`` in the Bedrock batch inference JSONL input format."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as file:
+        for record_id, model_input in records.items():
+            file.write(json.dumps({'recordId': record_id, 'modelInput': model_input}) + '\n')
+    return path
+
+
+def input_digest(model_input):
+    """Stable key of a model input, the same request gets the same key in every run."""
+    return hashlib.sha256(json.dumps(model_input, sort_keys=True).encode()).hexdigest()
+
+
+def read_batch_output(lines):
+    """Map the recordId of Bedrock batch output lines to the completion text, failed records are skipped."""
+    results = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        output = record.get('modelOutput')
+        if not output or 'error' in record:
+            logger.info(f'Batch record {record.get("recordId")} failed: {record.get("error")}')
+            continue
+        results[record['recordId']] = ''.join(content.get('text', '') for content in output.get('content', []))
+    return results
+
+
+class BedrockBatchBackend:
+    """Runs batch jobs with Bedrock model invocation jobs, input and output are exchanged through S3."""
+
+    def __init__(self, model_id, bucket=BATCH_S3_BUCKET, prefix=BATCH_S3_PREFIX, role_arn=BATCH_ROLE_ARN):
+        self.model_id = model_id
+        self.bucket = bucket
+        self.prefix = prefix
+        self.role_arn = role_arn
+        self.s3 = boto3.client('s3')
+        self.bedrock = boto3.client('bedrock')
+        self.jobs = {}
+
+    def submit(self, input_path):
+        name = f'stock-ranking-{uuid.uuid4().hex[:12]}'
+        input_key = f'{self.prefix}/input/{name}.jsonl'
+        self.s3.upload_file(input_path, self.bucket, input_key)
+
+        response = self.bedrock.create_model_invocation_job(
+            jobName=name,
+            roleArn=self.role_arn,
+            modelId=self.model_id,
+            inputDataConfig={'s3InputDataConfig': {'s3Uri': f's3://{self.bucket}/{input_key}'}},
+            outputDataConfig={'s3OutputDataConfig': {'s3Uri': f's3://{self.bucket}/{self.prefix}/output/'}},
+        )
+        job_arn = response['jobArn']
+        self.jobs[job_arn] = input_key
+        return job_arn
+
+    def status(self, job_id):
+        return self.bedrock.get_model_invocation_job(jobIdentifier=job_id)['status']
+
+    def results(self, job_id):
+        # Bedrock writes <output prefix>/<job id>/<input file name>.out
+        input_name = os.path.basename(self.jobs[job_id])
+        output_key = f'{self.prefix}/output/{job_id.split("/")[-1]}/{input_name}.out'
+        body = self.s3.get_object(Bucket=self.bucket, Key=output_key)['Body'].read().decode()
+        return read_batch_output(body.splitlines())
+
+
+class LocalReplayBackend:
+    """
+    Offline stand-in for the batch backend which answers every record from a file of canned responses.
+
+    The replay file uses the Bedrock batch output format, one ``{"recordId", "modelInput", "modelOutput"}``
+    object per line, e.g. the output of an earlier job. Responses are matched by their model input, record ids
+    are only used for lines without one. Records without a canned response are reported as failed.
+    """
+
+    def __init__(self, replay_file=BATCH_REPLAY_FILE):
+        self.responses = {}
+        with open(replay_file, 'r') as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    key = input_digest(record['modelInput']) if 'modelInput' in record else record['recordId']
+                    self.responses[key] = record
+        self.jobs = {}
+
+    def submit(self, input_path):
+        job_id = f'local-{uuid.uuid4().hex[:12]}'
+        with open(input_path, 'r') as file:
+            self.jobs[job_id] = [json.loads(line) for line in file if line.strip()]
+        return job_id
+
+    def status(self, job_id):
+        return STATUS_COMPLETED
+
+    def results(self, job_id):
+        lines = []
+        for record in self.jobs[job_id]:
+            response = self.responses.get(input_digest(record['modelInput']), self.responses.get(record['recordId']))
+            if response is not None:
+                lines.append(json.dumps({**response, 'recordId': record['recordId']}))
+        return read_batch_output(lines)
+
+
+def create_batch_backend(model_id, backend=BATCH_BACKEND):
+    if backend == 'bedrock':
+        return BedrockBatchBackend(model_id)
+    if backend == 'local':
+        return LocalReplayBackend()
+    raise ValueError(f'Batch backend {backend} not found')
+
+
+def run_batch(records, backend, work_dir=BATCH_WORK_DIR, poll_interval=BATCH_POLL_INTERVAL, timeout=BATCH_TIMEOUT):
+    """
+    Submit ``{record_id: model_input}`` as one batch job, wait for it to finish and return
+    ``{record_id: completion}`` for all successful records.
+    """
+    input_path = write_batch_input(records, os.path.join(work_dir, f'{uuid.uuid4().hex}.jsonl'))
+    job_id = backend.submit(input_path)
+    logger.info(f'Submitted batch job {job_id} with {len(records)} records')
+
+    start = time.monotonic()
+    status = backend.status(job_id)
+    while status not in FINAL_STATUSES:
+        if time.monotonic() - start > timeout:
+            raise TimeoutError(f'Batch job {job_id} did not finish within {timeout}s, status {status}')
+        time.sleep(poll_interval)
+        status = backend.status(job_id)
+
+    logger.info(f'Batch job {job_id} finished with status {status} after {round(time.monotonic() - start)}s')
+    if status not in (STATUS_COMPLETED, 'PartiallyCompleted'):
+        raise RuntimeError(f'Batch job {job_id} ended with status {status}')
+    return backend.results(job_id)
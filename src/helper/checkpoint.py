@@ -0,0 +1,68 @@
+import json
+import os
+import threading
+import time
+
+from aws_lambda_powertools import Logger
+
+logger = Logger()
+
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", ".cache/checkpoints")
+
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+class RunManifest:
+    """
+    Per-industry checkpoints of one stock analysis run, stored as a JSON file named after the run date.
+
+    An industry is marked done once its ranking has been saved, so a restarted run on the same date only
+    processes failed or missing industries. The file is local to the task, the analyst also marks industries
+    done whose rows of the date are already in the stock analytics table.
+    """
+
+    def __init__(self, date, directory=CHECKPOINT_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.date = date
+        self.path = os.path.join(directory, f'{date}.json')
+        self._lock = threading.Lock()
+        self.industries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)['industries']
+        except (ValueError, KeyError) as e:
+            logger.info(f'Ignoring unreadable run manifest {self.path}, error: {e}')
+            return {}
+
+    def _write(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'date': self.date, 'industries': self.industries}, file, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def is_done(self, industry):
+        return self.industries.get(industry, {}).get('status') == STATUS_DONE
+
+    def done_industries(self):
+        return [industry for industry in self.industries if self.is_done(industry)]
+
+    def mark_done(self, industry, stocks):
+        self._mark(industry, {'status': STATUS_DONE, 'stocks': stocks})
+
+    def mark_failed(self, industry, error):
+        self._mark(industry, {'status': STATUS_FAILED, 'error': str(error)})
+
+    def _mark(self, industry, entry):
+        with self._lock:
+            self.industries[industry] = {**entry, 'updated_at': time.time()}
+            self._write()
+
+    def reset(self):
+        with self._lock:
+            self.industries = {}
+            self._write()
@@ -1,22 +1,70 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 from aws_lambda_powertools import Logger
 from pynamodb.models import Model
+from pynamodb.indexes import GlobalSecondaryIndex, AllProjection
 from pynamodb.attributes import UnicodeAttribute, NumberAttribute
+from pynamodb.exceptions import PutError
 import os
 import json
+from helper.instrumentation import instrumentation
 
 logger = Logger()
 
 TABLE_NAME_STOCK_ANALYTICS = os.getenv("TABLE_NAME_STOCK_ANALYTICS", "StockAnalytics")
 REGION = os.getenv("REGION", "eu-central-1")
 TABLE_NAME_PORTFOLIO = os.getenv("TABLE_NAME_PORTFOLIO", "Portfolio")
+# Coordination rows of the analyst workers, shard plans and completion markers
+TABLE_NAME_ANALYSIS_RUNS = os.getenv("TABLE_NAME_ANALYSIS_RUNS", "AnalysisRuns")
+# Endpoint of a local DynamoDB stand-in, e.g. http://localhost:8000
+DYNAMODB_HOST = os.getenv("DYNAMODB_HOST")
+# DynamoDB accepts at most 25 put requests per BatchWriteItem call
+BATCH_SIZE = 25
+BATCH_MAX_RETRY_ATTEMPTS = int(os.getenv("BATCH_MAX_RETRY_ATTEMPTS", "5"))
+BATCH_BASE_BACKOFF_MS = int(os.getenv("BATCH_BASE_BACKOFF_MS", "100"))
+DATE_INDEX_NAME = 'date-index'
+# Marker row written after a portfolio is complete, its range keys list all portfolio versions
+PORTFOLIO_VERSION_KEY = '#VERSION'
+# Analysis run rows written by each shard once all its industries are saved
+SHARD_MARKER_PREFIX = 'SHARD-'
+# Analysis run row holding the industries of every shard of a date, stored once by the first worker
+SHARD_PLAN_PREFIX = 'PLAN-'
+
+
+class StockAnalysisDateIndex(GlobalSecondaryIndex):
+    class Meta:
+        index_name = DATE_INDEX_NAME
+        projection = AllProjection()
+
+    date = UnicodeAttribute(hash_key=True)
+    stock = UnicodeAttribute(range_key=True)
+
+
+class PortfolioDateIndex(GlobalSecondaryIndex):
+    class Meta:
+        index_name = DATE_INDEX_NAME
+        projection = AllProjection()
+
+    date = UnicodeAttribute(hash_key=True)
+    stock = UnicodeAttribute(range_key=True)
+
+
+class AnalysisRunDateIndex(GlobalSecondaryIndex):
+    class Meta:
+        index_name = DATE_INDEX_NAME
+        projection = AllProjection()
+
+    date = UnicodeAttribute(hash_key=True)
+    run = UnicodeAttribute(range_key=True)
 
 
 class StockAnalysis(Model):
     class Meta:
         table_name = TABLE_NAME_STOCK_ANALYTICS
         region = REGION
+        host = DYNAMODB_HOST
+        max_retry_attempts = BATCH_MAX_RETRY_ATTEMPTS
+        base_backoff_ms = BATCH_BASE_BACKOFF_MS
 
     stock = UnicodeAttribute(hash_key=True)
     date = UnicodeAttribute(range_key=True)
@@ -27,62 +75,227 @@ class StockAnalysis(Model):
     investment_decision = UnicodeAttribute(null=True)
     explanation = UnicodeAttribute(null=True)
     industry = UnicodeAttribute(null=True)
+    # Fingerprint of the inputs the ranking was made from, see helper.fingerprint
+    fingerprint = UnicodeAttribute(null=True)
+    # Date of the ranking, earlier than date if the analysis was carried forward
+    analysed_on = UnicodeAttribute(null=True)
+    date_index = StockAnalysisDateIndex()
 
 
 class Portfolio(Model):
     class Meta:
         table_name = TABLE_NAME_PORTFOLIO
         region = REGION
+        host = DYNAMODB_HOST
+        max_retry_attempts = BATCH_MAX_RETRY_ATTEMPTS
+        base_backoff_ms = BATCH_BASE_BACKOFF_MS
 
     stock = UnicodeAttribute(hash_key=True)
     date = UnicodeAttribute(range_key=True)
     name = UnicodeAttribute()
     number_of_shares_to_buy = NumberAttribute()
+    date_index = PortfolioDateIndex()
+
+
+class AnalysisRun(Model):
+    class Meta:
+        table_name = TABLE_NAME_ANALYSIS_RUNS
+        region = REGION
+        host = DYNAMODB_HOST
+        max_retry_attempts = BATCH_MAX_RETRY_ATTEMPTS
+        base_backoff_ms = BATCH_BASE_BACKOFF_MS
+
+    # PLAN-of-<count> or SHARD-<index>-of-<count>
+    run = UnicodeAttribute(hash_key=True)
+    date = UnicodeAttribute(range_key=True)
+    # JSON of the industries per shard of a plan, or of the industries a shard analysed
+    industries = UnicodeAttribute()
+    plan_digest = UnicodeAttribute(null=True)
+    stocks = NumberAttribute(null=True)
+    date_index = AnalysisRunDateIndex()
+
+
+@dataclass()
+class WriteResult:
+    written: int = 0
+    failed: int = 0
+    failed_keys: list = field(default_factory=list)
+
+    def merge(self, other):
+        self.written += other.written
+        self.failed += other.failed
+        self.failed_keys.extend(other.failed_keys)
+        return self
 
 
 @dataclass()
 class DatabaseService:
 
     def save_stock_analytics(self, objects):
+        items = []
+        result = WriteResult()
         for obj in objects:
             try:
-                item = StockAnalysis(stock=obj["symbol"],
-                                     date=obj["date"],
-                                     close=obj["previousClose"],
-                                     rank=obj.get('rank', 999),
-                                     stock_news=obj.get("StockNews", "None"),
-                                     investment_decision=obj.get("investment_decision", "None"),
-                                     explanation=obj.get("explanation", 'No explanation found'),
-                                     industry=obj["industry"],
-                                     name=obj.get('name'))
-                item.save()
+                items.append(StockAnalysis(stock=obj["symbol"],
+                                           date=obj["date"],
+                                           close=obj["previousClose"],
+                                           rank=obj.get('rank', 999),
+                                           stock_news=obj.get("StockNews", "None"),
+                                           investment_decision=obj.get("investment_decision", "None"),
+                                           explanation=obj.get("explanation", 'No explanation found'),
+                                           industry=obj["industry"],
+                                           name=obj.get('name'),
+                                           fingerprint=obj.get('fingerprint'),
+                                           analysed_on=obj.get('analysed_on', obj["date"])))
             except Exception as e:
                 logger.info(f'Error while saving, obj : {obj}, error: {e}')
+                result.failed += 1
+                result.failed_keys.append(obj.get("symbol"))
+
+        result = result.merge(self.batch_save(StockAnalysis, items))
+        logger.info(f'Saved stock analytics, written: {result.written}, failed: {result.failed}')
+        return result
 
     def save_portfolio(self, objects, date):
+        items = []
+        result = WriteResult()
         for obj in objects:
             try:
-                item = Portfolio(stock=obj["symbol"],
-                                 date=date,
-                                 name=obj["name"],
-                                 number_of_shares_to_buy=obj["number_of_shares_to_buy"])
-                item.save()
+                items.append(Portfolio(stock=obj["symbol"],
+                                       date=date,
+                                       name=obj["name"],
+                                       number_of_shares_to_buy=obj["number_of_shares_to_buy"]))
             except Exception as e:
                 logger.info(f'Error while saving, obj : {obj}, error: {e}')
+                result.failed += 1
+                result.failed_keys.append(obj.get("symbol") if isinstance(obj, dict) else None)
+
+        result = result.merge(self.batch_save(Portfolio, items))
+
+        # Publish the new version only once its rows are written, older versions stay readable by date
+        if result.written:
+            self._save_item(Portfolio(stock=PORTFOLIO_VERSION_KEY, date=date, name='portfolio version',
+                                      number_of_shares_to_buy=result.written))
+
+        logger.info(f'Saved portfolio {date}, written: {result.written}, failed: {result.failed}')
+        return result
+
+    def batch_save(self, model_class, items):
+        """
+        Write items in chunks of 25 with ``Model.batch_write``, which resubmits unprocessed items with backoff.
+
+        If a chunk still fails, its items are saved one by one so the result reports exactly which keys failed.
+        """
+        result = WriteResult()
+        for start in range(0, len(items), BATCH_SIZE):
+            chunk = items[start:start + BATCH_SIZE]
+            try:
+                with instrumentation.span('dynamodb.batch_write', table=model_class.Meta.table_name):
+                    with model_class.batch_write() as batch:
+                        for item in chunk:
+                            batch.save(item)
+                result.written += len(chunk)
+            except PutError as e:
+                logger.info(f'Batch write to {model_class.Meta.table_name} failed, saving items one by one: {e}')
+                for item in chunk:
+                    try:
+                        self._save_item(item)
+                        result.written += 1
+                    except Exception as e:
+                        logger.info(f'Error while saving, item : {item.stock}, error: {e}')
+                        result.failed += 1
+                        result.failed_keys.append(item.stock)
+
+        instrumentation.count('dynamodb.written', result.written)
+        instrumentation.count('dynamodb.failed', result.failed)
+        return result
+
+    def _save_item(self, item, condition=None):
+        item.save(condition=condition)
+
+    def _get_item(self, model_class, hash_key, range_key):
+        try:
+            return json.loads(model_class.get(hash_key, range_key).to_json())
+        except model_class.DoesNotExist:
+            return None
+
+    def save_shard_plan(self, date, shard_count, plan, digest):
+        """
+        Store the shard plan of ``date`` unless another worker stored one first and return the stored plan and
+        its digest. Every worker proposes the plan of its own universe, all of them use the first one.
+        """
+        key = f'{SHARD_PLAN_PREFIX}of-{shard_count}'
+        try:
+            self._save_item(AnalysisRun(run=key, date=date, industries=json.dumps(plan), plan_digest=digest),
+                            condition=AnalysisRun.run.does_not_exist())
+            logger.info(f'Stored shard plan {digest} of {date} for {shard_count} shards')
+        except PutError as e:
+            if e.cause_response_code != 'ConditionalCheckFailedException':
+                raise
+        stored = self._get_item(AnalysisRun, key, date)
+        return json.loads(stored['industries']), stored['plan_digest']
+
+    def save_shard_marker(self, date, shard_index, shard_count, industries, stocks, plan_digest=None):
+        self._save_item(AnalysisRun(run=f'{SHARD_MARKER_PREFIX}{shard_index}-of-{shard_count}', date=date,
+                                    industries=json.dumps(sorted(industries)), plan_digest=plan_digest,
+                                    stocks=stocks))
+        logger.info(f'Shard {shard_index} of {shard_count} complete for {date}: {len(industries)} industries, '
+                    f'{stocks} stocks, plan {plan_digest}')
+
+    def get_shard_markers(self, date):
+        with instrumentation.span('dynamodb.query', table=AnalysisRun.Meta.table_name):
+            return [json.loads(item.to_json()) for item in
+                    AnalysisRun.date_index.query(date, AnalysisRun.run.startswith(SHARD_MARKER_PREFIX))]
+
+    def is_analysis_complete(self, date):
+        """
+        True once every shard of one shard count has written its marker for ``date`` and all of them analysed
+        the same shard plan.
+        """
+        shards = {}
+        plans = {}
+        for marker in self.get_shard_markers(date):
+            index, count = marker['run'][len(SHARD_MARKER_PREFIX):].split('-of-')
+            shards.setdefault(int(count), set()).add(int(index))
+            plans.setdefault(int(count), set()).add(marker.get('plan_digest'))
+
+        for count, indices in shards.items():
+            if len(plans[count]) > 1:
+                logger.warning(f'Shard markers of {date} for {count} shards disagree on the plan: {plans[count]}')
+            elif indices >= set(range(count)):
+                return True
+        return False
 
     def get_analyst_data(self, stocks, date):
-        item_keys = [(stock['symbol'], date) for stock in stocks]
-        return [json.loads(item.to_json()) for item in StockAnalysis.batch_get(item_keys)]
+        symbols = {stock['symbol'] for stock in stocks}
+        return [item for item in self.get_analyst_data_by_date(date) if item['stock'] in symbols]
+
+    def get_analyst_data_by_date(self, date):
+        with instrumentation.span('dynamodb.query', table=StockAnalysis.Meta.table_name):
+            return [json.loads(item.to_json()) for item in StockAnalysis.date_index.query(date)]
+
+    def get_previous_analysis(self, symbol, date):
+        """Latest analysis of ``symbol`` saved before ``date``, None if there is none."""
+        with instrumentation.span('dynamodb.query', table=StockAnalysis.Meta.table_name):
+            rows = StockAnalysis.query(symbol, StockAnalysis.date < date, scan_index_forward=False, limit=1)
+            return next((json.loads(row.to_json()) for row in rows), None)
+
+    def get_latest_portfolio_date(self):
+        versions = Portfolio.query(PORTFOLIO_VERSION_KEY, scan_index_forward=False, limit=1)
+        return next((version.date for version in versions), None)
 
-    def get_portfolio_data(self):
-        return [json.loads(item.to_json()) for item in self.scan(Portfolio)]
+    def get_portfolio_data(self, date=None):
+        date = date or self.get_latest_portfolio_date()
+        if date is None:
+            return []
+        return [json.loads(item.to_json()) for item in Portfolio.date_index.query(date)
+                if item.stock != PORTFOLIO_VERSION_KEY]
 
     def scan(self, model_class):
         rows = model_class.scan()
         return rows
 
-    def delete_portfolio(self):
-        portfolio = self.scan(Portfolio)
+    def delete_portfolio(self, date):
         with Portfolio.batch_write() as batch:
-            for r in portfolio:
+            for r in Portfolio.date_index.query(date):
                 batch.delete(r)
@@ -5,7 +5,15 @@ from pytickersymbols import PyTickerSymbols
 from aws_lambda_powertools import Logger
 import pandas as pd
 import math
+import os
+import threading
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from helper.market_cache import MarketDataCache, MARKET_CACHE_DIR
+from helper.fundamentals import FundamentalsStore, FUNDAMENTAL_PARAMETERS
+from helper.technical_indicators import TechnicalIndicatorEngine
+from helper.instrumentation import instrumentation
 
 logger = Logger()
 SP_500_WIKI_URL = 'https://en.m.wikipedia.org/wiki/List_of_S%26P_500_companies'
@@ -18,20 +26,138 @@ INDEX_SYMBOLS = [
     {"symbol": "^N225", "index": True, 'name': 'Nikkei 225'},
     {"symbol": "^NSEI", "index": True, 'name': 'NIFTY 50'}
 ]
+AGGREGATE_STATISTICS = ['mean', 'median', 'count']
+# Market data cache key of the technical indicator engine state of the whole universe
+INDICATORS_CACHE_KEY = 'universe'
+WARM_UP_MAX_WORKERS = int(os.getenv("WARM_UP_MAX_WORKERS", "16"))
+WARM_UP_SYMBOL_TIMEOUT = float(os.getenv("WARM_UP_SYMBOL_TIMEOUT", "60"))
+# Relative difference of the re-downloaded last cached close which means the history was adjusted since
+HISTORY_ADJUSTMENT_TOLERANCE = 1e-4
+
+
+class CachedTicker:
+    """yf.Ticker wrapper which serves ``info`` from the persistent market data cache."""
+
+    def __init__(self, symbol, market_cache=None):
+        self.symbol = symbol
+        self.ticker = yf.Ticker(symbol)
+        self.market_cache = market_cache
+        self._info = None
+
+    @property
+    def info(self):
+        if self._info is not None:
+            return self._info
+
+        info, age = self.market_cache.get('info', self.symbol) if self.market_cache else (None, None)
+        if info is None or not self.market_cache.is_fresh('info', age):
+            try:
+                with instrumentation.span('yahoo.info', symbol=self.symbol):
+                    fresh_info = self.ticker.info
+                if self.market_cache:
+                    self.market_cache.put('info', self.symbol, fresh_info)
+                info = fresh_info
+            except Exception:
+                # Fall back to a stale snapshot instead of losing the symbol
+                if info is None:
+                    raise
+
+        self._info = info
+        return self._info
+
+    def __getattr__(self, name):
+        return getattr(self.ticker, name)
 
 
 class FinanceService:
-    """Class for fetching trading data from Yahoo Finance."""
+    """
+    Class for fetching trading data from Yahoo Finance.
 
-    def __init__(self):
+    Nothing is loaded on construction. History and info of all symbols are fetched on first use of the symbols,
+    their industry/sector classification or the market data (``load_market_data``).
+    """
+
+    def __init__(self, max_workers=WARM_UP_MAX_WORKERS, symbol_timeout=WARM_UP_SYMBOL_TIMEOUT,
+                 market_cache_dir=MARKET_CACHE_DIR):
         self.cache = {}
         self.cache_earnings_dates = {}
+        self.failed_symbols = {}
+        self._failed_lock = threading.Lock()
+        self.market_cache = MarketDataCache(market_cache_dir) if market_cache_dir else None
+        self.fundamentals = FundamentalsStore()
+        self.max_workers = max_workers
+        self.symbol_timeout = symbol_timeout
 
         self.today = datetime.today()
-        self.symbols = self._get_symbols()
-        self.industries, self.sectors = self._get_industries_and_sectors()
-
-        logger.info(f'FinanceService initialized, {len(self.cache)} stocks found on Yahoo.')
+        self._symbols = None
+        self._industries = None
+        self._sectors = None
+        self._market_data = None
+        self._load_lock = threading.RLock()
+
+    @property
+    def symbols(self):
+        if self._symbols is None:
+            self._symbols = self._get_symbols()
+        return self._symbols
+
+    @property
+    def industries(self):
+        if self._industries is None:
+            self.load_market_data()
+        return self._industries
+
+    @property
+    def sectors(self):
+        if self._sectors is None:
+            self.load_market_data()
+        return self._sectors
+
+    @property
+    def industry_aggregates(self):
+        return self.load_market_data()['industry_aggregates']
+
+    @property
+    def sector_aggregates(self):
+        return self.load_market_data()['sector_aggregates']
+
+    @property
+    def technical_indicators(self):
+        return self.load_market_data()['technical_indicators']
+
+    def load_market_data(self):
+        """
+        Fetch history and info of all symbols and build fundamentals, classification, aggregates and technical
+        indicators.
+        """
+        if self._market_data is not None:
+            return self._market_data
+
+        with self._load_lock:
+            if self._market_data is not None:
+                return self._market_data
+
+            with instrumentation.span('finance.symbols'):
+                if self._symbols is None:
+                    self._symbols = self._get_symbols()
+            with instrumentation.span('finance.warm_up'):
+                self.warm_up(max_workers=self.max_workers, symbol_timeout=self.symbol_timeout)
+            with instrumentation.span('finance.aggregates'):
+                self.fundamentals.build()
+                self._industries, self._sectors = self._get_industries_and_sectors()
+                market_data = {'industry_aggregates': self._aggregate_fundamentals('industry'),
+                               'sector_aggregates': self._aggregate_fundamentals('sector')}
+            with instrumentation.span('finance.technical_indicators'):
+                market_data['technical_indicators'] = self._build_technical_indicators()
+            self._market_data = market_data
+
+            if self.market_cache:
+                self.market_cache.evict()
+                logger.info(f'Market data cache stats: {self.market_cache.get_stats()}')
+
+            logger.info(f'Market data loaded, {len(self.cache)} stocks found on Yahoo, '
+                        f'fundamentals use {round(self.fundamentals.memory_usage() / 1024 ** 2, 2)} MiB.')
+            return self._market_data
 
     def get_symbols(self):
         return self.symbols
@@ -43,27 +169,152 @@ class FinanceService:
         return self.industries, self.sectors
 
     def get_history(self, symbol, days_to_subtract=365):
+        """
+        Return the price history and a ticker of a symbol.
+
+        Only the history is kept in memory, tickers are cheap to create and would otherwise retain the full
+        ``info`` payload. Use the fundamentals store for info fields.
+        """
         if symbol in self.cache:
-            return self.cache[symbol]
+            return self.cache[symbol], CachedTicker(symbol, self.market_cache)
 
         start_date = (self.today - timedelta(days=days_to_subtract)).strftime('%Y-%m-%d')
         end_date = self.today.strftime('%Y-%m-%d')
 
-        ticker = yf.Ticker(symbol)
-        data = ticker.history(start=start_date, end=end_date, period="1d")
-
-        self.cache[symbol] = data, ticker
-        return self.cache[symbol]
+        ticker = CachedTicker(symbol, self.market_cache)
+        data, age = self.market_cache.get('history', symbol) if self.market_cache else (None, None)
+
+        if data is None or data.empty:
+            with instrumentation.span('yahoo.history', symbol=symbol):
+                data = ticker.history(start=start_date, end=end_date, period="1d")
+            self._store_history(symbol, data)
+        elif not self.market_cache.is_fresh('history', age):
+            # Only download the bars since the last cached date. The last cached bar is downloaded again, after a
+            # split or dividend Yahoo re-adjusts all past closes and the cached ones must not be mixed with new bars.
+            last_date = data.index.max()
+            if (last_date + timedelta(days=1)).strftime('%Y-%m-%d') < end_date:
+                with instrumentation.span('yahoo.history_delta', symbol=symbol):
+                    missing = ticker.history(start=last_date.strftime('%Y-%m-%d'), end=end_date, period="1d")
+                if self._history_adjusted(data, missing):
+                    logger.info(f'Cached history of {symbol} was adjusted since {last_date}, downloading it again')
+                    self.market_cache.stats['history_adjusted'] += 1
+                    with instrumentation.span('yahoo.history', symbol=symbol):
+                        data = ticker.history(start=start_date, end=end_date, period="1d")
+                else:
+                    self.market_cache.stats['history_delta_bars'] += len(missing[missing.index > last_date])
+                    data = pd.concat([data, missing])
+                    data = data[~data.index.duplicated(keep='last')]
+            # Bars older than the window are dropped from the cache too, it does not grow with every run
+            data = self._trim_history(data, start_date)
+            self._store_history(symbol, data)
+
+        self.cache[symbol] = self._trim_history(data, start_date)
+        return self.cache[symbol], ticker
+
+    @staticmethod
+    def _history_adjusted(cached, delta):
+        """True if the delta download changed the close of the last cached bar or lacks that bar."""
+        if delta.empty:
+            return False
+        last_date = cached.index.max()
+        if last_date not in delta.index:
+            return True
+        return not math.isclose(delta.at[last_date, 'Close'], cached.at[last_date, 'Close'],
+                                rel_tol=HISTORY_ADJUSTMENT_TOLERANCE)
+
+    def _store_history(self, symbol, data):
+        if self.market_cache and not data.empty:
+            self.market_cache.put('history', symbol, data)
+
+    @staticmethod
+    def _trim_history(data, start_date):
+        if data.empty:
+            return data
+        cutoff = pd.Timestamp(start_date)
+        if data.index.tz is not None:
+            cutoff = cutoff.tz_localize(data.index.tz)
+        return data[data.index >= cutoff]
+
+    def _fetch_symbol(self, symbol, started, failed):
+        started[symbol] = time.monotonic()
+        with instrumentation.span('finance.fetch_symbol', symbol=symbol):
+            data, ticker = self.get_history(symbol)
+            # Accessing info triggers the lazy quote download inside the worker thread, only the fields used
+            # later are kept and the ticker with its full info payload is released
+            info = ticker.info
+            with self._failed_lock:
+                # A symbol which already timed out stays out of the fundamentals and aggregates
+                if symbol in failed:
+                    logger.info(f'Dropping late result of {symbol}, {failed[symbol]}')
+                    return symbol
+                self.fundamentals.add(symbol, info)
+        return symbol
+
+    def warm_up(self, max_workers=WARM_UP_MAX_WORKERS, symbol_timeout=WARM_UP_SYMBOL_TIMEOUT):
+        """
+        Fetch history and info for all non-index symbols concurrently.
+
+        Symbols which raise or exceed ``symbol_timeout`` seconds are recorded in
+        ``self.failed_symbols`` (symbol -> reason) and skipped when grouping by industry/sector.
+        """
+        symbols = [symbol["symbol"] for symbol in self.symbols if not symbol["index"]]
+        started = {}
+        start = time.monotonic()
+        # Each warm-up reports its own failures, late threads of an earlier one only see their own dict
+        failed = self.failed_symbols = {}
+
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='warm-up')
+        pending = {executor.submit(self._fetch_symbol, symbol, started, failed): symbol for symbol in symbols}
+        try:
+            while pending:
+                done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    symbol = pending.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failed[symbol] = str(e)
+
+                now = time.monotonic()
+                for future, symbol in list(pending.items()):
+                    if symbol in started and now - started[symbol] > symbol_timeout:
+                        pending.pop(future)
+                        with self._failed_lock:
+                            failed[symbol] = f'timeout after {symbol_timeout}s'
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        instrumentation.count('finance.failed_symbols', len(self.failed_symbols))
+        logger.info(f'Warm-up fetched {len(symbols) - len(self.failed_symbols)}/{len(symbols)} symbols '
+                    f'in {round(time.monotonic() - start, 2)}s with {max_workers} workers')
+        if self.failed_symbols:
+            logger.info(f'Warm-up failed symbols: {self.failed_symbols}')
+
+        return self.failed_symbols
 
     def get_earning(self, symbol):
         if symbol not in self.cache_earnings_dates:
-            data, ticker = self.get_history(symbol)
-            try:
-                self.cache_earnings_dates[symbol] = ticker.earnings_dates
-            except KeyError:
-                self.cache_earnings_dates[symbol] = None
+            earnings_dates, age = self.market_cache.get('earnings', symbol) if self.market_cache else (None, None)
+            if earnings_dates is None or not self.market_cache.is_fresh('earnings', age):
+                data, ticker = self.get_history(symbol)
+                try:
+                    earnings_dates = ticker.earnings_dates
+                except KeyError:
+                    earnings_dates = None
+                if self.market_cache and earnings_dates is not None:
+                    self.market_cache.put('earnings', symbol, earnings_dates)
+            self.cache_earnings_dates[symbol] = earnings_dates
         return self.cache_earnings_dates[symbol]
 
+    def get_snapshot(self, symbol):
+        self.load_market_data()
+        return self.fundamentals.snapshot(symbol)
+
+    def get_fundamental(self, symbol, parameter):
+        self.load_market_data()
+        value = self.fundamentals.get(symbol, parameter)
+        return round(value, 2) if value is not None else None
+
     def get_info(self, ticker, parameter):
         try:
             return round(ticker.info[parameter], 2)
@@ -96,7 +347,8 @@ class FinanceService:
             unique_symbols[stock['name']].append(stock['symbol'])
 
         # Get single symbol for each name
-        single_symbols = {k: list(set(v))[0] for k, v in unique_symbols.items()}
+        # Sorted, so the same symbol is picked on every run
+        single_symbols = {k: sorted(set(v))[0] for k, v in unique_symbols.items()}
 
         # Return formatted result
         result = [{"symbol": v, "index": False, "name": k} for k, v in single_symbols.items()]
@@ -121,61 +373,77 @@ class FinanceService:
         sector = {}
 
         for symbol in self.symbols:
-            if symbol["index"]:
+            if symbol["index"] or symbol["symbol"] in self.failed_symbols or symbol["symbol"] not in self.fundamentals:
                 continue
 
-            data, ticker = self.get_history(symbol["symbol"])
-            try:
-                industry_key = ticker.info["industry"]
-                sector_key = ticker.info["sector"]
-
-                # Industry
-                if industry_key and symbol["symbol"] and industry_key in industries:
-                    industries[industry_key].append(symbol)
-                else:
-                    industries[industry_key] = [symbol]
-
-                # Sector
-                if sector_key and symbol["symbol"] and sector_key in sector:
-                    sector[sector_key].append(symbol)
-                else:
-                    sector[sector_key] = [symbol]
-
-            except Exception:
+            industry_key = self.fundamentals.get(symbol["symbol"], "industry")
+            sector_key = self.fundamentals.get(symbol["symbol"], "sector")
+            if not industry_key or not sector_key:
                 continue
 
+            industries.setdefault(industry_key, []).append(symbol)
+            sector.setdefault(sector_key, []).append(symbol)
+
         return industries, sector
 
-    def get_industry_or_sector_data(self, symbol, name, parameter="trailingPE"):
-        data, ticker = self.get_history(symbol)
+    def _aggregate_fundamentals(self, name):
+        invalid_columns = [f'invalid_{parameter}' for parameter in FUNDAMENTAL_PARAMETERS]
+        grouped = self.fundamentals.frame.groupby(name, observed=True)
+        aggregates = grouped[FUNDAMENTAL_PARAMETERS].agg(AGGREGATE_STATISTICS)
+
+        # Mirror the previous behaviour: any non-numeric value in a group makes its aggregate unusable
+        invalid = grouped[invalid_columns].any()
+        for parameter in FUNDAMENTAL_PARAMETERS:
+            mask = invalid[f'invalid_{parameter}'] | (aggregates[(parameter, 'count')] == 0)
+            for statistic in ['mean', 'median']:
+                aggregates.loc[mask, (parameter, statistic)] = math.nan
+        return aggregates
+
+    def _build_technical_indicators(self):
+        """
+        Compute the indicators for all symbols on one panel. If the engine state of an earlier run with the same
+        universe is cached, only the bars appended since then are processed.
+        """
+        histories = {symbol: self.cache[symbol] for symbol in self.fundamentals.symbols() if symbol in self.cache}
+        closes = TechnicalIndicatorEngine.build_panel(histories, 'Close')
+        volumes = TechnicalIndicatorEngine.build_panel(histories, 'Volume')
+
+        engine, age = self.market_cache.get('indicators', INDICATORS_CACHE_KEY) if self.market_cache else (None, None)
+        if engine is not None and self.market_cache.is_fresh('indicators', age) \
+                and set(engine.closes.columns) == set(closes.columns):
+            engine.update(closes, volumes)
+        else:
+            engine = TechnicalIndicatorEngine()
+            engine.compute(closes, volumes)
 
-        if name not in ticker.info:
-            return None
+        if self.market_cache and not closes.empty:
+            self.market_cache.put('indicators', INDICATORS_CACHE_KEY, engine)
+        return engine
+
+    def get_technical_indicators(self, symbol):
+        return self.technical_indicators.get(symbol)
 
+    def get_industry_or_sector_data(self, symbol, name, parameter="trailingPE", statistic='mean'):
         if name == 'industry':
-            industry_or_sector = self.industries
+            aggregates = self.industry_aggregates
         elif name == 'sector':
-            industry_or_sector = self.sectors
+            aggregates = self.sector_aggregates
         else:
             logger.info(f'{name} not found in data')
             return None
 
-        industry_or_sector_symbols = industry_or_sector[ticker.info[name]]
-        parameter_data_points = []
+        if (parameter, statistic) not in aggregates.columns:
+            return None
 
-        for sec_symbol in industry_or_sector_symbols:
-            data, ticker = self.get_history(sec_symbol['symbol'])
-            try:
-                parameter_data_points.append(ticker.info[parameter])
-            except KeyError:
-                continue
+        group = self.fundamentals.get(symbol, name)
+        if group is None or group not in aggregates.index:
+            return None
 
-        try:
-            industry_avg = round(sum(parameter_data_points) / len(parameter_data_points), 2)
-            return industry_avg if parameter_data_points else None
-        except (ZeroDivisionError, TypeError):
+        value = aggregates.at[group, (parameter, statistic)]
+        if pd.isna(value):
             return None
+        return int(value) if statistic == 'count' else round(float(value), 2)
 
     def get_industry_for_symbol(self, symbol):
-        data, ticker = self.get_history(symbol)
-        return self.industries[ticker.info["industry"]]
+        self.load_market_data()
+        return self.industries[self.fundamentals.get(symbol, "industry")]
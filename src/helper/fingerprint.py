@@ -0,0 +1,94 @@
+import hashlib
+import math
+import os
+import re
+from datetime import datetime
+
+from helper.fundamentals import FUNDAMENTAL_PARAMETERS
+
+# Industries whose inputs did not change are carried forward from their last analysis instead of ranked again
+CHANGE_DETECTION = os.getenv("CHANGE_DETECTION", "true").lower() == "true"
+# Fields of the prepared stock data in the fingerprint, values are compared in relative tolerance bands
+FINGERPRINT_FIELDS = os.getenv("FINGERPRINT_FIELDS", ",".join(
+    FUNDAMENTAL_PARAMETERS + ["previousClose", "marketCap", "targetMeanPrice", "recommendationKey"])).split(",")
+FINGERPRINT_TOLERANCE = float(os.getenv("FINGERPRINT_TOLERANCE", "0.05"))
+# Maximum number of differing bits of the news simhashes for the news to count as unchanged
+FINGERPRINT_NEWS_DISTANCE = int(os.getenv("FINGERPRINT_NEWS_DISTANCE", "12"))
+# An analysis older than this is ranked again even if nothing changed
+FINGERPRINT_MAX_AGE_DAYS = int(os.getenv("FINGERPRINT_MAX_AGE_DAYS", "7"))
+
+SIMHASH_BITS = 64
+WORD_PATTERN = re.compile(r'[a-z0-9]{4,}')
+
+
+def quantize(value, tolerance=FINGERPRINT_TOLERANCE):
+    """
+    Band of a value on a log scale with bands ``tolerance`` wide, so drift within the band keeps the band.
+
+    A value close to a band boundary may still move to the next band, which only causes a new ranking.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return '' if value is None else str(value)
+    if math.isnan(value):
+        return ''
+    if value == 0:
+        return '0'
+    band = math.floor(math.log(abs(value)) / math.log1p(tolerance))
+    return f'{"-" if value < 0 else ""}{band}'
+
+
+def news_simhash(text):
+    """
+    64 bit simhash of the distinct words of ``text``, reworded news about the same events differs in few bits.
+
+    Every word counts once, a repeated word cannot outweigh new topics.
+    """
+    if not text:
+        return 0
+    weights = [0] * SIMHASH_BITS
+    for word in set(WORD_PATTERN.findall(str(text).lower())):
+        word_hash = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), 'big')
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if word_hash >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def stock_fingerprint(stock_data, fields=FINGERPRINT_FIELDS, tolerance=FINGERPRINT_TOLERANCE):
+    """``<fundamentals digest>:<news simhash>`` of the prepared data of one stock."""
+    bands = '|'.join(f'{field}={quantize(stock_data.get(field), tolerance)}' for field in fields)
+    digest = hashlib.sha256(bands.encode()).hexdigest()[:16]
+    return f'{digest}:{news_simhash(stock_data.get("StockNews")):016x}'
+
+
+def fingerprints_match(current, previous, news_distance=FINGERPRINT_NEWS_DISTANCE):
+    if not current or not previous:
+        return False
+    digest, news = current.split(':')
+    previous_digest, previous_news = previous.split(':')
+    return digest == previous_digest and bin(int(news, 16) ^ int(previous_news, 16)).count('1') <= news_distance
+
+
+def industry_unchanged(stocks, previous_rows, industry, date, news_distance=FINGERPRINT_NEWS_DISTANCE,
+                       max_age_days=FINGERPRINT_MAX_AGE_DAYS):
+    """
+    Reason why the industry has to be ranked again, or None if its last analysis can be carried forward.
+
+    ``stocks`` is the prepared data with fingerprints, ``previous_rows`` maps each symbol to its last saved
+    analysis. The last analysis must have ranked exactly these stocks together in the same industry.
+    """
+    if any(previous_rows.get(stock['symbol']) is None for stock in stocks):
+        return 'no previous analysis'
+    rows = [previous_rows[stock['symbol']] for stock in stocks]
+    dates = {row['date'] for row in rows}
+    if len(dates) > 1 or any(row.get('industry') != industry for row in rows):
+        return 'stocks were not ranked together'
+    # Carried forward analyses age from their original ranking
+    analysed_on = min(row.get('analysed_on') or row['date'] for row in rows)
+    if (datetime.strptime(date, '%Y-%m-%d') - datetime.strptime(analysed_on, '%Y-%m-%d')).days > max_age_days:
+        return f'analysis of {analysed_on} is older than {max_age_days} days'
+    changed = [stock['symbol'] for stock in stocks
+               if not fingerprints_match(stock.get('fingerprint'), previous_rows[stock['symbol']].get('fingerprint'),
+                                         news_distance)]
+    if changed:
+        return f'inputs changed for {changed}'
+    return None
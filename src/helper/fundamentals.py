@@ -0,0 +1,96 @@
+import math
+import threading
+from types import MappingProxyType
+
+import pandas as pd
+
+FUNDAMENTAL_PARAMETERS = ["trailingPE", "forwardPE", "averageVolume", "trailingAnnualDividendRate", "profitMargins",
+                          "shortRatio", "shortPercentOfFloat", "bookValue", "trailingEps", "forwardEps", "ebitda",
+                          "totalDebt", "totalRevenue", "debtToEquity", "freeCashflow", "earningsGrowth",
+                          "revenueGrowth", "operatingMargins", "pegRatio", "grossMargins", "ebitdaMargins"]
+
+# Fields of ticker.info used by the analyst and the prompts, everything else is dropped after download
+NUMERIC_FIELDS = FUNDAMENTAL_PARAMETERS + [
+    "previousClose", "currentPrice", "open", "dayLow", "dayHigh", "marketCap", "beta", "volume",
+    "fiftyTwoWeekLow", "fiftyTwoWeekHigh", "fiftyDayAverage", "twoHundredDayAverage", "dividendYield",
+    "payoutRatio", "priceToBook", "priceToSalesTrailing12Months", "enterpriseValue", "enterpriseToRevenue",
+    "enterpriseToEbitda", "returnOnAssets", "returnOnEquity", "currentRatio", "quickRatio", "totalCash",
+    "heldPercentInsiders", "heldPercentInstitutions", "targetMeanPrice", "recommendationMean",
+    "numberOfAnalystOpinions"]
+CATEGORY_FIELDS = ["industry", "sector", "currency", "exchange", "recommendationKey"]
+TEXT_FIELDS = ["shortName", "longName"]
+SNAPSHOT_DECIMALS = 4
+
+
+def is_numeric(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and not math.isnan(value)
+
+
+class FundamentalsStore:
+    """
+    Compact columnar store of the ticker fundamentals.
+
+    Rows are collected from ``ticker.info`` with ``add`` (thread safe, only whitelisted fields are kept) and
+    ``build`` turns them into one frame with float32 and category columns. Parameters present in ``ticker.info``
+    with a non-numeric value are flagged in ``invalid_<parameter>`` columns.
+    """
+
+    def __init__(self):
+        self.frame = None
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def add(self, symbol, info):
+        row = {field: info.get(field) for field in CATEGORY_FIELDS + TEXT_FIELDS}
+        for field in NUMERIC_FIELDS:
+            value = info.get(field)
+            row[field] = value if is_numeric(value) else math.nan
+        for parameter in FUNDAMENTAL_PARAMETERS:
+            row[f'invalid_{parameter}'] = parameter in info and not is_numeric(info.get(parameter))
+
+        with self._lock:
+            self._rows[symbol] = row
+
+    def build(self):
+        columns = CATEGORY_FIELDS + TEXT_FIELDS + NUMERIC_FIELDS + [f'invalid_{parameter}'
+                                                                    for parameter in FUNDAMENTAL_PARAMETERS]
+        with self._lock:
+            rows, self._rows = self._rows, {}
+
+        frame = pd.DataFrame.from_dict(rows, orient='index', columns=columns)
+        frame[NUMERIC_FIELDS] = frame[NUMERIC_FIELDS].astype('float32')
+        frame[CATEGORY_FIELDS] = frame[CATEGORY_FIELDS].astype('category')
+        self.frame = frame
+        return frame
+
+    def __contains__(self, symbol):
+        return self.frame is not None and symbol in self.frame.index
+
+    def symbols(self):
+        return list(self.frame.index) if self.frame is not None else []
+
+    def get(self, symbol, field):
+        if symbol not in self or field not in self.frame.columns:
+            return None
+        return self._to_python(self.frame.at[symbol, field])
+
+    def snapshot(self, symbol):
+        """Read-only mapping of the whitelisted fields of one symbol, missing values are None."""
+        row = self.frame.loc[symbol]
+        snapshot = {'symbol': symbol}
+        for field in CATEGORY_FIELDS + TEXT_FIELDS + NUMERIC_FIELDS:
+            snapshot[field] = self._to_python(row[field])
+        return MappingProxyType(snapshot)
+
+    def memory_usage(self):
+        return int(self.frame.memory_usage(deep=True).sum()) if self.frame is not None else 0
+
+    @staticmethod
+    def _to_python(value):
+        if value is None or pd.isna(value):
+            return None
+        if hasattr(value, 'item'):
+            value = value.item()
+        if isinstance(value, float):
+            return round(value, SNAPSHOT_DECIMALS)
+        return value
@@ -1,105 +1,441 @@
+import codecs
 import json
-import re
-import ast
 import uuid
 import boto3
+import yaml
 from botocore.config import Config
 import functools
+import itertools
+import os
+import random
+import threading
 import time
+from collections import defaultdict
+from botocore.exceptions import ClientError, EventStreamError, ConnectionError, ReadTimeoutError
 
 from aws_lambda_powertools import Logger
+from helper.response_cache import response_cache, cache_key
+from helper.json_stream import JsonArrayStreamParser, parse_json_array
+from helper.instrumentation import instrumentation
+from helper.prompt_serializer import estimate_tokens
 
 logger = Logger()
 
 MODEL_ID = 'anthropic.claude-3-sonnet-20240229-v1:0'
-PATTERN = r'\[.*?\]'
 ANTHROPIC_VERSION = 'bedrock-2023-05-31'
+# ToDo: Update manually with AgentID and AgentAliasId until AWS CDK support AWS Bedrock Agents
+AGENT_ID = 'VBVCRTAYMV'
+AGENT_ALIAS_ID = 'ECZGMVPR1S'
+# Agent completions are cut off after this many characters, 0 disables the cap
+AGENT_MAX_CHARS = int(os.getenv("AGENT_MAX_CHARS", "0"))
 
-config = Config(read_timeout=60 * 15)
-brt = boto3.client(service_name='bedrock-runtime',
-                   config=config)
-brt_agent = boto3.client(service_name='bedrock-agent-runtime',
-                         config=config)
+# Retries are handled by the rate limiter below, botocore only makes a single attempt
+config = Config(read_timeout=60 * 15, retries={'max_attempts': 1, 'mode': 'standard'})
+# Clients are created on first use, so importing the module does not pay for the boto3 client setup
+clients = {}
+clients_lock = threading.Lock()
+
+PROMPTS_PATH = 'schema/prompts.yaml'
+
+
+def get_client(service_name):
+    with clients_lock:
+        if service_name not in clients:
+            clients[service_name] = boto3.client(service_name=service_name, config=config)
+        return clients[service_name]
+
+
+@functools.lru_cache(maxsize=None)
+def load_prompts(path=PROMPTS_PATH):
+    """Prompts parsed once per process and shared by all roles, callers must not modify them."""
+    with open(path, 'r') as file:
+        return yaml.safe_load(file)
+
+
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException',
+                          'ModelNotReadyException')
+# Transient errors which arrive as events of a response stream, e.g. 'modelStreamErrorException'
+STREAM_ERROR_CODES = ('ModelStreamErrorException', 'InternalServerException', 'ServiceUnavailableException',
+                      'ModelTimeoutException')
+RETRY_ATTEMPTS = int(os.getenv("BEDROCK_RETRY_ATTEMPTS", "6"))
+RETRY_BASE_DELAY = float(os.getenv("BEDROCK_RETRY_BASE_DELAY", "2"))
+RETRY_MAX_DELAY = float(os.getenv("BEDROCK_RETRY_MAX_DELAY", "120"))
+
+# Requests per second and burst size per Bedrock operation
+RATE_LIMITS = {
+    'invoke_model': (float(os.getenv("BEDROCK_RATE_INVOKE_MODEL", "0.5")),
+                     int(os.getenv("BEDROCK_BURST_INVOKE_MODEL", "2"))),
+    'invoke_agent': (float(os.getenv("BEDROCK_RATE_INVOKE_AGENT", "1")),
+                     int(os.getenv("BEDROCK_BURST_INVOKE_AGENT", "4"))),
+}
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket with an adaptive refill rate.
+
+    The rate is halved on every throttle and recovers additively on success, never exceeding the configured rate.
+    """
+
+    def __init__(self, rate, capacity, min_rate=0.02):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        """Block until a token is available and return the seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+            waited += wait_time
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class RateLimiter:
+    """Client side rate limiter with one token bucket per Bedrock operation and jittered exponential backoff."""
+
+    def __init__(self, rate_limits=None, retries=RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                 max_delay=RETRY_MAX_DELAY):
+        self.buckets = {operation: TokenBucket(rate, capacity)
+                        for operation, (rate, capacity) in (rate_limits or RATE_LIMITS).items()}
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def _emit(self, operation, name, value=1):
+        with self._lock:
+            self.metrics[f'{operation}.{name}'] += value
+        instrumentation.count(f'bedrock.{operation}.{name}', value)
+
+    def call(self, operation, func, *args, **kwargs):
+        bucket = self.buckets[operation]
+        for attempt in range(self.retries):
+            waited = bucket.acquire()
+            self._emit(operation, 'requests')
+            if waited:
+                self._emit(operation, 'rate_limited_seconds', waited)
+
+            try:
+                result = func(*args, **kwargs)
+                bucket.on_success()
+                return result
+            except Exception as e:
+                throttled = is_throttling_error(e)
+                if not throttled and not is_connection_error(e) and not is_stream_error(e):
+                    self._emit(operation, 'errors')
+                    raise
+
+                self._emit(operation, 'throttles' if throttled else 'connection_errors')
+                if throttled:
+                    bucket.on_throttle()
+
+                if attempt == self.retries - 1:
+                    self._emit(operation, 'exhausted')
+                    logger.info(f'{operation} failed after {self.retries} attempts: {e}')
+                    raise
+
+                delay = self._backoff(attempt, e)
+                self._emit(operation, 'retries')
+                self._emit(operation, 'backoff_seconds', delay)
+                logger.info(f'{operation} attempt {attempt + 1} failed: {e}. '
+                            f'Retry in {round(delay, 2)}s, rate {round(bucket.rate, 3)}/s')
+                time.sleep(delay)
+
+    def retry_stream(self, operation, attempt, error):
+        """Account a retryable error raised while reading a stream and wait before it is requested again."""
+        throttled = is_throttling_error(error)
+        self._emit(operation, 'throttles' if throttled else 'stream_errors')
+        if throttled:
+            self.buckets[operation].on_throttle()
+
+        delay = self._backoff(attempt, error)
+        self._emit(operation, 'retries')
+        self._emit(operation, 'backoff_seconds', delay)
+        logger.info(f'{operation} stream attempt {attempt + 1} failed: {error}. Retry in {round(delay, 2)}s')
+        time.sleep(delay)
+
+    def _backoff(self, attempt, error):
+        # Full jitter, but never retry sooner than the service asked for
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after(error))
+
+
+def _has_error_code(error, codes):
+    # Error events of a stream use lower camel case codes, e.g. 'throttlingException'
+    codes = [code.lower() for code in codes]
+    if isinstance(error, (ClientError, EventStreamError)):
+        return str(error.response.get('Error', {}).get('Code')).lower() in codes
+    return any(code in str(error).lower() for code in codes)
+
+
+def is_throttling_error(error):
+    return _has_error_code(error, THROTTLING_ERROR_CODES)
+
+
+def is_stream_error(error):
+    return isinstance(error, EventStreamError) and _has_error_code(error, STREAM_ERROR_CODES)
+
+
+def is_connection_error(error):
+    return isinstance(error, (ConnectionError, ReadTimeoutError)) or 'AWSHTTPSConnectionPool' in str(error)
+
+
+def retry_after(error):
+    if not isinstance(error, ClientError):
+        return 0
+    headers = error.response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    try:
+        return float(headers.get('retry-after', 0))
+    except ValueError:
+        return 0
+
+
+rate_limiter = RateLimiter()
+
+
+def rate_limited(operation):
+    def decorator_rate_limited(func):
+        @functools.wraps(func)
+        def wrapper_rate_limited(*args, **kwargs):
+            return rate_limiter.call(operation, func, *args, **kwargs)
+
+        return wrapper_rate_limited
+
+    return decorator_rate_limited
 
 
 def parse_response(response):
-    regex_result = re.search(PATTERN, response, re.DOTALL)
-    regex_result = regex_result.group(0)
-    return ast.literal_eval(regex_result)
+    result = parse_json_array(response)
+    if not result:
+        raise ValueError('No JSON objects found in response')
+    return result
+
+
+def build_request(messages, system_prompt):
+    return {
+        "anthropic_version": ANTHROPIC_VERSION,
+        "max_tokens": 2500,
+        "system": system_prompt,
+        "temperature": 0,
+        "messages": messages
+    }
 
 
 def invoke_model(messages, system_prompt):
-    body = json.dumps(
-        {
-            "anthropic_version": ANTHROPIC_VERSION,
-            "max_tokens": 2500,
-            "system": system_prompt,
-            "temperature": 0,
-            "messages": messages
-        }
-    )
-    response = brt.invoke_model(body=body, modelId=MODEL_ID)
-    response_body = json.loads(response.get('body').read())
+    request = build_request(messages, system_prompt)
+
+    key = cache_key(MODEL_ID, request)
+    completion = response_cache.get('model', key) if response_cache else None
+    if completion is None:
+        with instrumentation.span('bedrock.invoke_model'):
+            completion = _invoke_model(json.dumps(request))
+        if response_cache:
+            response_cache.put('model', key, completion)
 
     try:
-        response = json.loads(response_body['content'][0]['text'])
+        response = json.loads(completion)
+        response = [response] if isinstance(response, dict) else response
     except Exception as e:
         logger.info(f'Error parse response: {e}')
         try:
-            logger.info(f'Error parse response: {e}')
-            response = parse_response(response_body['content'][0]['text'])
+            response = parse_response(completion)
         except Exception as e:
-            logger.info(f'Error parse response: {e}')
-            response = response_body['content'][0]['text']
+            logger.info(f'Error parse response: {e}, completion: {completion[:500]}')
+            response = []
 
     return response
 
 
-def invoke_agent(input_text):
-    # Note: The execution time depends on the foundation model, complexity of the agent,
-    # and the length of the prompt. In some cases, it can take up to a minute or more to
-    # generate a response.
-    response = brt_agent.invoke_agent(
-        # ToDo: Update manually with AgentID and AgentAliasId until AWS CDK support AWS Bedrock Agents
-        agentId='VBVCRTAYMV',
-        agentAliasId='ECZGMVPR1S',
-        sessionId=str(uuid.uuid4()),
-        inputText=input_text
-    )
+def invoke_model_stream(messages, system_prompt, schema=None, min_objects=1):
+    """
+    Stream a completion with ``invoke_model_with_response_stream`` and yield the objects of its JSON array
+    as soon as each one is complete and valid against ``schema``.
 
-    completion = ""
+    The stream is abandoned when the completion does not open a JSON array within its preamble, or once the
+    array is closed. Throttling and stream errors raised before the first object was yielded request the
+    completion again. Only complete arrays of at least ``min_objects`` valid objects are cached.
+    """
+    request = build_request(messages, system_prompt)
+    parser = JsonArrayStreamParser(schema)
 
-    for event in response.get("completion"):
-        chunk = event["chunk"]
-        completion = completion + chunk["bytes"].decode()
+    key = cache_key(MODEL_ID, request)
+    completion = response_cache.get('model', key) if response_cache else None
+    if completion is not None:
+        yield from parser.feed(completion)
+        return
 
-    return completion
+    start = time.monotonic()
+    first_result = None
+    for attempt in range(RETRY_ATTEMPTS):
+        parser = JsonArrayStreamParser(schema)
+        chunks = []
+        usage = {}
+        stream, events = _invoke_model_stream(json.dumps(request))
+        try:
+            for event in events:
+                chunk = json.loads(event['chunk']['bytes'])
+                if chunk.get('type') == 'message_start':
+                    usage.update(chunk['message'].get('usage', {}))
+                elif chunk.get('type') == 'message_delta':
+                    usage.update(chunk.get('usage', {}))
+                if chunk.get('type') != 'content_block_delta':
+                    continue
 
+                text = chunk['delta'].get('text', '')
+                chunks.append(text)
+                for obj in parser.feed(text):
+                    if first_result is None:
+                        first_result = time.monotonic() - start
+                    yield obj
 
-def get_stocks(finance_api):
-    stocks = []
-    for industry, stocks_list in finance_api.industries.items():
-        if len(stocks_list) < 4:
+                if parser.finished or parser.abandoned:
+                    break
+        except Exception as e:
+            # Objects already yielded cannot be taken back, only a stream that yielded nothing is retried
+            retryable = is_throttling_error(e) or is_stream_error(e)
+            if first_result is not None or not retryable or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            rate_limiter.retry_stream('invoke_model', attempt, e)
             continue
-        stocks.append(stocks_list)
-    return [stock for industry_stock in stocks for stock in industry_stock]
+        finally:
+            stream.close()
+        break
 
+    # The final usage event is not read if the stream is left early, the output is estimated then
+    instrumentation.record_span('bedrock.invoke_model_stream', time.monotonic() - start)
+    instrumentation.count('bedrock.model.input_tokens', usage.get('input_tokens', 0))
+    instrumentation.count('bedrock.model.output_tokens',
+                          usage.get('output_tokens') or estimate_tokens(''.join(chunks)))
+    logger.info(f'Streamed model response in {round(time.monotonic() - start, 2)}s, first result after '
+                f'{round(first_result, 2) if first_result is not None else None}s, valid: {parser.valid}, '
+                f'invalid: {parser.invalid}, complete: {parser.finished}')
+    if parser.abandoned:
+        logger.info(f'Abandoned model response without JSON array: {"".join(chunks)[:500]}')
+    elif response_cache and parser.finished and parser.valid >= min_objects and not parser.invalid:
+        response_cache.put('model', key, ''.join(chunks))
+
+
+@rate_limited('invoke_model')
+def _invoke_model_stream(body):
+    response = get_client('bedrock-runtime').invoke_model_with_response_stream(body=body, modelId=MODEL_ID)
+
+    # Throttling arrives as an error event of the stream, the first event is read here so it is retried
+    stream = response.get('body')
+    events = iter(stream)
+    first_event = next(events, None)
+    return stream, itertools.chain([first_event] if first_event is not None else [], events)
+
+
+@rate_limited('invoke_model')
+def _invoke_model(body):
+    response = get_client('bedrock-runtime').invoke_model(body=body, modelId=MODEL_ID)
+    response_body = json.loads(response.get('body').read())
+    usage = response_body.get('usage', {})
+    instrumentation.count('bedrock.model.input_tokens', usage.get('input_tokens', 0))
+    instrumentation.count('bedrock.model.output_tokens', usage.get('output_tokens', 0))
+    return response_body['content'][0]['text']
+
+
+def invoke_agent(input_text, max_chars=AGENT_MAX_CHARS):
+    return ''.join(invoke_agent_stream(input_text, max_chars=max_chars))
+
+
+def invoke_agent_stream(input_text, max_chars=AGENT_MAX_CHARS):
+    """
+    Yield the decoded text chunks of an agent completion as they arrive.
+
+    Bytes are decoded incrementally, so multibyte characters split across chunks stay intact. The stream is
+    closed once ``max_chars`` characters were produced, 0 disables the cap.
+    """
+    key = cache_key(AGENT_ID, AGENT_ALIAS_ID, input_text, max_chars)
+    completion = response_cache.get('agent', key) if response_cache else None
+    if completion is not None:
+        yield completion
+        return
+
+    start = time.monotonic()
+    first_chunk = None
+    chunks = []
+    length = 0
+    capped = False
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    stream, events = _invoke_agent(input_text)
+    try:
+        for event in events:
+            if 'chunk' not in event:
+                continue
+
+            text = decoder.decode(event['chunk']['bytes'])
+            if max_chars and length + len(text) >= max_chars:
+                text = text[:max_chars - length]
+                capped = True
+            if text:
+                if first_chunk is None:
+                    first_chunk = time.monotonic() - start
+                chunks.append(text)
+                length += len(text)
+                yield text
+            if capped:
+                break
+        else:
+            text = decoder.decode(b'', final=True)
+            if text:
+                chunks.append(text)
+                yield text
+    finally:
+        if hasattr(stream, 'close'):
+            stream.close()
+
+    instrumentation.record_span('bedrock.invoke_agent', time.monotonic() - start)
+    instrumentation.count('bedrock.agent.output_chars', length)
+
+    logger.info(f'Streamed agent response in {round(time.monotonic() - start, 2)}s, first chunk after '
+                f'{round(first_chunk, 2) if first_chunk is not None else None}s, characters: {length}, '
+                f'capped: {capped}')
+    if response_cache and chunks:
+        response_cache.put('agent', key, ''.join(chunks))
+
+
+@rate_limited('invoke_agent')
+def _invoke_agent(input_text):
+    # Note: The execution time depends on the foundation model, complexity of the agent,
+    # and the length of the prompt. In some cases, it can take up to a minute or more to
+    # generate a response.
+    response = get_client('bedrock-agent-runtime').invoke_agent(
+        agentId=AGENT_ID,
+        agentAliasId=AGENT_ALIAS_ID,
+        sessionId=str(uuid.uuid4()),
+        inputText=input_text
+    )
+
+    # Throttling arrives as an error event of the stream, the first event is read here so it is retried
+    stream = response.get('completion')
+    events = iter(stream)
+    first_event = next(events, None)
+    return stream, itertools.chain([first_event] if first_event is not None else [], events)
 
-def retry(retries=3, delay=60 * 5):
-    def decorator_retry(func):
-        @functools.wraps(func)
-        def wrapper_retry(*args, **kwargs):
-            for attempt in range(retries):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    logger.info(f"Attempt {attempt + 1} failed: {e}")
-                    if 'ThrottlingException' in str(e) or 'AWSHTTPSConnectionPool' in str(e):
-                        if attempt < retries - 1:
-                            time.sleep(delay)
-                        else:
-                            logger.info("All attempts failed. Continue...")
-
-        return wrapper_retry
-
-    return decorator_retry
@@ -0,0 +1,104 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from aws_lambda_powertools import Logger, Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+
+logger = Logger()
+
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "StockAnalysis")
+# Directory of the JSON run profiles, empty disables the file sink
+PROFILE_DIR = os.getenv("PROFILE_DIR", ".cache/profiles")
+# Individual spans kept in the profile, aggregates are always complete
+PROFILE_MAX_SPANS = int(os.getenv("PROFILE_MAX_SPANS", "20000"))
+
+
+class Instrumentation:
+    """
+    Thread safe timing spans and counters for one run.
+
+    Spans are aggregated per name (count, total, max) and kept individually with their dimensions, e.g. the
+    industry or symbol. Counters are plain sums. ``flush`` writes the run profile as JSON and emits the
+    aggregates as CloudWatch embedded metrics through powertools.
+    """
+
+    def __init__(self, namespace=METRICS_NAMESPACE, profile_dir=PROFILE_DIR, max_spans=PROFILE_MAX_SPANS):
+        self.namespace = namespace
+        self.profile_dir = profile_dir
+        self.max_spans = max_spans
+        self.started_at = time.time()
+        self.counters = defaultdict(float)
+        self.aggregates = defaultdict(lambda: {'count': 0, 'total': 0.0, 'max': 0.0, 'errors': 0})
+        self.spans = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **dimensions):
+        start = time.monotonic()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.record_span(name, time.monotonic() - start, error=error, **dimensions)
+
+    def record_span(self, name, duration, error=None, **dimensions):
+        with self._lock:
+            aggregate = self.aggregates[name]
+            aggregate['count'] += 1
+            aggregate['total'] += duration
+            aggregate['max'] = max(aggregate['max'], duration)
+            aggregate['errors'] += error is not None
+            if len(self.spans) < self.max_spans:
+                self.spans.append({'name': name, 'duration': round(duration, 4), 'error': error, **dimensions})
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def count_all(self, prefix, values):
+        for name, value in values.items():
+            self.count(f'{prefix}.{name}', value)
+
+    def profile(self):
+        with self._lock:
+            return {
+                'started_at': self.started_at,
+                'duration': round(time.time() - self.started_at, 4),
+                'stages': {name: {**aggregate, 'total': round(aggregate['total'], 4),
+                                  'max': round(aggregate['max'], 4)}
+                           for name, aggregate in self.aggregates.items()},
+                'counters': dict(self.counters),
+                'spans': list(self.spans),
+            }
+
+    def flush(self, name='run'):
+        """Write the profile to ``profile_dir`` and emit the aggregates as embedded metrics."""
+        profile = self.profile()
+        path = None
+        if self.profile_dir:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir,
+                                f'{name}-{time.strftime("%Y%m%dT%H%M%S", time.gmtime(self.started_at))}.json')
+            with open(path, 'w') as file:
+                json.dump(profile, file, indent=1, default=str)
+
+        metrics = Metrics(namespace=self.namespace, service=name)
+        for stage, aggregate in profile['stages'].items():
+            metrics.add_metric(name=f'{stage}.seconds', unit=MetricUnit.Seconds, value=aggregate['total'])
+            metrics.add_metric(name=f'{stage}.count', unit=MetricUnit.Count, value=aggregate['count'])
+        for counter, value in profile['counters'].items():
+            metrics.add_metric(name=counter, unit=MetricUnit.Count, value=value)
+        metrics.flush_metrics()
+
+        logger.info(f'Run profile written to {path}, stages: {profile["stages"]}, counters: {profile["counters"]}')
+        return profile
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,136 @@
+import ast
+import json
+
+from aws_lambda_powertools import Logger
+
+logger = Logger()
+
+# Completions which have not opened the JSON array after this many characters are abandoned
+MAX_PREAMBLE_CHARS = 4000
+
+RANKING_SCHEMA = {
+    'symbol': ((str,), True),
+    'rank': ((int, float, str), False),
+    'explanation': ((str,), False),
+    'investment_decision': ((str,), False),
+}
+PORTFOLIO_SCHEMA = {
+    'symbol': ((str,), True),
+    'name': ((str,), False),
+    'number_of_shares_to_buy': ((int, float), True),
+}
+
+
+def validate(obj, schema):
+    """Check an object against a schema of ``field: (types, required)``."""
+    if not isinstance(obj, dict):
+        return False
+    for field, (types, required) in schema.items():
+        if field not in obj or obj[field] is None:
+            if required:
+                return False
+            continue
+        if not isinstance(obj[field], types) or isinstance(obj[field], bool):
+            return False
+    return True
+
+
+class JsonArrayStreamParser:
+    """
+    Incremental parser extracting the objects of the first top level JSON array in a text stream.
+
+    Text before the array is skipped, a ``[`` only opens the array if the next non-blank character opens an
+    element, so brackets in the preamble like ``Ranking [by score]:`` are skipped too. Every element is decoded
+    as soon as its closing bracket arrives, nested arrays and brackets inside strings are handled.
+    Elements which are not objects, cannot be decoded or do not match the optional schema are counted as invalid
+    and dropped, strings and numbers at the top level of the array are skipped.
+    """
+
+    def __init__(self, schema=None, max_preamble_chars=MAX_PREAMBLE_CHARS):
+        self.schema = schema
+        self.max_preamble_chars = max_preamble_chars
+        self.started = False
+        self.candidate = False
+        self.finished = False
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.buffer = []
+        self.preamble_chars = 0
+        self.valid = 0
+        self.invalid = 0
+
+    @property
+    def abandoned(self):
+        return not self.started and self.preamble_chars > self.max_preamble_chars
+
+    def feed(self, text):
+        objects = []
+        for char in text:
+            if self.finished:
+                break
+
+            if not self.started and not self._opens_array(char):
+                continue
+
+            if self.depth >= 2:
+                self.buffer.append(char)
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+
+            if char == '"':
+                self.in_string = True
+            elif char in '{[':
+                if self.depth == 1:
+                    self.buffer = [char]
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+                if self.depth == 1:
+                    obj = self._decode(''.join(self.buffer))
+                    if obj is not None:
+                        objects.append(obj)
+                elif self.depth == 0:
+                    self.finished = True
+        return objects
+
+    def _opens_array(self, char):
+        """Advance the preamble, True if ``char`` is the first element of the array started by a candidate ``[``."""
+        if self.candidate and char.isspace():
+            return False
+        if self.candidate and char in '{[':
+            self.started = True
+            self.depth = 1
+            return True
+        self.candidate = char == '['
+        self.preamble_chars += 1
+        return False
+
+    def _decode(self, text):
+        try:
+            obj = json.loads(text)
+        except ValueError:
+            try:
+                obj = ast.literal_eval(text)
+            except (ValueError, SyntaxError):
+                obj = None
+
+        if obj is None or not validate(obj, self.schema or {}):
+            self.invalid += 1
+            logger.info(f'Dropping invalid element from model response: {text[:200]}')
+            return None
+
+        self.valid += 1
+        return obj
+
+
+def parse_json_array(text, schema=None):
+    """Parse all valid objects of the first JSON array in ``text``, also if the array is truncated."""
+    return JsonArrayStreamParser(schema, max_preamble_chars=len(text)).feed(text)
@@ -0,0 +1,119 @@
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from aws_lambda_powertools import Logger
+
+logger = Logger()
+
+# The ECS stack provisions no volume, on Fargate the cache is task storage and starts empty on every run.
+# Point this at a mounted volume (e.g. EFS) for the history delta downloads to take effect.
+MARKET_CACHE_DIR = os.getenv("MARKET_CACHE_DIR", ".cache/market_data")
+MARKET_CACHE_MAX_BYTES = int(os.getenv("MARKET_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+# Time to live in seconds per cached field
+MARKET_CACHE_TTL = {
+    'history': int(os.getenv("MARKET_CACHE_TTL_HISTORY", str(60 * 60 * 12))),
+    'info': int(os.getenv("MARKET_CACHE_TTL_INFO", str(60 * 60 * 24))),
+    'earnings': int(os.getenv("MARKET_CACHE_TTL_EARNINGS", str(60 * 60 * 24 * 7))),
+    'indicators': int(os.getenv("MARKET_CACHE_TTL_INDICATORS", str(60 * 60 * 24 * 7))),
+}
+
+
+class MarketDataCache:
+    """
+    Persistent SQLite cache for price history, ticker info snapshots, earnings dates and indicator state.
+
+    Entries are keyed by (field, symbol). ``get`` returns the value together with its age so callers can decide
+    between reusing, refreshing incrementally or downloading again. The total payload size is bounded by evicting
+    the least recently accessed entries.
+    """
+
+    def __init__(self, directory=MARKET_CACHE_DIR, ttl=None, max_bytes=MARKET_CACHE_MAX_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'market_data.sqlite')
+        self.ttl = {**MARKET_CACHE_TTL, **(ttl or {})}
+        self.max_bytes = max_bytes
+        self.stats = defaultdict(int)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS market_data (
+                field TEXT NOT NULL,
+                symbol TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (field, symbol)
+            )""")
+        self._connection.commit()
+
+    def get(self, field, symbol):
+        """Return ``(value, age_in_seconds)`` or ``(None, None)`` if the entry does not exist."""
+        with self._lock:
+            row = self._connection.execute('SELECT payload, updated_at FROM market_data WHERE field = ? AND symbol = ?',
+                                           (field, symbol)).fetchone()
+            if row is None:
+                self.stats[f'{field}_miss'] += 1
+                return None, None
+
+            self._connection.execute('UPDATE market_data SET accessed_at = ? WHERE field = ? AND symbol = ?',
+                                     (time.time(), field, symbol))
+            self._connection.commit()
+
+        self.stats[f'{field}_hit'] += 1
+        return self._deserialize(field, row[0]), time.time() - row[1]
+
+    def is_fresh(self, field, age):
+        return age is not None and age < self.ttl[field]
+
+    def put(self, field, symbol, value):
+        payload = self._serialize(field, value)
+        now = time.time()
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO market_data VALUES (?, ?, ?, ?, ?, ?)',
+                                     (field, symbol, payload, len(payload), now, now))
+            self._connection.commit()
+        self.stats[f'{field}_write'] += 1
+
+    def evict(self):
+        """Delete least recently accessed entries until the cache fits into ``max_bytes``."""
+        with self._lock:
+            total = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM market_data').fetchone()[0]
+            if total <= self.max_bytes:
+                return 0
+
+            evicted = 0
+            rows = self._connection.execute('SELECT field, symbol, size FROM market_data ORDER BY accessed_at')
+            for field, symbol, size in rows.fetchall():
+                if total <= self.max_bytes:
+                    break
+                self._connection.execute('DELETE FROM market_data WHERE field = ? AND symbol = ?', (field, symbol))
+                total -= size
+                evicted += 1
+            self._connection.commit()
+
+        self.stats['evicted'] += evicted
+        logger.info(f'Market data cache evicted {evicted} entries')
+        return evicted
+
+    def get_stats(self):
+        return dict(self.stats)
+
+    @staticmethod
+    def _serialize(field, value):
+        if field == 'info':
+            return json.dumps(value).encode()
+        return pickle.dumps(value)
+
+    @staticmethod
+    def _deserialize(field, payload):
+        if field == 'info':
+            return json.loads(payload)
+        return pickle.loads(payload)
@@ -1,54 +1,102 @@
-from helper.helper import get_stocks, invoke_agent, invoke_model
-import yaml
+from helper.helper import invoke_agent, invoke_model_stream, load_prompts
+from helper.json_stream import PORTFOLIO_SCHEMA
+from helper.instrumentation import instrumentation
+from helper.prompt_serializer import serialize_stocks, truncate, PORTFOLIO_FIELDS, PORTFOLIO_TOKEN_BUDGET, \
+    CHARS_PER_TOKEN
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
 
 from aws_lambda_powertools import Logger
 
 logger = Logger()
 
+MARKET_SENTIMENT_TERMS = ['US', 'EU', 'Chine']
+# Same threshold as the stock analyst, smaller industries are not ranked
+MIN_INDUSTRY_SIZE = 4
+# Seconds to wait for all analyst shards of the day to finish before the analyses are read, the analyst must run
+# with ANALYSIS_BARRIER=true if it is not sharded. Without timeout and requirement the barrier is not used.
+ANALYSIS_BARRIER_TIMEOUT = float(os.getenv("ANALYSIS_BARRIER_TIMEOUT", "0"))
+ANALYSIS_BARRIER_POLL_INTERVAL = float(os.getenv("ANALYSIS_BARRIER_POLL_INTERVAL", "30"))
+# Without the barrier the portfolio is built from whatever analyses were saved
+ANALYSIS_BARRIER_REQUIRED = os.getenv("ANALYSIS_BARRIER_REQUIRED", "false").lower() == "true"
+
 
 class PortfolioManager:
     def __init__(self):
-        with open('schema/prompts.yaml', 'r') as file:
-            prompts = yaml.safe_load(file)
-
-        self.prompts = prompts
+        self.prompts = load_prompts()
 
     def manage_portfolio(self, finance_api, database):
         date = str(finance_api.today.strftime('%Y-%m-%d'))
         logger.info(f'Start portfolio manager {date}')
 
-        stocks = get_stocks(finance_api)
-        logger.info(f'{len(stocks)} stocks found')
-
-        market_sentiment = ''
-        try:
-            market_sentiment += invoke_agent(self.prompts['agent_web_search_portfolio_manger']['prompt'].
-                                             replace("<term>", "US")) + "; "
-            market_sentiment += invoke_agent(self.prompts['agent_web_search_portfolio_manger']['prompt'].
-                                             replace("<term>", "EU")) + "; "
-            market_sentiment += invoke_agent(self.prompts['agent_web_search_portfolio_manger']['prompt'].
-                                             replace("<term>", "Chine"))
-        except Exception as e:
-            logger.info(f'Error getting market sentiment, error: {e}')
-
-        stock_analysis = database.get_analyst_data(stocks=stocks, date=date)
-        logger.info(f'{len(stock_analysis)} stocks analysis found from today {date}')
-        for stock in stock_analysis:
-            try:
-                del stock['stock_news']
-            except:
-                continue
-
-        content = self.prompts['portfolio_manager_user']['prompt'].replace("<data>", str({"general_market_sentiment":
-                                                                                              market_sentiment,
-                                                                                          "stocks":
-                                                                                              stock_analysis}))
+        if ANALYSIS_BARRIER_TIMEOUT or ANALYSIS_BARRIER_REQUIRED:
+            with instrumentation.span('portfolio.barrier'):
+                self._wait_for_analysis(database, date)
+
+        # Market sentiment is streamed while the analyses are loaded, each term is capped to the sentiment budget
+        sentiment_chars = PORTFOLIO_TOKEN_BUDGET * CHARS_PER_TOKEN // 4
+        with ThreadPoolExecutor(max_workers=len(MARKET_SENTIMENT_TERMS), thread_name_prefix='agent') as pool:
+            sentiment_futures = [pool.submit(self._get_market_sentiment, term, sentiment_chars)
+                                 for term in MARKET_SENTIMENT_TERMS]
+
+            stock_analysis = self._get_stock_analysis(database, date)
+            logger.info(f'{len(stock_analysis)} stocks analysis found from today {date}')
+
+            market_sentiments = []
+            for term, future in zip(MARKET_SENTIMENT_TERMS, sentiment_futures):
+                try:
+                    market_sentiments.append(future.result())
+                except Exception as e:
+                    logger.info(f'Error getting market sentiment for {term}, error: {e}')
+            market_sentiment = "; ".join(market_sentiments)
+
+        # Market sentiment may use a quarter of the budget, the rest is shared by the stocks
+        sentiment = truncate(market_sentiment, sentiment_chars)
+        payload, report = serialize_stocks(stock_analysis, PORTFOLIO_FIELDS, text_field='explanation',
+                                           key_field='stock', token_budget=PORTFOLIO_TOKEN_BUDGET,
+                                           header=f'general_market_sentiment: {sentiment}\nstocks:')
+        logger.info(f'Portfolio prompt: {report}')
+
+        content = self.prompts['portfolio_manager_user']['prompt'].replace("<data>", payload)
         system_prompt = self.prompts['portfolio_manager_system']['prompt']
-        response = invoke_model([{
-            "role": "user",
-            "content": content
-        }], system_prompt)
+        with instrumentation.span('portfolio.model'):
+            response = list(invoke_model_stream([{
+                "role": "user",
+                "content": content
+            }], system_prompt, schema=PORTFOLIO_SCHEMA))
 
         logger.info(f'Response: {response}')
-        database.save_portfolio(response, date)
+        with instrumentation.span('portfolio.save'):
+            database.save_portfolio(response, date)
         logger.info(f'Finished portfolio manager')
+
+    def _get_stock_analysis(self, database, date):
+        """
+        Analyses of the day grouped by their stored industry. The portfolio manager runs in its own task without
+        the analyst's universe, so the industries come from the rows and no market data is loaded.
+        """
+        rows = database.get_analyst_data_by_date(date)
+        industry_sizes = Counter(row.get('industry') for row in rows)
+        logger.info(f'{len(rows)} analyses in {len(industry_sizes)} industries found for {date}')
+        return [row for row in rows if industry_sizes[row.get('industry')] >= MIN_INDUSTRY_SIZE]
+
+    def _wait_for_analysis(self, database, date, timeout=ANALYSIS_BARRIER_TIMEOUT,
+                           poll_interval=ANALYSIS_BARRIER_POLL_INTERVAL, required=ANALYSIS_BARRIER_REQUIRED):
+        deadline = time.monotonic() + timeout
+        while not database.is_analysis_complete(date):
+            if time.monotonic() >= deadline:
+                if required:
+                    raise TimeoutError(f'Stock analysis of {date} is not complete after {timeout}s')
+                logger.warning(f'Stock analysis of {date} is not complete, building the portfolio from the analyses '
+                               f'saved so far')
+                return False
+            time.sleep(poll_interval)
+        logger.info(f'Stock analysis of {date} is complete')
+        return True
+
+    def _get_market_sentiment(self, term, max_chars):
+        input_text = self.prompts['agent_web_search_portfolio_manger']['prompt'].replace("<term>", term)
+        with instrumentation.span('portfolio.sentiment', term=term):
+            return invoke_agent(input_text, max_chars=max_chars)
@@ -0,0 +1,113 @@
+import csv
+import io
+import math
+import os
+
+from helper.fundamentals import FUNDAMENTAL_PARAMETERS
+
+# Rough token estimate for Claude models on mixed English text and numbers
+CHARS_PER_TOKEN = 4
+RANKING_TOKEN_BUDGET = int(os.getenv("RANKING_TOKEN_BUDGET", "12000"))
+PORTFOLIO_TOKEN_BUDGET = int(os.getenv("PORTFOLIO_TOKEN_BUDGET", "30000"))
+SIGNIFICANT_DIGITS = 4
+TRUNCATION_MARK = '...'
+
+RANKING_FIELDS = ['symbol', 'name', 'currency', 'previousClose', 'marketCap', 'beta', 'fiftyTwoWeekLow',
+                  'fiftyTwoWeekHigh', 'dividendYield', 'priceToBook', 'enterpriseToEbitda', 'returnOnEquity',
+                  'recommendationKey', 'targetMeanPrice'] + [
+                     field for parameter in FUNDAMENTAL_PARAMETERS
+                     for field in (parameter, f"industryAverage{parameter[0].upper()}{parameter[1:]}")] + [
+                     'rsi14', 'macdHistogram', 'priceToSma200', 'maTrend', 'daysSinceMaCrossover', 'volatility30d',
+                     'maxDrawdown1y', 'drawdown', 'return1m', 'return1y', 'volumeRatio20d']
+PORTFOLIO_FIELDS = ['stock', 'name', 'industry', 'close', 'rank', 'investment_decision']
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def format_number(value, digits=SIGNIFICANT_DIGITS):
+    """Fixed-point ``value`` rounded to ``digits`` significant digits, never in exponent notation."""
+    if value == 0:
+        return '0'
+    magnitude = math.floor(math.log10(abs(value)))
+    decimals = max(0, digits - 1 - magnitude)
+    text = f'{round(value, digits - 1 - magnitude):.{decimals}f}'
+    return text.rstrip('0').rstrip('.') if decimals else text
+
+
+def format_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, (int, float)):
+        if isinstance(value, float) and not math.isfinite(value):
+            return ''
+        for limit, suffix in ((1e12, 'T'), (1e9, 'B'), (1e6, 'M')):
+            if abs(value) >= limit:
+                return f'{format_number(value / limit)}{suffix}'
+        return format_number(value)
+    return ' '.join(str(value).split())
+
+
+def _flatten(row):
+    flat = {}
+    for key, value in row.items():
+        if isinstance(value, dict):
+            flat.update(value)
+        else:
+            flat[key] = value
+    return flat
+
+
+def serialize_table(rows, fields):
+    """CSV table with one header line shared by all rows, columns without any value are dropped."""
+    rows = [_flatten(row) for row in rows]
+    columns = [field for field in fields if any(row.get(field) is not None for row in rows)]
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([format_value(row.get(field)) for field in columns])
+    return buffer.getvalue().rstrip('\n')
+
+
+def truncate(text, max_chars):
+    text = ' '.join(str(text).split())
+    if len(text) <= max_chars:
+        return text
+    return text[:max(0, max_chars - len(TRUNCATION_MARK))].rsplit(' ', 1)[0] + TRUNCATION_MARK
+
+
+def serialize_stocks(rows, fields, text_field=None, key_field='symbol', token_budget=RANKING_TOKEN_BUDGET,
+                     header=None):
+    """
+    Serialize stock rows for a prompt: whitelisted fields as one table plus the free text of ``text_field``
+    per stock, which is truncated evenly so the whole payload stays within ``token_budget``.
+
+    Returns the payload and a report with the estimated tokens.
+    """
+    sections = [header] if header else []
+    sections.append(serialize_table(rows, fields))
+    payload = '\n'.join(sections)
+
+    truncated = 0
+    if text_field:
+        texts = [(row.get(key_field), row.get(text_field)) for row in rows if row.get(text_field)]
+        remaining_chars = max(0, (token_budget - estimate_tokens(payload)) * CHARS_PER_TOKEN)
+        per_stock_chars = remaining_chars // len(texts) if texts else 0
+
+        lines = []
+        for key, text in texts:
+            shortened = truncate(text, per_stock_chars)
+            truncated += len(shortened) < len(' '.join(str(text).split()))
+            if shortened:
+                lines.append(f'{key}: {shortened}')
+        if lines:
+            payload = f'{payload}\n{text_field}:\n' + '\n'.join(lines)
+
+    report = {'stocks': len(rows), 'tokens': estimate_tokens(payload), 'token_budget': token_budget,
+              'truncated_texts': truncated}
+    return payload, report
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from aws_lambda_powertools import Logger
+
+logger = Logger()
+
+# The cache is opt-in, it is only enabled if a directory is configured
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+
+# Time to live in seconds per response kind
+RESPONSE_CACHE_TTL = {
+    'model': int(os.getenv("RESPONSE_CACHE_TTL_MODEL", str(60 * 60 * 24))),
+    'agent': int(os.getenv("RESPONSE_CACHE_TTL_AGENT", str(60 * 60 * 12))),
+}
+
+
+def cache_key(*parts):
+    """Content address of a request, the sha256 of its canonical JSON representation."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite cache for Bedrock model and agent completions keyed by the hash of the request.
+
+    Expired entries are ignored on read, and the least recently used entries are evicted once the cache
+    holds more than ``max_entries`` responses.
+    """
+
+    def __init__(self, directory=RESPONSE_CACHE_DIR, ttl=None, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'responses.sqlite')
+        self.ttl = {**RESPONSE_CACHE_TTL, **(ttl or {})}
+        self.max_entries = max_entries
+        self.stats = defaultdict(int)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+        self._connection.commit()
+
+    def get(self, kind, key):
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute('SELECT response, created_at FROM responses WHERE key = ?',
+                                           (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl[kind]:
+                self.stats[f'{kind}_miss'] += 1
+                return None
+
+            self._connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+            self._connection.commit()
+
+        self.stats[f'{kind}_hit'] += 1
+        return row[0]
+
+    def put(self, kind, key, response):
+        now = time.time()
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                                     (key, kind, response, now, now))
+            self._connection.execute("""
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )""", (self.max_entries,))
+            self._connection.commit()
+
+    def get_stats(self):
+        return dict(self.stats)
+
+
+response_cache = ResponseCache() if RESPONSE_CACHE_DIR else None
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from aws_lambda_powertools import Logger
+
+logger = Logger()
+
+# 'static' analyses the industries of shard SHARD_INDEX of SHARD_COUNT, 'queue' pulls industries from a work queue
+SHARD_MODE = os.getenv("SHARD_MODE", "static")
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+# SQLite file on a volume shared by all workers, e.g. EFS
+WORK_QUEUE_PATH = os.getenv("WORK_QUEUE_PATH", ".cache/work_queue.sqlite")
+# A claimed industry goes back to the queue if its worker did not finish it within the lease
+WORK_QUEUE_LEASE = float(os.getenv("WORK_QUEUE_LEASE", "1800"))
+WORK_QUEUE_MAX_ATTEMPTS = int(os.getenv("WORK_QUEUE_MAX_ATTEMPTS", "3"))
+WORKER_ID = os.getenv("WORKER_ID", f'{socket.gethostname()}-{os.getpid()}')
+# Set if the portfolio manager waits for the completion markers, a single static shard only writes one then
+ANALYSIS_BARRIER = os.getenv("ANALYSIS_BARRIER", "false").lower() == "true"
+
+STATUS_PENDING = 'pending'
+STATUS_LEASED = 'leased'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+def balanced_shards(industries, count):
+    """
+    Split ``{industry: stocks}`` into ``count`` lists of industries with similar stock counts.
+
+    Industries are assigned largest first to the shard with the fewest stocks. Ties are broken by name and
+    shard index, so every worker computes the same shards from the same universe.
+    """
+    shards = [[] for _ in range(count)]
+    sizes = [0] * count
+    for industry, stocks in sorted(industries.items(), key=lambda item: (-len(item[1]), item[0])):
+        index = min(range(count), key=lambda i: (sizes[i], i))
+        shards[index].append(industry)
+        sizes[index] += len(stocks)
+    return shards
+
+
+def plan_digest(plan):
+    return hashlib.sha256(json.dumps(plan).encode()).hexdigest()[:12]
+
+
+def stable_shard(industry, count):
+    """Shard of an industry missing from the stored plan, the same in every worker and process."""
+    return int(hashlib.sha256(industry.encode()).hexdigest(), 16) % count
+
+
+class SqliteWorkQueue:
+    """
+    Work queue of the industries of one run date in a SQLite file, shared by several workers.
+
+    Every worker populates the queue with the same industries, which is idempotent, and claims the largest
+    pending industry. A claim is a lease: industries of a worker that died are claimed again once the lease
+    expired, failed industries are retried up to ``max_attempts`` times.
+    """
+
+    def __init__(self, date, path=WORK_QUEUE_PATH, lease=WORK_QUEUE_LEASE, max_attempts=WORK_QUEUE_MAX_ATTEMPTS):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.date = date
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # Autocommit, transactions are opened explicitly
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS tasks (date TEXT, industry TEXT, stocks INTEGER, '
+                                 'status TEXT, worker TEXT, attempts INTEGER, lease_until REAL, updated_at REAL, '
+                                 'error TEXT, PRIMARY KEY (date, industry))')
+
+    def populate(self, industries):
+        with self._lock:
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, ?, NULL, 0, 0, ?, NULL)',
+                [(self.date, industry, len(stocks), STATUS_PENDING, time.time())
+                 for industry, stocks in industries.items()])
+
+    def requeue(self, finished_before):
+        """Put industries finished before ``finished_before`` back to pending, used to recompute a run."""
+        with self._lock:
+            self._connection.execute(
+                'UPDATE tasks SET status = ?, attempts = 0, error = NULL WHERE date = ? AND status IN (?, ?) '
+                'AND updated_at < ?', (STATUS_PENDING, self.date, STATUS_DONE, STATUS_FAILED, finished_before))
+
+    def claim(self, worker_id=WORKER_ID):
+        """Lease the largest claimable industry to ``worker_id``, None if there is none."""
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock, two workers never claim the same industry
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._connection.execute(
+                    'SELECT industry FROM tasks WHERE date = ? AND (status = ? OR (status = ? AND lease_until < ?) '
+                    'OR (status = ? AND attempts < ?)) ORDER BY stocks DESC, industry LIMIT 1',
+                    (self.date, STATUS_PENDING, STATUS_LEASED, now, STATUS_FAILED, self.max_attempts)).fetchone()
+                if row:
+                    self._connection.execute(
+                        'UPDATE tasks SET status = ?, worker = ?, attempts = attempts + 1, lease_until = ?, '
+                        'updated_at = ? WHERE date = ? AND industry = ?',
+                        (STATUS_LEASED, worker_id, now + self.lease, now, self.date, row[0]))
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+        return row[0] if row else None
+
+    def complete(self, industry):
+        self._finish(industry, STATUS_DONE, None)
+
+    def fail(self, industry, error):
+        self._finish(industry, STATUS_FAILED, str(error))
+
+    def _finish(self, industry, status, error):
+        with self._lock:
+            self._connection.execute('UPDATE tasks SET status = ?, error = ?, updated_at = ? '
+                                     'WHERE date = ? AND industry = ?',
+                                     (status, error, time.time(), self.date, industry))
+
+    def counts(self):
+        with self._lock:
+            return dict(self._connection.execute('SELECT status, COUNT(*) FROM tasks WHERE date = ? GROUP BY status',
+                                                 (self.date,)).fetchall())
+
+    def is_complete(self):
+        counts = self.counts()
+        return bool(counts) and set(counts) == {STATUS_DONE}
+
+    def close(self):
+        self._connection.close()
@@ -1,69 +1,532 @@
-import yaml
-from helper.helper import parse_response, retry, invoke_model, invoke_agent
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from helper.helper import invoke_model_stream, invoke_agent, rate_limiter, build_request, load_prompts
+from helper.json_stream import RANKING_SCHEMA, parse_json_array
+from helper.batch_inference import run_batch, BATCH_MIN_RECORDS
+from helper.fundamentals import FUNDAMENTAL_PARAMETERS
+from helper.checkpoint import RunManifest, CHECKPOINT_DIR
+from helper.sharding import balanced_shards, plan_digest, stable_shard, SHARD_INDEX, SHARD_COUNT, WORKER_ID, \
+    ANALYSIS_BARRIER
+from helper.fingerprint import stock_fingerprint, industry_unchanged, CHANGE_DETECTION
+from helper.instrumentation import instrumentation
+from helper.prompt_serializer import serialize_stocks, RANKING_FIELDS, RANKING_TOKEN_BUDGET, CHARS_PER_TOKEN
 from aws_lambda_powertools import Logger
 
 logger = Logger()
 
+# Separate caps keep agent and model calls below their Bedrock quotas
+AGENT_MAX_WORKERS = int(os.getenv("AGENT_MAX_WORKERS", "4"))
+MODEL_MAX_WORKERS = int(os.getenv("MODEL_MAX_WORKERS", "2"))
+# Industries with more stocks than the threshold are ranked in chunks and merged in a final round
+RANKING_CHUNK_SIZE = int(os.getenv("RANKING_CHUNK_SIZE", "12"))
+RANKING_CHUNK_THRESHOLD = int(os.getenv("RANKING_CHUNK_THRESHOLD", "15"))
+# News of one stock never gets more than a quarter of the ranking budget, longer agent output is not read
+NEWS_MAX_CHARS = int(os.getenv("NEWS_MAX_CHARS", str(RANKING_TOKEN_BUDGET * CHARS_PER_TOKEN // 4)))
+
 
 class StockAnalyst:
-    def __init__(self):
-        with open('schema/prompts.yaml', 'r') as file:
-            prompts = yaml.safe_load(file)
+    def __init__(self, agent_max_workers=AGENT_MAX_WORKERS, model_max_workers=MODEL_MAX_WORKERS,
+                 ranking_chunk_size=RANKING_CHUNK_SIZE, ranking_chunk_threshold=RANKING_CHUNK_THRESHOLD,
+                 shard_index=SHARD_INDEX, shard_count=SHARD_COUNT, change_detection=CHANGE_DETECTION,
+                 analysis_barrier=ANALYSIS_BARRIER):
+        if not 0 <= shard_index < shard_count:
+            raise ValueError(f'Shard index {shard_index} is not within shard count {shard_count}')
+        self.prompts = load_prompts()
+        self.agent_max_workers = agent_max_workers
+        self.model_max_workers = model_max_workers
+        # Chunk rankings run on pools nested in the model pool or queue workers, this caps all model calls
+        self._model_slots = threading.BoundedSemaphore(model_max_workers)
+        self.ranking_chunk_size = ranking_chunk_size
+        self.ranking_chunk_threshold = ranking_chunk_threshold
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.analysis_barrier = analysis_barrier
+        self.change_detection = change_detection
+        self.token_report = {}
+        self.skip_report = {}
 
-        self.prompts = prompts
+    def stock_analysis(self, finance_api, database, force_recompute=False):
+        """
+        Run the analysis as a two stage pipeline: news for all stocks is collected on the agent pool and each
+        industry is handed to the model pool for ranking as soon as the news of all its stocks is complete.
 
-    def stock_analysis(self, finance_api, database):
+        Industries already saved today are skipped unless ``force_recompute`` is set. With several shards only
+        the industries of this analyst's shard are analysed. Industries whose inputs did not change since their
+        last analysis are carried forward without a ranking, unless ``force_recompute`` is set.
+        """
         logger.info('Start stock analytics')
-        for industry, stocks in finance_api.industries.items():
-            if len(stocks) < 4:
-                continue
+        shard, digest = self._shard_industries(finance_api, database)
+        manifest = self._run_manifest(finance_api, database, shard, force_recompute)
+        industries = {industry: stocks for industry, stocks in shard.items() if not manifest.is_done(industry)}
+        logger.info(f'{len(industries)} industries to analyse, '
+                    f'{len(manifest.done_industries())} already done for {manifest.date}')
+
+        with ThreadPoolExecutor(max_workers=self.agent_max_workers, thread_name_prefix='agent') as agent_pool, \
+                ThreadPoolExecutor(max_workers=self.model_max_workers, thread_name_prefix='model') as model_pool:
+            news_futures = {}
+            pending_news = {}
+            news = defaultdict(dict)
+            for industry, stocks in industries.items():
+                pending_news[industry] = len(stocks)
+                for symbol in stocks:
+                    future = agent_pool.submit(self.get_news, symbol)
+                    news_futures[future] = industry, symbol['symbol']
+
+            ranking_futures = {}
+            for future in as_completed(news_futures):
+                industry, symbol = news_futures[future]
+                try:
+                    news[industry][symbol] = future.result()
+                except Exception as e:
+                    logger.info(f'Error while collecting news for {symbol}, error: {e}')
+                    news[industry][symbol] = None
 
-            self.compare_stocks_with_retry(stocks, industry, finance_api, database)
+                pending_news[industry] -= 1
+                if pending_news[industry] == 0:
+                    logger.info(f'News complete for industry {industry}, start ranking')
+                    future = model_pool.submit(self.rank_stocks, industries[industry], news.pop(industry),
+                                               industry, finance_api, database, not force_recompute)
+                    ranking_futures[future] = industry
 
+            for future in as_completed(ranking_futures):
+                industry = ranking_futures[future]
+                try:
+                    manifest.mark_done(industry, len(future.result()))
+                except Exception as e:
+                    logger.info(f'Error while ranking industry {industry}, error: {e}')
+                    manifest.mark_failed(industry, e)
+
+        self._mark_shard_complete(shard, digest, manifest, database)
+        self._log_skip_report()
+        logger.info(f'Rate limiter metrics: {dict(rate_limiter.metrics)}')
+        tokens_per_industry = {industry: sum(report['tokens'] for report in reports)
+                               for industry, reports in self.token_report.items()}
+        instrumentation.count('analyst.estimated_prompt_tokens', sum(tokens_per_industry.values()))
+        logger.info(f'Estimated ranking prompt tokens: {sum(tokens_per_industry.values())}, '
+                    f'per industry: {tokens_per_industry}')
         logger.info('Finished stock analytics')
 
     def compare_stocks(self, stocks, industry, finance_api, database):
+        news = {symbol['symbol']: self.get_news(symbol) for symbol in stocks}
+        return self.rank_stocks(stocks, news, industry, finance_api, database)
+
+    def get_news(self, symbol):
+        input_text = self.prompts['agent_web_search_stock_analyst']['prompt'].replace("<stock_name>",
+                                                                                      symbol['name'])
+        with instrumentation.span('analyst.news', symbol=symbol['symbol']):
+            return invoke_agent(input_text, max_chars=NEWS_MAX_CHARS)
+
+    def rank_stocks(self, stocks, news, industry, finance_api, database, detect_changes=True):
+        with instrumentation.span('analyst.rank', industry=industry, stocks=len(stocks)):
+            data_per_symbol = self._prepare_data(stocks, news, finance_api)
+            if detect_changes:
+                carried = self._carry_forward(data_per_symbol, industry, finance_api, database)
+                if carried is not None:
+                    return carried
+            stocks_to_send = self.get_ranking(data_per_symbol, industry, finance_api)
+        with instrumentation.span('analyst.save', industry=industry):
+            return self._save_ranking(stocks_to_send, industry, finance_api, database)
+
+    def stock_analysis_batch(self, finance_api, database, backend, force_recompute=False,
+                             min_records=BATCH_MIN_RECORDS):
+        """
+        Run the analysis with batch inference: the ranking requests of all industries are submitted as one batch
+        job per ranking round and the outputs are merged exactly like the synchronous ranking.
+
+        Large industries need a second round for their merge rankings. A round with fewer than ``min_records``
+        requests, usually a merge round, is ranked with synchronous model calls. Industries of a failed batch job
+        or with records missing from its output are marked as failed, so the next run picks them up again.
+        """
+        logger.info('Start stock analytics in batch mode')
+        shard, digest = self._shard_industries(finance_api, database)
+        manifest = self._run_manifest(finance_api, database, shard, force_recompute)
+        industries = {industry: stocks for industry, stocks in shard.items() if not manifest.is_done(industry)}
+        logger.info(f'{len(industries)} industries to analyse, '
+                    f'{len(manifest.done_industries())} already done for {manifest.date}')
+
+        news = self._collect_news(industries)
+        plans = {}
+        for industry, stocks in industries.items():
+            data_per_symbol = self._prepare_data(stocks, news[industry], finance_api)
+            if not force_recompute:
+                try:
+                    carried = self._carry_forward(data_per_symbol, industry, finance_api, database)
+                except Exception as e:
+                    logger.info(f'Error while carrying forward industry {industry}, error: {e}')
+                    manifest.mark_failed(industry, e)
+                    continue
+                if carried is not None:
+                    manifest.mark_done(industry, len(carried))
+                    continue
+            plan = self._ranking_plan(data_per_symbol)
+            plans[industry] = plan, next(plan)
+
+        ranking_round = 0
+        while plans:
+            ranking_round += 1
+            requests = {industry: chunks for industry, (_, chunks) in plans.items()}
+            ranked, failed = self._rank_round(requests, ranking_round, backend, finance_api, min_records)
+            for industry, error in failed.items():
+                logger.info(f'Ranking round {ranking_round} failed for industry {industry}, error: {error}')
+                manifest.mark_failed(industry, error)
+                del plans[industry]
+
+            for industry, ranked_chunks in ranked.items():
+                plan = plans[industry][0]
+                try:
+                    plans[industry] = plan, plan.send(ranked_chunks)
+                except StopIteration as stop:
+                    del plans[industry]
+                    try:
+                        manifest.mark_done(industry,
+                                           len(self._save_ranking(stop.value, industry, finance_api, database)))
+                    except Exception as e:
+                        logger.info(f'Error while saving ranking of industry {industry}, error: {e}')
+                        manifest.mark_failed(industry, e)
+
+        self._mark_shard_complete(shard, digest, manifest, database)
+        self._log_skip_report()
+        logger.info('Finished stock analytics in batch mode')
+
+    def _rank_round(self, requests, ranking_round, backend, finance_api, min_records):
+        """
+        Rank the chunks ``{industry: chunks}`` of one round, as one batch job or synchronously if there are fewer
+        than ``min_records``. Returns the ranked chunks per industry and the error per failed industry.
+        """
+        ranked, failed = {}, {}
+        number_of_records = sum(len(chunks) for chunks in requests.values())
+        if number_of_records < min_records:
+            logger.info(f'Ranking round {ranking_round}: {number_of_records} requests are below the batch minimum '
+                        f'of {min_records}, ranking synchronously')
+            with ThreadPoolExecutor(max_workers=self.model_max_workers, thread_name_prefix='model') as pool:
+                futures = {pool.submit(self._rank_chunks, chunks, industry, finance_api): industry
+                           for industry, chunks in requests.items()}
+                for future in as_completed(futures):
+                    try:
+                        ranked[futures[future]] = future.result()
+                    except Exception as e:
+                        failed[futures[future]] = e
+            return ranked, failed
+
+        records = {}
+        record_chunks = defaultdict(list)
+        for industry, chunks in requests.items():
+            for chunk in chunks:
+                messages, system_prompt = self._build_ranking_prompt(chunk, industry, finance_api)
+                # Unique across the rounds of a run, replays match records by their model input
+                record_id = f'R{ranking_round:02d}{len(records):08d}'
+                records[record_id] = build_request(messages, system_prompt)
+                record_chunks[industry].append((record_id, chunk))
+
+        logger.info(f'Batch ranking round {ranking_round}: {len(records)} requests for {len(requests)} industries')
+        try:
+            with instrumentation.span('analyst.batch_round', round=ranking_round, records=len(records)):
+                completions = run_batch(records, backend)
+        except Exception as e:
+            return ranked, {industry: e for industry in requests}
+
+        for industry, chunks in record_chunks.items():
+            missing = [record_id for record_id, _ in chunks if record_id not in completions]
+            if missing:
+                failed[industry] = f'missing batch records {missing}'
+                continue
+            try:
+                ranked[industry] = [self._apply_ranking(chunk,
+                                                        parse_json_array(completions[record_id], RANKING_SCHEMA))
+                                    for record_id, chunk in chunks]
+            except ValueError as e:
+                failed[industry] = e
+        return ranked, failed
+
+    def _rank_chunks(self, chunks, industry, finance_api):
+        return [self._get_single_ranking(chunk, industry, finance_api) for chunk in chunks]
+
+    def stock_analysis_queue(self, finance_api, database, queue, force_recompute=False, worker_id=WORKER_ID):
+        """
+        Run the analysis as one of several workers pulling industries from a shared work queue.
+
+        Each of the ``model_max_workers`` threads claims the largest pending industry, collects its news on the
+        shared agent pool and saves its ranking, until the queue has nothing left to claim. The queue is the
+        checkpoint of the run, with ``force_recompute`` industries finished before this worker started are
+        queued again. The worker that finds every industry done writes the completion marker.
+        """
+        logger.info(f'Start stock analytics as queue worker {worker_id}')
+        started_at = time.time()
+        industries, digest = self._shard_industries(finance_api, database, shard_index=0, shard_count=1)
+        queue.populate(industries)
+        if force_recompute:
+            queue.requeue(finished_before=started_at)
+
+        claimed = []
+        claimed_lock = threading.Lock()
+
+        def work(agent_pool):
+            while True:
+                industry = queue.claim(worker_id)
+                if industry is None:
+                    return
+                with claimed_lock:
+                    claimed.append(industry)
+                logger.info(f'Worker {worker_id} claimed industry {industry}')
+                try:
+                    stocks = industries[industry]
+                    news = self._collect_news({industry: stocks}, agent_pool)
+                    self.rank_stocks(stocks, news[industry], industry, finance_api, database, not force_recompute)
+                    queue.complete(industry)
+                except Exception as e:
+                    logger.info(f'Error while analysing industry {industry}, error: {e}')
+                    queue.fail(industry, e)
+
+        with ThreadPoolExecutor(max_workers=self.agent_max_workers, thread_name_prefix='agent') as agent_pool, \
+                ThreadPoolExecutor(max_workers=self.model_max_workers, thread_name_prefix='worker') as workers:
+            for future in [workers.submit(work, agent_pool) for _ in range(self.model_max_workers)]:
+                future.result()
+
+        counts = queue.counts()
+        instrumentation.count('analyst.claimed_industries', len(claimed))
+        logger.info(f'Worker {worker_id} analysed {len(claimed)} industries, queue: {counts}')
+        self._log_skip_report()
+        if queue.is_complete():
+            database.save_shard_marker(queue.date, 0, 1, list(industries),
+                                       sum(len(stocks) for stocks in industries.values()), plan_digest=digest)
+        logger.info('Finished stock analytics as queue worker')
+
+    def _run_manifest(self, finance_api, database, industries, force_recompute):
+        directory = CHECKPOINT_DIR
+        if self.shard_count > 1:
+            # Shards never write to each other's manifest
+            directory = os.path.join(CHECKPOINT_DIR, f'shard-{self.shard_index}-of-{self.shard_count}')
+        manifest = RunManifest(str(finance_api.today.strftime('%Y-%m-%d')), directory=directory)
+        if force_recompute:
+            manifest.reset()
+        else:
+            self._resume_from_database(manifest, database, industries)
+        return manifest
+
+    def _resume_from_database(self, manifest, database, industries):
+        """
+        Mark industries done whose stocks all have a saved analysis of the manifest date.
+
+        The manifest file lives on the task's disk, a restarted task starts in a fresh container without it, so
+        the saved rows of the day are the checkpoint that survives the task.
+        """
+        saved = defaultdict(set)
+        for row in database.get_analyst_data_by_date(manifest.date):
+            saved[row.get('industry')].add(row['stock'])
+
+        resumed = [industry for industry, stocks in industries.items() if not manifest.is_done(industry)
+                   and {stock['symbol'] for stock in stocks} <= saved[industry]]
+        for industry in resumed:
+            manifest.mark_done(industry, len(industries[industry]))
+        if resumed:
+            logger.info(f'{len(resumed)} industries already saved for {manifest.date}: {resumed}')
+
+    def _shard_industries(self, finance_api, database, shard_index=None, shard_count=None):
+        """
+        Industries of the shard with at least 4 stocks and the digest of the shard plan.
+
+        The shards are balanced by their number of stocks. Workers may warm up different universes, so the plan of
+        the first worker is stored in the database and used by all of them; industries the stored plan does not
+        know are assigned by a stable hash of their name.
+        """
+        shard_index = self.shard_index if shard_index is None else shard_index
+        shard_count = self.shard_count if shard_count is None else shard_count
+        industries = {industry: stocks for industry, stocks in finance_api.industries.items() if len(stocks) >= 4}
+        plan = balanced_shards(industries, shard_count)
+        digest = plan_digest(plan)
+        if shard_count > 1:
+            plan, digest = database.save_shard_plan(str(finance_api.today.strftime('%Y-%m-%d')), shard_count,
+                                                    plan, digest)
+        planned = {industry: index for index, names in enumerate(plan) for industry in names}
+        shard = {industry: stocks for industry, stocks in industries.items()
+                 if planned.get(industry, stable_shard(industry, shard_count)) == shard_index}
+        unplanned = sorted(industry for industry in industries if industry not in planned)
+        if unplanned:
+            logger.info(f'Industries missing from shard plan {digest}: {unplanned}')
+        logger.info(f'Shard {shard_index} of {shard_count} of plan {digest}: {len(shard)} of {len(industries)} '
+                    f'industries, {sum(len(stocks) for stocks in shard.values())} stocks')
+        return shard, digest
+
+    def _mark_shard_complete(self, shard, digest, manifest, database):
+        failed = [industry for industry in shard if not manifest.is_done(industry)]
+        if failed:
+            logger.info(f'Shard {self.shard_index} of {self.shard_count} is incomplete, failed industries: {failed}')
+            return
+        if self.shard_count == 1 and not self.analysis_barrier:
+            return
+        database.save_shard_marker(manifest.date, self.shard_index, self.shard_count, list(shard),
+                                   sum(len(stocks) for stocks in shard.values()), plan_digest=digest)
+
+    def _collect_news(self, industries, agent_pool=None):
+        if agent_pool is None:
+            with ThreadPoolExecutor(max_workers=self.agent_max_workers, thread_name_prefix='agent') as agent_pool:
+                return self._collect_news(industries, agent_pool)
+
+        news = defaultdict(dict)
+        futures = {agent_pool.submit(self.get_news, symbol): (industry, symbol['symbol'])
+                   for industry, stocks in industries.items() for symbol in stocks}
+        for future in as_completed(futures):
+            industry, symbol = futures[future]
+            try:
+                news[industry][symbol] = future.result()
+            except Exception as e:
+                logger.info(f'Error while collecting news for {symbol}, error: {e}')
+                news[industry][symbol] = None
+        return news
+
+    def _prepare_data(self, stocks, news, finance_api):
         data_per_symbol = []
         for symbol in stocks:
-            data, ticker = finance_api.get_history(symbol['symbol'])
+            # The snapshot is read-only, the analyst works on its own copy
+            stock_data = dict(finance_api.get_snapshot(symbol['symbol']))
 
-            self._add_industry_average_to_ticker(ticker, symbol['symbol'], finance_api)
-            ticker.info['name'] = symbol['name']
+            self._add_industry_average(stock_data, symbol['symbol'], finance_api)
+            stock_data['name'] = symbol['name']
+            stock_data['technicalIndicators'] = finance_api.get_technical_indicators(symbol['symbol'])
+            stock_data['StockNews'] = news.get(symbol['symbol'])
 
-            input_text = self.prompts['agent_web_search_stock_analyst']['prompt'].replace("<stock_name>",
-                                                                                          symbol['name'])
+            stock_data = self._remove_unused_data_for_ai(stock_data)
+            stock_data['fingerprint'] = stock_fingerprint(stock_data)
+            data_per_symbol.append(stock_data)
+        return data_per_symbol
 
-            ticker.info['StockNews'] = invoke_agent(input_text)
+    def _carry_forward(self, data_per_symbol, industry, finance_api, database):
+        """
+        Save the last analysis of the industry under today's date if none of its inputs changed materially.
 
-            data_per_symbol.append(self._remove_unused_data_for_ai(ticker.info))
+        Returns the saved stocks, or None if the industry has to be ranked.
+        """
+        if not self.change_detection:
+            return None
+        date = str(finance_api.today.strftime('%Y-%m-%d'))
+        previous = {stock['symbol']: database.get_previous_analysis(stock['symbol'], date)
+                    for stock in data_per_symbol}
+        reason = industry_unchanged(data_per_symbol, previous, industry, date)
+        if reason:
+            logger.info(f'Ranking industry {industry}: {reason}')
+            return None
 
-        stocks_to_send = self.get_ranking(data_per_symbol, industry, finance_api)
+        # Model output and baseline fingerprint are kept, the close is today's
+        carried = [{'symbol': stock['symbol'],
+                    'name': stock.get('name'),
+                    'previousClose': stock.get('previousClose') or previous[stock['symbol']]['close'],
+                    'rank': previous[stock['symbol']].get('rank', 999),
+                    'StockNews': previous[stock['symbol']].get('stock_news', 'None'),
+                    'investment_decision': previous[stock['symbol']].get('investment_decision', 'None'),
+                    'explanation': previous[stock['symbol']].get('explanation', 'No explanation found'),
+                    'fingerprint': previous[stock['symbol']].get('fingerprint'),
+                    'analysed_on': previous[stock['symbol']].get('analysed_on') or previous[stock['symbol']]['date']}
+                   for stock in data_per_symbol]
+        carried.sort(key=lambda stock: stock['rank'])
+        analysed_on = carried[0]['analysed_on']
+        self.skip_report[industry] = {'carried_from': previous[carried[0]['symbol']]['date'],
+                                      'analysed_on': analysed_on, 'stocks': len(carried)}
+        instrumentation.count('analyst.carried_stocks', len(carried))
+        logger.info(f'Inputs of industry {industry} unchanged since {analysed_on}, carrying its analysis forward')
+        return self._save_ranking(carried, industry, finance_api, database)
 
+    def _log_skip_report(self):
+        instrumentation.count('analyst.skipped_industries', len(self.skip_report))
+        logger.info(f'Skipped {len(self.skip_report)} industries with unchanged inputs: {self.skip_report}')
+
+    def _save_ranking(self, stocks_to_send, industry, finance_api, database):
         for st in stocks_to_send:
             st['industry'] = industry
             st['date'] = str(finance_api.today.strftime('%Y-%m-%d'))
 
-        database.save_stock_analytics(stocks_to_send)
+        result = database.save_stock_analytics(stocks_to_send)
+        if result.failed:
+            # The industry must not be checkpointed or counted as complete with missing rows
+            raise RuntimeError(f'{result.failed} analyses of industry {industry} were not saved: '
+                               f'{result.failed_keys}')
+        return stocks_to_send
 
     def get_ranking(self, data, industry, finance_api):
+        plan = self._ranking_plan(data)
+        chunks = next(plan)
+        while True:
+            if len(chunks) == 1:
+                ranked_chunks = [self._get_single_ranking(chunks[0], industry, finance_api)]
+            else:
+                logger.info(f'Tournament ranking for {industry}: {sum(map(len, chunks))} stocks in '
+                            f'{len(chunks)} chunks')
+                with ThreadPoolExecutor(max_workers=self.model_max_workers, thread_name_prefix='chunk') as pool:
+                    ranked_chunks = list(pool.map(
+                        lambda chunk: self._get_single_ranking(chunk, industry, finance_api), chunks))
+            try:
+                chunks = plan.send(ranked_chunks)
+            except StopIteration as stop:
+                return stop.value
+
+    def _ranking_plan(self, data):
+        """
+        Ranking of one industry in rounds. The generator yields the chunks to rank in the next round, receives
+        them ranked and returns the final ranking.
+
+        A large industry is ranked in bounded chunks, then the chunk winners are ranked in a merge round. The
+        merged winners lead the global order, the remaining stocks follow by their position in their chunk.
+        Ranks are renumbered from 1 over the global order.
+        """
+        if len(data) <= self.ranking_chunk_threshold:
+            ranked_chunks = yield [data]
+            return ranked_chunks[0]
+
+        number_of_chunks = math.ceil(len(data) / self.ranking_chunk_size)
+        chunks = [data[i::number_of_chunks] for i in range(number_of_chunks)]
+        ranked_chunks = yield chunks
+
+        winners_per_chunk = max(1, self.ranking_chunk_size // number_of_chunks)
+        winners = [stock for chunk in ranked_chunks for stock in chunk[:winners_per_chunk]]
+        for stock in winners:
+            # Chunk ranks are not comparable across chunks
+            stock.pop('rank', None)
+        rest = sorted(((position, stock) for chunk in ranked_chunks
+                       for position, stock in enumerate(chunk[winners_per_chunk:])), key=lambda item: item[0])
+
+        # Merge round, recurses if there are still too many winners
+        ranking = (yield from self._ranking_plan(winners)) + [stock for _, stock in rest]
+        for rank, stock in enumerate(ranking, start=1):
+            stock['rank'] = rank
+        return ranking
+
+    def _build_ranking_prompt(self, data, industry, finance_api):
 
         # Prompt with user turn only.
-        content = self.prompts['stock_analytics_user']['prompt'].replace("<data>", str(data))
+        payload, report = serialize_stocks(data, RANKING_FIELDS, text_field='StockNews')
+        self.token_report.setdefault(industry, []).append(report)
+        logger.info(f'Ranking prompt for {industry}: {report}')
+        content = self.prompts['stock_analytics_user']['prompt'].replace("<data>", payload)
 
         system_prompt = self.prompts['stock_analytics_system']['prompt'].replace('<date>',
                                                                                  str(finance_api.today.strftime(
                                                                                      '%Y-%m-%d'))) \
             .replace('<industry>', industry)
 
-        response = invoke_model([{
+        return [{
             "role": "user",
             "content": content
-        }], system_prompt)
+        }], system_prompt
+
+    def _get_single_ranking(self, data, industry, finance_api):
+        messages, system_prompt = self._build_ranking_prompt(data, industry, finance_api)
+
+        # Rankings are applied while the completion is still streaming
+        with self._model_slots:
+            response = invoke_model_stream(messages, system_prompt, schema=RANKING_SCHEMA, min_objects=len(data))
+            return self._apply_ranking(data, response)
 
+    def _apply_ranking(self, data, response):
+        """Apply the ranked objects of the model response to the stocks, raises if any stock was not ranked."""
         stock_indicators = data
+        ranked_symbols = set()
         for ai_ranking in response:
             for stock_indicator in stock_indicators:
-                if 'symbol' in ai_ranking and stock_indicator['symbol'] == ai_ranking['symbol']:
+                if stock_indicator['symbol'] == ai_ranking['symbol']:
+                    ranked_symbols.add(stock_indicator['symbol'])
 
                     rank = ai_ranking.get('rank', 99)
                     explanation = ai_ranking.get('explanation', '')
@@ -76,6 +539,12 @@ class StockAnalyst:
                     stock_indicator["explanation"] = explanation
                     stock_indicator["investment_decision"] = investment_decision
 
+        # A refused, abandoned or unparsable reply must fail the industry instead of saving unranked stocks
+        missing = [stock['symbol'] for stock in stock_indicators if stock['symbol'] not in ranked_symbols]
+        if missing:
+            raise ValueError(f'Model response ranked {len(ranked_symbols)} of {len(stock_indicators)} stocks, '
+                             f'missing: {missing}')
+
         try:
             stock_indicators_sorted = sorted(stock_indicators, key=lambda d: d.get('rank', 99))
         except Exception as e:
@@ -91,22 +560,13 @@ class StockAnalyst:
                       'longBusinessSummary', 'fullTimeEmployees', 'companyOfficers']
         return {key: value for key, value in data.items() if key not in parameters}
 
-    def _add_industry_average_to_ticker(self, ticker, symbol, finance_api):
-        parameters = ["trailingPE", "forwardPE", "averageVolume", "trailingAnnualDividendRate", "profitMargins",
-                      "shortRatio", "shortPercentOfFloat", "bookValue", "trailingEps", "forwardEps", "ebitda",
-                      "totalDebt", "totalRevenue", "debtToEquity", "freeCashflow", "earningsGrowth",
-                      "revenueGrowth", "operatingMargins", "pegRatio", "grossMargins", "ebitdaMargins"]
-
-        for parameter in parameters:
+    def _add_industry_average(self, stock_data, symbol, finance_api):
+        for parameter in FUNDAMENTAL_PARAMETERS:
             industry_avg = finance_api.get_industry_or_sector_data(symbol,
                                                                    name="industry",
                                                                    parameter=parameter)
 
-            ticker.info[f"industryAverage{parameter[0].upper()}{parameter[1:]}"] = industry_avg
-
-            symbol_val = finance_api.get_info(ticker, parameter=parameter)
-            ticker.info[parameter] = symbol_val
+            stock_data[f"industryAverage{parameter[0].upper()}{parameter[1:]}"] = industry_avg
 
-    @retry(retries=3, delay=60 * 5)
-    def compare_stocks_with_retry(self, stocks, industry, finance_api, database):
-        self.compare_stocks(stocks, industry, finance_api, database)
+            symbol_val = finance_api.get_fundamental(symbol, parameter=parameter)
+            stock_data[parameter] = symbol_val
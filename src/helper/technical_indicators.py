@@ -0,0 +1,171 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+RSI_PERIOD = 14
+MACD_FAST = 12
+MACD_SLOW = 26
+MACD_SIGNAL = 9
+SMA_SHORT = 50
+SMA_LONG = 200
+VOLATILITY_SHORT = 30
+TRADING_DAYS = 252
+# Bars kept in the panel, enough for the long moving average and one year of returns
+WINDOW = 260
+SUMMARY_DECIMALS = 4
+
+
+def _ema_step(previous, value, alpha):
+    """One recursive EMA step for all symbols, missing values keep the previous state."""
+    result = alpha * value + (1 - alpha) * previous
+    result = result.where(previous.notna(), value)
+    return result.where(value.notna(), previous)
+
+
+class TechnicalIndicatorEngine:
+    """
+    Technical indicators computed on one aligned panel of closes and volumes (rows are dates, columns symbols).
+
+    ``compute`` processes a full history. The exponential averages behind RSI and MACD are kept as state, so
+    ``update`` only has to process bars appended after the last known date.
+    """
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.closes = pd.DataFrame()
+        self.volumes = pd.DataFrame()
+        self.state = {}
+        self.summary = pd.DataFrame()
+
+    @staticmethod
+    def build_panel(histories, column):
+        """Align one column of the per symbol histories on a common tz-naive date index."""
+        series = {}
+        for symbol, history in histories.items():
+            if history is None or history.empty or column not in history or history[column].isna().all():
+                continue
+            values = history[column]
+            index = values.index.tz_localize(None) if values.index.tz is not None else values.index
+            values = pd.Series(values.values, index=index.normalize())
+            series[symbol] = values[~values.index.duplicated(keep='last')]
+        return pd.DataFrame(series).sort_index()
+
+    @classmethod
+    def from_histories(cls, histories, window=WINDOW):
+        engine = cls(window)
+        engine.compute(cls.build_panel(histories, 'Close'), cls.build_panel(histories, 'Volume'))
+        return engine
+
+    @property
+    def last_date(self):
+        return self.closes.index[-1] if not self.closes.empty else None
+
+    def compute(self, closes, volumes):
+        if closes.empty:
+            # Nothing was fetched, e.g. the whole warm-up failed, every symbol gets empty indicators
+            self.closes, self.volumes, self.state, self.summary = pd.DataFrame(), pd.DataFrame(), {}, pd.DataFrame()
+            return self.summary
+
+        closes = closes.sort_index().ffill()
+        delta = closes.diff()
+        alpha = 1 / RSI_PERIOD
+
+        ema_fast = closes.ewm(span=MACD_FAST, adjust=False, ignore_na=True).mean()
+        ema_slow = closes.ewm(span=MACD_SLOW, adjust=False, ignore_na=True).mean()
+        macd = ema_fast - ema_slow
+        self.state = {
+            'avg_gain': delta.clip(lower=0).ewm(alpha=alpha, adjust=False, ignore_na=True).mean().iloc[-1],
+            'avg_loss': (-delta.clip(upper=0)).ewm(alpha=alpha, adjust=False, ignore_na=True).mean().iloc[-1],
+            'ema_fast': ema_fast.iloc[-1],
+            'ema_slow': ema_slow.iloc[-1],
+            'signal': macd.ewm(span=MACD_SIGNAL, adjust=False, ignore_na=True).mean().iloc[-1],
+        }
+
+        self.closes = closes.iloc[-self.window:]
+        self.volumes = volumes.reindex(index=closes.index, columns=closes.columns).iloc[-self.window:]
+        self.summary = self._summarize()
+        return self.summary
+
+    def update(self, closes, volumes):
+        """Process the bars of ``closes``/``volumes`` after the last known date, other rows are ignored."""
+        if self.closes.empty:
+            return self.compute(closes, volumes)
+
+        closes = closes.reindex(columns=self.closes.columns)
+        closes = closes[closes.index > self.last_date].sort_index()
+        if closes.empty:
+            return self.summary
+
+        combined = pd.concat([self.closes, closes]).ffill()
+        new_rows = combined.iloc[len(self.closes):]
+        alpha = 1 / RSI_PERIOD
+        previous_close = self.closes.iloc[-1]
+        for _, close in new_rows.iterrows():
+            delta = close - previous_close
+            self.state['avg_gain'] = _ema_step(self.state['avg_gain'], delta.clip(lower=0), alpha)
+            self.state['avg_loss'] = _ema_step(self.state['avg_loss'], -delta.clip(upper=0), alpha)
+            self.state['ema_fast'] = _ema_step(self.state['ema_fast'], close, 2 / (MACD_FAST + 1))
+            self.state['ema_slow'] = _ema_step(self.state['ema_slow'], close, 2 / (MACD_SLOW + 1))
+            self.state['signal'] = _ema_step(self.state['signal'], self.state['ema_fast'] - self.state['ema_slow'],
+                                             2 / (MACD_SIGNAL + 1))
+            previous_close = close
+
+        volumes = volumes.reindex(index=new_rows.index, columns=self.closes.columns)
+        self.closes = combined.iloc[-self.window:]
+        self.volumes = pd.concat([self.volumes, volumes]).iloc[-self.window:]
+        self.summary = self._summarize()
+        return self.summary
+
+    def _summarize(self):
+        closes = self.closes
+        avg_loss = self.state['avg_loss']
+        rsi = 100 - 100 / (1 + self.state['avg_gain'] / avg_loss.replace(0, np.nan))
+        rsi = rsi.where(avg_loss != 0, 100.0)
+        macd = self.state['ema_fast'] - self.state['ema_slow']
+
+        sma_short = closes.rolling(SMA_SHORT).mean()
+        sma_long = closes.rolling(SMA_LONG).mean()
+        crossover = np.sign(sma_short - sma_long)
+        changes = crossover.ne(crossover.shift()) & crossover.notna() & crossover.shift().notna()
+        days_since_crossover = (changes.iloc[::-1].cumsum() == 0).sum().where(changes.any())
+
+        log_returns = np.log(closes).diff()
+        drawdown = closes / closes.cummax() - 1
+        last_close = closes.iloc[-1]
+
+        return pd.DataFrame({
+            'rsi14': rsi,
+            'macd': macd,
+            'macdSignal': self.state['signal'],
+            'macdHistogram': macd - self.state['signal'],
+            'sma50': sma_short.iloc[-1],
+            'sma200': sma_long.iloc[-1],
+            'priceToSma200': last_close / sma_long.iloc[-1] - 1,
+            'maTrend': crossover.iloc[-1],
+            'daysSinceMaCrossover': days_since_crossover,
+            'volatility30d': log_returns.iloc[-VOLATILITY_SHORT:].std() * math.sqrt(TRADING_DAYS),
+            'volatility1y': log_returns.iloc[-TRADING_DAYS:].std() * math.sqrt(TRADING_DAYS),
+            'maxDrawdown1y': drawdown.iloc[-TRADING_DAYS:].min(),
+            'drawdown': drawdown.iloc[-1],
+            'return1m': last_close / closes.shift(21).iloc[-1] - 1,
+            'return1y': last_close / closes.shift(TRADING_DAYS - 1).iloc[-1] - 1,
+            'volumeRatio20d': self.volumes.iloc[-20:].mean() / self.volumes.mean(),
+        })
+
+    def get(self, symbol):
+        """Compact indicator summary of one symbol, missing values are None."""
+        if symbol not in self.summary.index:
+            return {}
+
+        summary = {}
+        for name, value in self.summary.loc[symbol].items():
+            if pd.isna(value):
+                summary[name] = None
+            elif name == 'maTrend':
+                summary[name] = 'golden cross' if value > 0 else 'death cross' if value < 0 else None
+            elif name == 'daysSinceMaCrossover':
+                summary[name] = int(value)
+            else:
+                summary[name] = round(float(value), SUMMARY_DECIMALS)
+        return summary
@@ -1,74 +1,541 @@
+import codecs
+import hashlib
 import json
+import math
+import os
+import re
+import threading
+import time
 import requests
+from html.parser import HTMLParser
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
 from googlesearch import search
-from bs4 import BeautifulSoup
-from aws_lambda_powertools import Logger
+from aws_lambda_powertools import Logger, Metrics
+from aws_lambda_powertools.metrics import MetricUnit
 import boto3
 import random
 
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
 logger: Logger = Logger(service="internet_search")
-client = boto3.client('lambda')
+metrics: Metrics = Metrics(namespace=os.getenv("METRICS_NAMESPACE", "StockAnalysis"), service="internet_search")
+# Pages are fetched on worker threads, the metric set of powertools is not thread safe
+metrics_lock = threading.Lock()
+# Only needed to recycle the execution environment, created on first use to keep cold starts short
+lambda_client = None
 
+MAX_URLS = int(os.getenv("MAX_URLS", "8"))
+FETCH_MAX_WORKERS = int(os.getenv("FETCH_MAX_WORKERS", "8"))
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT", "12"))
+# Overall deadline for fetching all pages of one search request
+SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE", "30"))
+# Bytes read per page, the rest of large pages is never downloaded
+MAX_PAGE_BYTES = int(os.getenv("MAX_PAGE_BYTES", str(1024 * 1024)))
+CHUNK_SIZE = 64 * 1024
 
-def get_page_content(url):
-    try:
-        response = requests.get(url, timeout=12)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
+# Budget of the assembled search result, tokens are estimated from characters
+RESULT_TOKEN_BUDGET = int(os.getenv("RESULT_TOKEN_BUDGET", "5000"))
+CHARS_PER_TOKEN = 4
+# Hard limit of the serialized response body accepted by the agent
+MAX_RESPONSE_CHARS = int(os.getenv("MAX_RESPONSE_CHARS", "22000"))
+PASSAGE_WORDS = int(os.getenv("PASSAGE_WORDS", "80"))
+DUPLICATE_THRESHOLD = float(os.getenv("DUPLICATE_THRESHOLD", "0.8"))
+SHINGLE_SIZE = 5
+MINHASH_BANDS = 4
+MINHASH_ROWS = 4
+BM25_K1 = 1.5
+BM25_B = 0.75
+TOKEN_PATTERN = re.compile(r'\w+')
+STOP_WORDS = {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is', 'it', 'of', 'on', 'or',
+              'that', 'the', 'to', 'was', 'with', 'news'}
+
+# Seconds a cached search result or page is used without asking the origin again
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", str(60 * 60 * 6)))
+PAGE_CACHE_TTL = int(os.getenv("PAGE_CACHE_TTL", str(60 * 60)))
+# Stale pages are kept for revalidation with ETag/Last-Modified until they reach this age
+CACHE_MAX_AGE = int(os.getenv("CACHE_MAX_AGE", str(60 * 60 * 24 * 7)))
+MEMORY_CACHE_MAX_ENTRIES = int(os.getenv("MEMORY_CACHE_MAX_ENTRIES", "512"))
+# Persistent layer: 'none' or 'tmp'
+PERSISTENT_CACHE = os.getenv("PERSISTENT_CACHE", "tmp")
+PERSISTENT_CACHE_DIR = os.getenv("PERSISTENT_CACHE_DIR", "/tmp/internet_search_cache")
+PERSISTENT_CACHE_MAX_ENTRIES = int(os.getenv("PERSISTENT_CACHE_MAX_ENTRIES", "2000"))
+
+# Policy for recycling the execution environment (and with it its outbound IP and caches):
+# 'never', 'always', 'probability' (RECYCLE_PROBABILITY) or 'invocations' (every RECYCLE_EVERY invocations)
+RECYCLE_POLICY = os.getenv("RECYCLE_POLICY", "never")
+RECYCLE_PROBABILITY = float(os.getenv("RECYCLE_PROBABILITY", "0.5"))
+RECYCLE_EVERY = int(os.getenv("RECYCLE_EVERY", "50"))
+FUNCTION_NAME = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "BedrockAgentInternetSearch")
+
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+# Content of these elements is never part of the article text
+SKIPPED_TAGS = {'script', 'style', 'noscript', 'template', 'svg', 'iframe', 'nav', 'footer', 'header', 'aside',
+                'form', 'button', 'select'}
+BLOCK_TAGS = {'p', 'div', 'br', 'li', 'ul', 'ol', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'tr', 'td', 'th', 'table',
+              'section', 'article', 'main', 'blockquote', 'pre', 'dt', 'dd', 'title', 'figcaption'}
+
+# Pooled session shared across fetches and warm invocations
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=FETCH_MAX_WORKERS, pool_maxsize=FETCH_MAX_WORKERS))
+session.mount('https://', HTTPAdapter(pool_connections=FETCH_MAX_WORKERS, pool_maxsize=FETCH_MAX_WORKERS))
+
+
+class MemoryCache:
+    """In-memory LRU cache living as long as the warm execution environment."""
+
+    def __init__(self, max_entries=MEMORY_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class FileCache:
+    """Persistent cache layer storing one JSON file per key, e.g. in the Lambda /tmp storage."""
+
+    def __init__(self, directory=PERSISTENT_CACHE_DIR, max_entries=PERSISTENT_CACHE_MAX_ENTRIES):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{hashlib.sha256(key.encode()).hexdigest()}.json')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        tmp_path = f'{self._path(key)}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(value, file)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.json')]
+        if len(paths) <= self.max_entries:
+            return
+        paths.sort(key=lambda path: os.path.getmtime(path))
+        for path in paths[:len(paths) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+
+class TwoLevelCache:
+    """
+    Memory LRU in front of an optional persistent layer.
+
+    Entries are dicts with a ``stored_at`` timestamp, entries older than ``max_age`` are treated as missing.
+    Any object with ``get(key)`` and ``set(key, value)`` can serve as persistent layer.
+    """
+
+    def __init__(self, memory, persistent=None, max_age=CACHE_MAX_AGE):
+        self.memory = memory
+        self.persistent = persistent
+        self.max_age = max_age
+
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is None and self.persistent is not None:
+            entry = self.persistent.get(key)
+            if entry is not None:
+                self.memory.set(key, entry)
+        if entry is None or time.time() - entry['stored_at'] > self.max_age:
+            return None
+        return entry
+
+    def set(self, key, value):
+        entry = {**value, 'stored_at': time.time()}
+        self.memory.set(key, entry)
+        if self.persistent is not None:
+            try:
+                self.persistent.set(key, entry)
+            except OSError as e:
+                logger.info(f"Error while writing persistent cache: {e}")
 
-        for script_or_style in soup(["script", "style"]):
-            script_or_style.decompose()
 
-        text = soup.get_text()
+def create_cache():
+    persistent = FileCache() if PERSISTENT_CACHE == 'tmp' else None
+    return TwoLevelCache(MemoryCache(), persistent)
+
+
+cache = create_cache()
+invocations = 0
+
+
+def add_metric(name, unit, value):
+    with metrics_lock:
+        metrics.add_metric(name=name, unit=unit, value=value)
+
+
+class TextCollector:
+    """
+    Parser target collecting visible text while skipping boilerplate elements.
+
+    Implements the lxml target interface (start, end, data, close); ``_StdlibHTMLParser`` drives it with the
+    standard library parser when lxml is not installed.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.skip_depth = 0
+
+    def start(self, tag, attrib=None):
+        tag = tag.lower()
+        if tag in SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def end(self, tag):
+        tag = tag.lower()
+        if tag in SKIPPED_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def data(self, text):
+        if not self.skip_depth:
+            self.parts.append(text)
+
+    def close(self):
+        text = ''.join(self.parts)
         lines = (line.strip() for line in text.splitlines())
         chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        cleaned_text = ';'.join(chunk for chunk in chunks if chunk)
+        return ';'.join(chunk for chunk in chunks if chunk)
+
+
+class _StdlibHTMLParser(HTMLParser):
+    def __init__(self, target):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag)
+
+    def handle_endtag(self, tag):
+        self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+    def close(self):
+        super().close()
+        return self.target.close()
+
+
+def create_parser(target):
+    if etree is not None:
+        return etree.HTMLParser(target=target)
+    return _StdlibHTMLParser(target)
+
+
+def extract_text(chunks, encoding='utf-8'):
+    """
+    Decode the chunks of an HTML document, parse them and return the cleaned text.
+
+    libxml2 drops the text after a feed that ends inside a closing script or style tag, so lxml gets the whole
+    document, capped at ``MAX_PAGE_BYTES``, in one feed. The standard library parser buffers incomplete tags
+    and is fed chunk by chunk.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    parser = create_parser(TextCollector())
+    if etree is not None:
+        texts = [''.join(decoder.decode(chunk) for chunk in chunks)]
+    else:
+        texts = (decoder.decode(chunk) for chunk in chunks)
+    for text in texts:
+        if text:
+            parser.feed(text)
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        parser.feed(tail)
+    return parser.close()
+
+
+def _iter_capped(response, max_bytes, stats):
+    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+        chunk = chunk[:max_bytes - stats['bytes']]
+        stats['bytes'] += len(chunk)
+        yield chunk
+        if stats['bytes'] >= max_bytes:
+            stats['truncated'] = True
+            return
+
+
+def get_page_content(url, timeout=FETCH_TIMEOUT, max_bytes=MAX_PAGE_BYTES):
+    cached = cache.get(f'page:{url}')
+    if cached and time.time() - cached['stored_at'] < PAGE_CACHE_TTL:
+        logger.info(f"Cache hit for {url}")
+        add_metric('PageCacheHits', MetricUnit.Count, 1)
+        return cached['text']
+
+    # Revalidate a stale copy instead of downloading it again
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+
+    start = time.monotonic()
+    stats = {'bytes': 0, 'truncated': False}
+    try:
+        with session.get(url, timeout=timeout, stream=True, headers=headers) as response:
+            if response.status_code == 304 and cached:
+                logger.info(f"Revalidated {url} in {round(time.monotonic() - start, 2)}s")
+                add_metric('PageRevalidations', MetricUnit.Count, 1)
+                cache.set(f'page:{url}', cached)
+                return cached['text']
+
+            response.raise_for_status()
+
+            content_type = response.headers.get('Content-Type', '').lower()
+            if content_type and not content_type.startswith(HTML_CONTENT_TYPES):
+                logger.info(f"Skipping {url}, content type {content_type}")
+                return None
+
+            encoding = response.encoding if 'charset' in content_type else 'utf-8'
+            try:
+                codecs.lookup(encoding)
+            except LookupError:
+                encoding = 'utf-8'
+            cleaned_text = extract_text(_iter_capped(response, max_bytes, stats), encoding)
+
+        logger.info(f"Fetched {url} in {round(time.monotonic() - start, 2)}s, {stats['bytes']} bytes"
+                    f"{' (truncated)' if stats['truncated'] else ''}")
+        add_metric('PagesFetched', MetricUnit.Count, 1)
+        add_metric('BytesScraped', MetricUnit.Bytes, stats['bytes'])
+        add_metric('PageFetchSeconds', MetricUnit.Seconds, time.monotonic() - start)
+        if cleaned_text:
+            cache.set(f'page:{url}', {'text': cleaned_text,
+                                      'etag': response.headers.get('ETag'),
+                                      'last_modified': response.headers.get('Last-Modified')})
         return cleaned_text
     except requests.RequestException as e:
         logger.info(f"Request error while fetching {url}: {e}")
     except Exception as e:
         logger.info(f"Error while processing content from {url}: {e}")
+    add_metric('PageFetchErrors', MetricUnit.Count, 1)
     return None
 
 
 def search_google(query, num_results=10, sleep_interval=5):
+    cached = cache.get(f'query:{query}:{num_results}')
+    if cached and time.time() - cached['stored_at'] < QUERY_CACHE_TTL:
+        logger.info(f"Cache hit for query {query}")
+        add_metric('QueryCacheHits', MetricUnit.Count, 1)
+        return cached['urls']
+
     try:
-        return [j for j in search(query, num_results=num_results, sleep_interval=sleep_interval)]
+        urls = [j for j in search(query, num_results=num_results, sleep_interval=sleep_interval)]
     except Exception as e:
         logger.info(f"Error during Google search: {e}")
-        return []
+        return cached['urls'] if cached else []
+
+    if urls:
+        cache.set(f'query:{query}:{num_results}', {'urls': urls})
+    return urls
+
+
+def should_recycle():
+    if RECYCLE_POLICY == 'always':
+        return True
+    if RECYCLE_POLICY == 'probability':
+        return random.random() < RECYCLE_PROBABILITY
+    if RECYCLE_POLICY == 'invocations':
+        return invocations % RECYCLE_EVERY == 0
+    return False
+
+
+def recycle_execution_environment():
+    """Changing the configuration forces new execution environments, dropping all warm caches."""
+    global lambda_client
+    logger.info(f"Updating lambda configuration for new execution environment, policy {RECYCLE_POLICY}")
+    if lambda_client is None:
+        lambda_client = boto3.client('lambda')
+    lambda_client.update_function_configuration(
+        FunctionName=FUNCTION_NAME,
+        Timeout=random.choice(range(600, 700)),
+        MemorySize=random.choice(range(4048, 5048)),
+    )
+
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOP_WORDS]
+
+
+def split_passages(page, passage_words=PASSAGE_WORDS):
+    """Group the ';' separated chunks of a page into passages of roughly ``passage_words`` words."""
+    passages = []
+    current, words = [], 0
+    for chunk in page.split(';'):
+        current.append(chunk)
+        words += len(chunk.split())
+        if words >= passage_words:
+            passages.append(';'.join(current))
+            current, words = [], 0
+    if current:
+        passages.append(';'.join(current))
+    return passages
+
 
+def _shingles(tokens):
+    if len(tokens) < SHINGLE_SIZE:
+        return {hash(tuple(tokens))}
+    return {hash(tuple(tokens[i:i + SHINGLE_SIZE])) for i in range(len(tokens) - SHINGLE_SIZE + 1)}
 
-def handle_search(event):
+
+_MINHASH_SEEDS = [random.Random(seed).getrandbits(64) for seed in range(MINHASH_BANDS * MINHASH_ROWS)]
+
+
+def remove_near_duplicates(passages, threshold=DUPLICATE_THRESHOLD):
+    """
+    Drop passages whose word shingles overlap an earlier passage by at least ``threshold`` (Jaccard).
+
+    MinHash signatures banded into LSH buckets select the candidates, only those are compared exactly.
+    """
+    kept = []
+    buckets = {}
+    for passage in passages:
+        shingles = _shingles(tokenize(passage))
+        signature = [min(shingle ^ seed for shingle in shingles) for seed in _MINHASH_SEEDS]
+        bands = [(band, tuple(signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]))
+                 for band in range(MINHASH_BANDS)]
+
+        candidates = {index for band in bands for index in buckets.get(band, ())}
+        if any(len(shingles & kept[index][1]) / len(shingles | kept[index][1]) >= threshold
+               for index in candidates):
+            continue
+
+        for band in bands:
+            buckets.setdefault(band, []).append(len(kept))
+        kept.append((passage, shingles))
+    return [passage for passage, _ in kept]
+
+
+def bm25_scores(query, passages):
+    query_terms = set(tokenize(query))
+    documents = [tokenize(passage) for passage in passages]
+    if not documents or not query_terms:
+        return [0.0] * len(passages)
+
+    average_length = sum(len(document) for document in documents) / len(documents) or 1
+    document_frequency = {term: sum(1 for document in documents if term in document) for term in query_terms}
+
+    scores = []
+    for document in documents:
+        score = 0.0
+        for term in query_terms:
+            frequency = document.count(term)
+            if not frequency:
+                continue
+            idf = math.log(1 + (len(documents) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+            score += idf * frequency * (BM25_K1 + 1) / (
+                    frequency + BM25_K1 * (1 - BM25_B + BM25_B * len(document) / average_length))
+        scores.append(score)
+    return scores
+
+
+def assemble_results(query, pages, token_budget=RESULT_TOKEN_BUDGET):
+    """
+    Select the passages most relevant to ``query`` from all pages within ``token_budget``.
+
+    Passages are deduplicated across pages, ranked with BM25 and the selected ones are returned in page order.
+    """
+    passages = remove_near_duplicates([passage for page in pages for passage in split_passages(page)])
+    scores = bm25_scores(query, passages)
+    ranking = sorted(range(len(passages)), key=lambda index: -scores[index])
+
+    selected = []
+    budget = token_budget * CHARS_PER_TOKEN
+    for index in ranking:
+        length = len(passages[index]) + 1
+        if length > budget and not selected:
+            # The most relevant passage alone exceeds the budget, it is cut at a word boundary instead of dropped
+            passages[index] = passages[index][:max(budget - 1, 0)].rsplit(' ', 1)[0]
+            length = len(passages[index]) + 1
+        if length <= budget and passages[index]:
+            selected.append(index)
+            budget -= length
+
+    logger.info(f"Assembled {len(selected)}/{len(passages)} passages, "
+                f"{token_budget * CHARS_PER_TOKEN - budget} chars of {token_budget * CHARS_PER_TOKEN}")
+    return [(passages[index], scores[index]) for index in sorted(selected)]
+
+
+def serialize_results(passages, max_chars=MAX_RESPONSE_CHARS):
+    """Serialize passages to JSON, dropping the least relevant ones until the body fits into ``max_chars``."""
+    passages = list(passages)
+    result_json = json.dumps({"results": ";".join(passage for passage, _ in passages)})
+    while len(result_json) > max_chars and passages:
+        passages.remove(min(passages, key=lambda passage: passage[1]))
+        result_json = json.dumps({"results": ";".join(passage for passage, _ in passages)})
+    return result_json
+
+
+def handle_search(event, deadline=SEARCH_DEADLINE):
     input_text = event.get('inputText', '')
+    start = time.monotonic()
+
+    urls_to_scrape = search_google(input_text)[:MAX_URLS]
+    remaining = max(0.0, deadline - (time.monotonic() - start))
+    timeout = min(FETCH_TIMEOUT, remaining)
+
+    executor = ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS)
+    futures = [executor.submit(get_page_content, url, timeout) for url in urls_to_scrape]
+    done, not_done = wait(futures, timeout=remaining)
+    # Return what arrived before the deadline, late fetches are abandoned
+    executor.shutdown(wait=False, cancel_futures=True)
 
-    urls_to_scrape = search_google(input_text)
-    results = []
+    if not_done:
+        add_metric('PagesSkippedByDeadline', MetricUnit.Count, len(not_done))
+        logger.info(f"Deadline of {deadline}s hit, {len(not_done)}/{len(futures)} pages skipped: "
+                    f"{[url for url, future in zip(urls_to_scrape, futures) if future in not_done]}")
 
-    for url in urls_to_scrape[:8]:
-        logger.info(f"URL: {url}")
-        content = get_page_content(url)
-        if content:
-            results.append(content)
+    # Keep the search engine's order of results
+    results = [future.result() for future in futures if future in done and future.result()]
 
-    return {"results": ";".join(results)}
+    logger.info(f"Search finished in {round(time.monotonic() - start, 2)}s, {len(results)} pages")
+    add_metric('SearchSeconds', MetricUnit.Seconds, time.monotonic() - start)
+    return assemble_results(input_text, results)
 
 
+@metrics.log_metrics
 def lambda_handler(event, context):
+    global invocations
+    invocations += 1
     logger.info(f"Agent Event: {event}")
 
     response_code = 200
     if event.get('apiPath') == '/search':
-        result = handle_search(event)
+        result_json = serialize_results(handle_search(event))
     else:
         response_code = 404
-        result = {"error": "Unrecognized API path"}
-
-    result_json = json.dumps(result)
-
-    if len(result_json) > 22000:
-        logger.info("Response too big, trimming to 22k chars")
-        result_json = result_json[:22000]
+        result_json = json.dumps({"error": "Unrecognized API path"})
 
     response_body = {
         'application/json': {
@@ -91,13 +558,8 @@ def lambda_handler(event, context):
 
     logger.info(f"Response: {action_response}")
 
-    if random.choice([1, 2]) == 1:
-        logger.info("Updating lambda configuration for new execution environment")
-        client.update_function_configuration(
-            FunctionName='BedrockAgentInternetSearch',
-            Timeout=random.choice(range(600, 700)),
-            MemorySize=random.choice(range(4048, 5048)),
-        )
+    if should_recycle():
+        recycle_execution_environment()
 
     return api_response
 
@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [SRC_DIR, os.path.join(SRC_DIR, 'lambda')]
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+@pytest.fixture(autouse=True)
+def src_dir(monkeypatch):
+    # Prompts and schemas are loaded relative to src, like the container does
+    monkeypatch.chdir(SRC_DIR)
@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+import pytest
+
+from benchmark import fakes
+from helper import finance_api
+from helper.finance_api import FinanceService
+from helper.market_cache import MarketDataCache
+
+SYMBOL = 'SYM00000'
+
+
+@pytest.fixture
+def history_service(tmp_path, monkeypatch):
+    """Service with a stale history cache of ``SYMBOL`` which lacks the last 5 bars of the fixture."""
+    fixtures = fakes.TickerFixtures.synthetic([{'symbol': SYMBOL, 'index': False}], 1)
+    monkeypatch.setattr(finance_api, 'yf', fakes.FakeYFinance(fixtures))
+    history = fixtures.fixtures[SYMBOL][0]
+
+    def create(cached):
+        service = FinanceService(market_cache_dir=None)
+        service.market_cache = MarketDataCache(str(tmp_path), ttl={'history': -1})
+        service.market_cache.put('history', SYMBOL, cached)
+        service.today = (history.index.max() + timedelta(days=1)).to_pydatetime().replace(tzinfo=None)
+        return service
+
+    return history, create
+
+
+def test_history_delta_appends_new_bars(history_service):
+    history, create = history_service
+    service = create(history.iloc[:-5])
+    data, _ = service.get_history(SYMBOL)
+    assert data['Close'].equals(service._trim_history(history, data.index.min().strftime('%Y-%m-%d'))['Close'])
+    assert service.market_cache.stats['history_delta_bars'] == 5
+    assert service.market_cache.stats['history_adjusted'] == 0
+
+
+def test_adjusted_history_is_downloaded_again(history_service):
+    history, create = history_service
+    # Closes cached before a 2:1 split, Yahoo reports all of them halved now
+    cached = history.iloc[:-5].copy()
+    cached['Close'] *= 2
+    service = create(cached)
+    data, _ = service.get_history(SYMBOL)
+    assert service.market_cache.stats['history_adjusted'] == 1
+    assert (data['Close'] == history['Close'].reindex(data.index)).all()
+    stored, _ = service.market_cache.get('history', SYMBOL)
+    assert (stored['Close'] == history['Close'].reindex(stored.index)).all()
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from benchmark.fakes import FakeEventStream, throttling_error
+from helper import helper
+from helper.json_stream import RANKING_SCHEMA
+
+RANKING = [{'symbol': 'AAA', 'rank': 1}, {'symbol': 'BBB', 'rank': 2}]
+
+
+def _events(text, chunk_chars=7):
+    events = [{'type': 'message_start', 'message': {'usage': {'input_tokens': 10}}}]
+    events += [{'type': 'content_block_delta', 'delta': {'type': 'text_delta', 'text': text[i:i + chunk_chars]}}
+               for i in range(0, len(text), chunk_chars)]
+    events += [{'type': 'message_stop'}]
+    return [{'chunk': {'bytes': json.dumps(event).encode()}} for event in events]
+
+
+class ScriptedRuntime:
+    """``bedrock-runtime`` client answering stream requests with the next of the scripted streams."""
+
+    def __init__(self, streams):
+        self.streams = list(streams)
+        self.calls = 0
+
+    def invoke_model_with_response_stream(self, body, modelId):
+        self.calls += 1
+        return {'body': self.streams.pop(0)}
+
+
+@pytest.fixture
+def runtime(monkeypatch):
+    def install(*streams):
+        client = ScriptedRuntime(streams)
+        monkeypatch.setitem(helper.clients, 'bedrock-runtime', client)
+        return client
+
+    monkeypatch.setattr(helper, 'rate_limiter', helper.RateLimiter(
+        rate_limits={'invoke_model': (1000, 1000)}, base_delay=0))
+    monkeypatch.setattr(helper, 'response_cache', None)
+    return install
+
+
+def _stream(text, error=None, error_after=0):
+    return FakeEventStream(_events(text), 0, 0, error=error, error_after=error_after)
+
+
+def test_throttling_event_before_first_object_is_retried(runtime):
+    error = throttling_error('InvokeModelWithResponseStream', True)
+    client = runtime(_stream('[]', error=error, error_after=0), _stream('[]', error=error, error_after=1),
+                     _stream(json.dumps(RANKING)))
+    assert list(helper.invoke_model_stream([], 'system', schema=RANKING_SCHEMA)) == RANKING
+    assert client.calls == 3
+
+
+def test_stream_error_after_first_object_is_raised(runtime):
+    error = throttling_error('InvokeModelWithResponseStream', True)
+    text = json.dumps(RANKING)
+    client = runtime(_stream(text, error=error, error_after=6), _stream(text))
+    results = []
+    with pytest.raises(Exception, match='Rate exceeded'):
+        for obj in helper.invoke_model_stream([], 'system', schema=RANKING_SCHEMA):
+            results.append(obj)
+    assert results == RANKING[:1]
+    assert client.calls == 1
+
+
+def test_other_errors_are_not_retried(runtime):
+    client = runtime(_stream('[]', error=ValueError('broken'), error_after=1), _stream(json.dumps(RANKING)))
+    with pytest.raises(ValueError):
+        list(helper.invoke_model_stream([], 'system', schema=RANKING_SCHEMA))
+    assert client.calls == 1
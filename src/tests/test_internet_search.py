@@ -0,0 +1,55 @@
+import pytest
+
+import internet_search
+
+PAGE = ('<html><head><title>Quarterly results</title><script>var tracking = "</p>";</script>'
+        '<style>p { color: red; }</style></head><body>'
+        + ''.join(f'<p>Revenue grew in quarter {index}</p>' for index in range(200)) + '</body></html>')
+
+
+def _split_at(text, index):
+    data = text.encode()
+    return [data[:index], data[index:]]
+
+
+@pytest.fixture(params=['lxml', 'stdlib'])
+def parser_backend(request, monkeypatch):
+    if request.param == 'stdlib':
+        monkeypatch.setattr(internet_search, 'etree', None)
+    return request.param
+
+
+@pytest.mark.parametrize('tag', ['</script>', '</style>'])
+def test_extract_text_split_inside_closing_tag(parser_backend, tag):
+    expected = internet_search.extract_text([PAGE.encode()])
+    index = PAGE.index(tag) + 3
+    assert internet_search.extract_text(_split_at(PAGE, index)) == expected
+    assert 'Revenue grew in quarter 199' in expected
+
+
+def test_extract_text_small_chunks(parser_backend):
+    data = PAGE.encode()
+    chunks = [data[index:index + 7] for index in range(0, len(data), 7)]
+    assert internet_search.extract_text(chunks) == internet_search.extract_text([data])
+
+
+def test_extract_text_split_inside_multibyte_character(parser_backend):
+    page = '<html><body><p>Umsatz 5 € höher</p></body></html>'
+    data = page.encode()
+    index = data.index('€'.encode()) + 1
+    assert internet_search.extract_text([data[:index], data[index:]]) == 'Umsatz 5 € höher'
+
+
+def test_extract_text_skips_scripts(parser_backend):
+    assert 'tracking' not in internet_search.extract_text([PAGE.encode()])
+
+
+def test_assemble_results_truncates_top_passage_to_budget():
+    page = ' '.join(['stock market earnings outlook'] * 100)
+    results = internet_search.assemble_results('earnings outlook', [page], token_budget=100)
+    assert len(results) == 1
+    passage, score = results[0]
+    assert score > 0
+    assert 300 < len(passage) < 100 * internet_search.CHARS_PER_TOKEN
+    assert page.startswith(passage)
+
@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from helper.json_stream import JsonArrayStreamParser, parse_json_array, RANKING_SCHEMA
+
+RANKING = [{'symbol': 'AAA', 'rank': 1, 'explanation': 'Beats [peers] on "margins" {and growth}]'},
+           {'symbol': 'BBB', 'rank': 2, 'explanation': 'Escaped quote \\" and bracket ['},
+           {'symbol': 'CCC', 'rank': 3, 'explanation': 'Nested', 'investment_decision': 'hold'}]
+
+
+def _feed_in_chunks(text, size, schema=RANKING_SCHEMA):
+    parser = JsonArrayStreamParser(schema)
+    objects = []
+    for start in range(0, len(text), size):
+        objects += parser.feed(text[start:start + size])
+    return parser, objects
+
+
+@pytest.mark.parametrize('size', [1, 3, 7, 1000])
+def test_brackets_inside_strings(size):
+    parser, objects = _feed_in_chunks(json.dumps(RANKING), size)
+    assert objects == RANKING
+    assert parser.finished and parser.valid == 3 and parser.invalid == 0
+
+
+@pytest.mark.parametrize('preamble', ['Here is the ranking [by score]:\n', 'Ranking of [3] stocks [] ',
+                                      'Sure! Note [1]: ranks are relative.\n\n'])
+def test_bracketed_preamble(preamble):
+    parser, objects = _feed_in_chunks(preamble + json.dumps(RANKING, indent=1), 5)
+    assert objects == RANKING
+
+
+def test_truncated_stream_keeps_complete_objects():
+    text = json.dumps(RANKING)
+    truncated = text[:text.index('"CCC"') + 10]
+    parser, objects = _feed_in_chunks(truncated, 4)
+    assert objects == RANKING[:2]
+    assert not parser.finished
+    assert parse_json_array(truncated, RANKING_SCHEMA) == RANKING[:2]
+
+
+@pytest.mark.parametrize('text', ["I'm sorry, I can't rank these stocks.", '', '[]', 'No data [none]'])
+def test_empty_parse(text):
+    parser, objects = _feed_in_chunks(text, 3)
+    assert objects == []
+    assert parser.valid == 0
+
+
+def test_refusal_is_abandoned_after_preamble():
+    parser = JsonArrayStreamParser(RANKING_SCHEMA, max_preamble_chars=20)
+    assert parser.feed("I'm sorry, I can't rank these stocks.") == []
+    assert parser.abandoned
+
+
+def test_invalid_elements_are_dropped():
+    text = json.dumps([{'rank': 1}, ['AAA'], RANKING[0], {'symbol': 'BBB', 'rank': True}])
+    parser, objects = _feed_in_chunks(text, 6)
+    assert objects == [RANKING[0]]
+    assert parser.valid == 1 and parser.invalid == 3
+
+
+def test_python_literal_elements():
+    assert parse_json_array("[{'symbol': 'AAA', 'rank': 1}]", RANKING_SCHEMA) == [{'symbol': 'AAA', 'rank': 1}]
@@ -0,0 +1,26 @@
+import pytest
+
+from helper.prompt_serializer import format_value
+
+
+@pytest.mark.parametrize('value,expected', [
+    (54321.7, '54320'),
+    (1234.5, '1234'),
+    (0.00001234, '0.00001234'),
+    (-0.5, '-0.5'),
+    (12.0, '12'),
+    (0.1 + 0.2, '0.3'),
+    (9999.7, '10000'),
+    (0, '0'),
+    (1.5e6, '1.5M'),
+    (-2.345678e9, '-2.346B'),
+    (1.234e15, '1234T'),
+    (float('nan'), ''),
+    (float('inf'), ''),
+    (None, ''),
+    (True, 'true'),
+    ('  Strong   buy\n', 'Strong buy'),
+])
+def test_format_value(value, expected):
+    assert format_value(value) == expected
+    assert 'e+' not in format_value(value) and 'e-' not in format_value(value)
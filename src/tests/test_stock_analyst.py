@@ -0,0 +1,57 @@
+import pytest
+
+from helper.stock_analyst import StockAnalyst
+
+
+def _stocks(count):
+    # Scores are a permutation of the indices, so the expected order is known
+    return [{'symbol': f'S{index:03d}', 'score': (index * 7919) % count} for index in range(count)]
+
+
+def _rank(chunk):
+    ranked = sorted(chunk, key=lambda stock: -stock['score'])
+    for rank, stock in enumerate(ranked, start=1):
+        stock['rank'] = rank
+    return ranked
+
+
+def _run_plan(analyst, stocks):
+    plan = analyst._ranking_plan(stocks)
+    chunks = next(plan)
+    rounds = 1
+    while True:
+        try:
+            chunks = plan.send([_rank(chunk) for chunk in chunks])
+            rounds += 1
+        except StopIteration as stop:
+            return stop.value, rounds
+
+
+@pytest.mark.parametrize('count', [1, 5, 13, 17, 31, 37, 100, 129])
+@pytest.mark.parametrize('chunk_size,threshold', [(5, 8), (12, 15), (7, 7)])
+def test_tournament_ranks_every_stock_once(count, chunk_size, threshold):
+    analyst = StockAnalyst(ranking_chunk_size=chunk_size, ranking_chunk_threshold=threshold)
+    stocks = _stocks(count)
+    ranking, rounds = _run_plan(analyst, stocks)
+
+    assert sorted(stock['symbol'] for stock in ranking) == sorted(stock['symbol'] for stock in stocks)
+    assert [stock['rank'] for stock in ranking] == list(range(1, count + 1))
+    assert ranking[0]['score'] == count - 1
+    assert rounds == 1 if count <= threshold else rounds >= 2
+
+
+def test_apply_ranking_raises_on_empty_response():
+    with pytest.raises(ValueError, match='ranked 0 of 2 stocks'):
+        StockAnalyst()._apply_ranking([{'symbol': 'AAA'}, {'symbol': 'BBB'}], iter([]))
+
+
+def test_apply_ranking_raises_on_missing_stock():
+    with pytest.raises(ValueError, match=r"missing: \['BBB'\]"):
+        StockAnalyst()._apply_ranking([{'symbol': 'AAA'}, {'symbol': 'BBB'}],
+                                      iter([{'symbol': 'AAA', 'rank': 1}, {'symbol': 'XXX', 'rank': 2}]))
+
+
+def test_apply_ranking_sorts_by_rank():
+    ranked = StockAnalyst()._apply_ranking([{'symbol': 'AAA'}, {'symbol': 'BBB'}],
+                                           iter([{'symbol': 'BBB', 'rank': 1}, {'symbol': 'AAA', 'rank': 2}]))
+    assert [stock['symbol'] for stock in ranked] == ['BBB', 'AAA']
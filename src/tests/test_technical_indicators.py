@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+from helper.technical_indicators import TechnicalIndicatorEngine
+
+DATES = pd.date_range('2025-01-01', periods=300)
+
+
+def _history(closes):
+    return pd.DataFrame({'Close': closes, 'Volume': 1000.0}, index=DATES)
+
+
+def test_empty_panel_gives_empty_indicators():
+    engine = TechnicalIndicatorEngine.from_histories({})
+    assert engine.summary.empty
+    assert engine.get('AAA') == {}
+    assert engine.update(pd.DataFrame(), pd.DataFrame()).empty
+
+
+def test_symbols_without_closes_are_skipped():
+    engine = TechnicalIndicatorEngine.from_histories({
+        'AAA': _history(np.linspace(100, 200, len(DATES))),
+        'BBB': _history(np.nan),
+        'CCC': pd.DataFrame(columns=['Close', 'Volume']),
+    })
+    assert list(engine.summary.index) == ['AAA']
+    assert engine.get('BBB') == {}
+    assert engine.get('AAA')['maTrend'] == 'golden cross'
+
+
+def test_update_matches_compute():
+    closes = pd.Series(np.cumsum(np.sin(np.arange(len(DATES)) / 7)) + 100, index=DATES)
+    full = TechnicalIndicatorEngine.from_histories({'AAA': _history(closes)})
+    engine = TechnicalIndicatorEngine.from_histories({'AAA': _history(closes)[:-5]})
+    panel = TechnicalIndicatorEngine.build_panel({'AAA': _history(closes)}, 'Close')
+    volumes = TechnicalIndicatorEngine.build_panel({'AAA': _history(closes)}, 'Volume')
+    engine.update(panel, volumes)
+    for name, value in full.get('AAA').items():
+        assert engine.get('AAA')[name] == value or abs(engine.get('AAA')[name] - value) < 1e-3, name